@@ -0,0 +1,78 @@
+"""Run the bot's tasks against local stand-ins for reddit, YouTube and
+LiveLeak, and compare the results against a baseline."""
+import json
+import logging
+import sys
+
+import rlb.benchmark as benchmark
+
+
+def create_parser():
+    from optparse import OptionParser
+    p = OptionParser("usage: %prog [options]")
+    p.add_option(
+        "-s", "--subreddits", dest="subreddits", type="int", default=4,
+        help="The number of subreddits to monitor")
+    p.add_option(
+        "-n", "--submissions", dest="submissions", type="int", default=100,
+        help="The number of submissions to each subreddit")
+    p.add_option(
+        "-v", "--videos", dest="videos", type="int", default=200,
+        help="The number of distinct videos the submissions link to")
+    p.add_option(
+        "-d", "--deletion-rate", dest="deletion_rate", type="float",
+        default=0.1, help="The share of the videos deleted from YouTube")
+    p.add_option(
+        "--video-size", dest="video_size", type="int", default=64 * 1024,
+        help="The size of each downloaded video, in bytes")
+    p.add_option(
+        "-l", "--latency", dest="latency", type="float", default=0.0,
+        help="The latency of each request, in seconds")
+    p.add_option(
+        "--deferred", dest="deferred", action="store_true", default=False,
+        help="Queue new videos and download them in a separate phase")
+    p.add_option(
+        "-b", "--baseline", dest="baseline", default=None,
+        help="Compare the results against the baseline in this JSON file")
+    p.add_option(
+        "-t", "--tolerance", dest="tolerance", type="float", default=0.25,
+        help="How much slower or bigger than the baseline is acceptable")
+    p.add_option(
+        "-o", "--output", dest="output", default=None,
+        help="Save the results to this JSON file, e.g. as a new baseline")
+    p.add_option(
+        "--verbose", dest="verbose", action="store_true", default=False,
+        help="Show the bot's log messages")
+    return p
+
+
+def main():
+    p = create_parser()
+    opts, args = p.parse_args()
+    if args:
+        p.error("invalid number of arguments")
+    if not opts.verbose:
+        logging.disable(logging.INFO)
+
+    scale = benchmark.Scale(opts.subreddits, opts.submissions, opts.videos,
+                            opts.deletion_rate, opts.video_size)
+    results = benchmark.Benchmark(scale, opts.latency,
+                                  opts.deferred).run()
+    print benchmark.format_results(results)
+
+    if opts.output:
+        with open(opts.output, "w") as fout:
+            json.dump(results, fout, indent=2, sort_keys=True)
+
+    if opts.baseline:
+        with open(opts.baseline) as fin:
+            baseline = json.load(fin)
+        regressions = benchmark.compare(results, baseline, opts.tolerance)
+        for regression in regressions:
+            print "REGRESSION: %s" % regression
+        if regressions:
+            sys.exit(1)
+        print "no regressions against %s" % opts.baseline
+
+if __name__ == "__main__":
+    main()
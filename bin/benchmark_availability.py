@@ -0,0 +1,80 @@
+"""Compare ways of checking whether videos are still available on YouTube.
+
+Runs against a local fake of the YouTube Data API that adds a fixed
+latency to every request."""
+import time
+
+import rlb.youtube as youtube
+from rlb.fakes import FakeYoutubeApi
+from rlb.net import create_session
+
+
+def create_parser():
+    from optparse import OptionParser
+    p = OptionParser("usage: %prog [options]")
+    p.add_option(
+        "-n", "--videos", dest="videos", type="int", default=2000,
+        help="The number of videos to check")
+    p.add_option(
+        "-l", "--latency", dest="latency", type="float", default=0.1,
+        help="The latency of each API request, in seconds")
+    p.add_option(
+        "-f", "--in-flight", dest="in_flight", type="int", default=4,
+        help="The number of requests the checker keeps in flight")
+    p.add_option(
+        "--per-video", dest="per_video", action="store_true", default=False,
+        help="Also time one request per video (slow)")
+    return p
+
+
+def sequential(api, video_ids, session):
+    """What monitor_deleted_videos used to do: one batch at a time."""
+    alive = set()
+    for chunk in youtube.chunk_ids(video_ids):
+        alive.update(youtube.check_chunk(chunk, "benchmark", "key", session,
+                                         api.url))
+    return alive
+
+
+def per_video(api, video_ids, session):
+    """What monitor_deleted_videos did originally: one video at a time."""
+    return set(i for i in video_ids
+               if youtube.check_chunk([i], "benchmark", "key", session,
+                                      api.url))
+
+
+def main():
+    p = create_parser()
+    opts, args = p.parse_args()
+    if args:
+        p.error("invalid number of arguments")
+    video_ids = ["video%06d" % i for i in range(opts.videos)]
+    api = FakeYoutubeApi(video_ids[::2], latency=opts.latency).start()
+    session = create_session("benchmark", pool_size=opts.in_flight,
+                             max_retries=0)
+
+    checker = youtube.AvailabilityChecker(
+        "benchmark", "key", session, max_in_flight=opts.in_flight,
+        requests_per_second=1000, url=api.url)
+    candidates = [
+        ("sequential", lambda: sequential(api, video_ids, session)),
+        ("checker", lambda: checker.check(video_ids)[0]),
+    ]
+    if opts.per_video:
+        candidates.insert(0, ("per video", lambda: per_video(
+            api, video_ids, session)))
+
+    print "%d videos, %.0fms latency" % (opts.videos, opts.latency * 1000)
+    try:
+        for name, func in candidates:
+            api.requests = 0
+            start = time.time()
+            alive = func()
+            seconds = time.time() - start
+            assert len(alive) == (opts.videos + 1) // 2
+            print "%-12s %8.2fs %6d requests" % (name, seconds, api.requests)
+    finally:
+        api.stop()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+"""Compare the YouTube URL extractor with the one it replaced.
+
+Runs both over the submission URLs in a saved reddit listing."""
+import json
+import re
+import timeit
+import os.path as P
+
+import rlb.youtube
+
+DEFAULT_LISTING = P.join(P.dirname(P.abspath(__file__)),
+                         "../rlb/test/UkrainianConflict.json")
+
+
+def old_extract_id(url):
+    """The extractor we used to have: two uncompiled patterns."""
+    m = re.search("watch%3Fv%3D(?P<id>[a-zA-Z0-9-_]{11})", url)
+    if m:
+        return m.group("id")
+    m = re.search(r"youtu\.?be.*(v=|/)(?P<id>[a-zA-Z0-9-_]{11})", url)
+    if m:
+        return m.group("id")
+    return None
+
+
+def create_parser():
+    from optparse import OptionParser
+    p = OptionParser("usage: %prog [listing.json]")
+    p.add_option(
+        "-n", "--number", dest="number", type="int", default=2000,
+        help="The number of times to go through the listing")
+    return p
+
+
+def main():
+    p = create_parser()
+    opts, args = p.parse_args()
+    if len(args) > 1:
+        p.error("invalid number of arguments")
+    path = args[0] if args else DEFAULT_LISTING
+    with open(path) as fin:
+        listing = json.load(fin)
+    urls = [child["data"]["url"] for child in listing["data"]["children"]]
+
+    old = [old_extract_id(url) for url in urls]
+    new = rlb.youtube.extract_ids(urls)
+    for url, old_id, new_id in zip(urls, old, new):
+        if old_id != new_id:
+            print "differs: %s old: %s new: %s" % (url, old_id, new_id)
+    print "%d URLs, %d YouTube links" % (len(urls), len(filter(None, new)))
+
+    candidates = [
+        ("old extract_id", lambda: [old_extract_id(url) for url in urls]),
+        ("extract_id", lambda: [rlb.youtube.extract_id(url) for url in urls]),
+        ("extract_ids", lambda: rlb.youtube.extract_ids(urls)),
+    ]
+    baseline = None
+    for name, func in candidates:
+        seconds = min(timeit.repeat(func, number=opts.number, repeat=3))
+        rate = len(urls) * opts.number / seconds
+        if baseline is None:
+            baseline = rate
+        print "%-15s %10.0f URLs/s %5.2fx" % (name, rate, rate / baseline)
+
+if __name__ == "__main__":
+    main()
@@ -18,14 +18,18 @@ def main():
     if len(args) != 1:
         parser.error("invalid number of arguments")
     action = args[0]
-    if action not in "monitor deleted check_stale purge".split(" "):
+    if action not in "monitor deleted check_stale purge daemon".split(" "):
         parser.error("invalid action: %s" % action)
 
     bot = Bot(options.config)
     if action == "monitor":
         bot.monitor()
+        bot.report_metrics()
     elif action == "purge":
         bot.purge()
+        bot.report_metrics()
+    elif action == "daemon":
+        bot.daemon()
     else:
         assert False, "not implemented yet"
 
@@ -0,0 +1,8 @@
+#!/usr/bin/env python
+"""Download a single video the way the bot does.  Named so that it doesn't
+shadow the youtube_dl package when run from this directory."""
+import rlb.youtube
+import sys
+import logging
+logging.basicConfig(level=logging.INFO)
+print rlb.youtube.download(".", sys.argv[1])
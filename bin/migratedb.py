@@ -0,0 +1,21 @@
+"""Bring the schema of an existing database up to date."""
+from sqlalchemy import create_engine
+from rlb.orm import upgrade
+
+
+def create_parser():
+    from optparse import OptionParser
+    p = OptionParser("usage: %prog db.sqlite3")
+    return p
+
+
+def main():
+    p = create_parser()
+    opts, args = p.parse_args()
+    if len(args) != 1:
+        p.error("invalid number of arguments")
+    engine = create_engine("sqlite:///"+args[0])
+    upgrade(engine)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+"""Move the videos of an existing installation into the sharded layout."""
+from sqlalchemy import create_engine, bindparam
+from sqlalchemy.orm import sessionmaker
+
+from rlb.main import Config
+from rlb.orm import Video
+from rlb.storage import VideoIndex, shard_directory
+
+#
+# The number of rows to update per statement.
+#
+BATCH_SIZE = 500
+
+
+def create_parser():
+    from optparse import OptionParser
+    p = OptionParser("usage: %prog [options]")
+    p.add_option(
+        "-c", "--config", dest="config", type="string",
+        default=None, help="Specify the configuration file to use")
+    return p
+
+
+def main():
+    p = create_parser()
+    opts, args = p.parse_args()
+    if len(args) != 0:
+        p.error("invalid number of arguments")
+    cfg = Config(opts.config)
+
+    moved = shard_directory(cfg.dest_dir)
+
+    #
+    # Point the database at wherever the files are now.  This covers files
+    # moved by an earlier, interrupted run as well.
+    #
+    index = VideoIndex(cfg.dest_dir, sharded=True)
+    videos = Video.__table__
+    stmt = videos.update()\
+        .where(videos.c.youtubeId == bindparam("youtube_id"))\
+        .where(videos.c.localPath.isnot(None))\
+        .values(localPath=bindparam("path"))
+    params = [{"youtube_id": youtube_id, "path": path}
+              for (youtube_id, path) in index.paths.items()]
+
+    engine = create_engine(cfg.dbpath)
+    Session = sessionmaker(bind=engine)
+    session = Session()
+    for i in range(0, len(params), BATCH_SIZE):
+        session.execute(stmt, params[i:i + BATCH_SIZE])
+    session.commit()
+
+    print "Moved %d videos, %d videos in the sharded layout." % (
+        moved, len(params))
+    if not cfg.shard_videos:
+        print "Remember to set shard_videos to true in the configuration."
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,293 @@
+"""Run the bot against local stand-ins for reddit, YouTube and LiveLeak, and
+measure what each of its tasks costs.
+
+The stand-ins are seeded from the test fixtures: the submissions come from
+UkrainianConflict.json and submission.json, and LiveLeak serves
+add_item.html.  A fake youtube_dl writes a file of zeros for each video.
+
+Each phase reports its wall time, the requests it made to each service,
+the number of database queries it ran, and the peak RSS of the process so
+far.  Save the results of a run as a baseline, and compare later runs
+against it to see how a change affects the bot."""
+
+import functools
+import json
+import logging
+import os.path as P
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+import yaml
+from sqlalchemy import create_engine, event, func
+
+import main
+import metrics
+import youtube
+from fakes import FakeLiveLeak, FakeReddit, FakeYoutubeApi, FakeYoutubeDL
+from orm import Base, Video
+
+logger = logging.getLogger(__name__)
+
+FIXTURE_DIR = P.join(P.dirname(P.abspath(__file__)), "test")
+
+#
+# The bot's tasks, in the order a pass of Bot.monitor and Bot.purge does
+# them.  monitor_deleted_videos includes reposting.  download_queued only
+# has work to do in deferred mode, where scan_subreddits queues the videos
+# instead of downloading them.
+#
+PHASES = ["scan_subreddits", "download_queued", "monitor_deleted_videos",
+          "make_stale", "purge"]
+
+
+class Scale(object):
+    """How much work to give the bot: subreddits with submissions each,
+    linking to videos distinct YouTube videos, deletion_rate of which have
+    been taken down."""
+
+    def __init__(self, subreddits=4, submissions=100, videos=200,
+                 deletion_rate=0.1, video_size=64 * 1024):
+        self.subreddits = subreddits
+        self.submissions = submissions
+        self.videos = videos
+        self.deletion_rate = deletion_rate
+        self.video_size = video_size
+
+    def __repr__(self):
+        return "<Scale(%s)>" % ", ".join(
+            "%s=%r" % item for item in sorted(self.to_dict().items()))
+
+    def to_dict(self):
+        return dict(self.__dict__)
+
+
+def load_templates():
+    """Return the data of the submissions in the fixtures."""
+    with open(P.join(FIXTURE_DIR, "UkrainianConflict.json")) as fin:
+        listing = json.load(fin)
+    with open(P.join(FIXTURE_DIR, "submission.json")) as fin:
+        submission = json.load(fin)
+    children = listing["data"]["children"] + submission[0]["data"]["children"]
+    return [child["data"] for child in children]
+
+
+def video_ids(scale):
+    return ["v%010d" % i for i in range(scale.videos)]
+
+
+def make_submissions(scale, now=None):
+    """Return the data of the submissions to seed the fake reddit with.
+
+    Each subreddit is named after the fixture's, and the submissions link
+    to the videos in turn, so the more submissions there are per video,
+    the more duplicates the bot has to weed out."""
+    if now is None:
+        now = time.time()
+    templates = load_templates()
+    ids = video_ids(scale)
+    prefix = templates[0]["subreddit"]
+    total = scale.subreddits * scale.submissions
+    submissions = []
+    for k in range(total):
+        template = templates[k % len(templates)]
+        subreddit = "%s%d" % (prefix, k % scale.subreddits)
+        submission_id = base36(36 ** 5 + k)
+        slug = template["permalink"].rstrip("/").rsplit("/", 1)[-1]
+        data = dict(template)
+        data.update({
+            "id": submission_id,
+            "name": "t3_" + submission_id,
+            "subreddit": subreddit,
+            "url": "https://www.youtube.com/watch?v=%s" % ids[k % len(ids)],
+            "permalink": "/r/%s/comments/%s/%s/" % (subreddit, submission_id,
+                                                    slug),
+            "created_utc": now - total + k
+        })
+        submissions.append(data)
+    return submissions
+
+
+def base36(number):
+    digits = "0123456789abcdefghijklmnopqrstuvwxyz"
+    result = ""
+    while number:
+        number, digit = divmod(number, 36)
+        result = digits[digit] + result
+    return result or "0"
+
+
+def peak_rss_kb():
+    """The peak resident set size of this process so far.  Linux reports
+    it in kilobytes, OS X in bytes."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak // 1024 if sys.platform == "darwin" else peak
+
+
+class Benchmark(object):
+    """Sets up the stand-ins and a bot that talks to them, and runs the
+    phases.  Each service adds latency seconds to every request.  If
+    deferred is True, the bot runs in deferred mode."""
+
+    def __init__(self, scale, latency=0.0, deferred=False):
+        self.scale = scale
+        self.latency = latency
+        self.deferred = deferred
+        self.queries = 0
+
+    def setup(self):
+        scale = self.scale
+        self.work_dir = tempfile.mkdtemp(prefix="rlb-benchmark-")
+        ids = video_ids(scale)
+        deleted = int(round(scale.videos * scale.deletion_rate))
+        self.reddit = FakeReddit(self.latency)
+        for data in make_submissions(scale):
+            self.reddit.add_submission(data)
+        self.youtube = FakeYoutubeApi(ids[deleted:], self.latency).start()
+        with open(P.join(FIXTURE_DIR, "add_item.html")) as fin:
+            self.liveleak = FakeLiveLeak(fin.read(), self.latency).start()
+
+        db_path = P.join(self.work_dir, "db.sqlite3")
+        Base.metadata.create_all(create_engine("sqlite:///" + db_path))
+        config_path = P.join(self.work_dir, "config.yml")
+        with open(config_path, "w") as fout:
+            yaml.safe_dump(self.config(db_path), fout,
+                           default_flow_style=False)
+
+        self.bot = main.Bot(config_path, reddit=self.reddit)
+        self.bot.downloader = youtube.DownloadEngine(
+            factory=functools.partial(FakeYoutubeDL, size=scale.video_size))
+        event.listen(self.bot.db.get_bind(), "before_cursor_execute",
+                     self._count_query)
+
+    def config(self, db_path):
+        subreddits = set(s.subreddit.display_name
+                         for s in self.reddit.submissions.values())
+        return {
+            "user_agent": "benchmark",
+            "dbpath": "sqlite:///" + db_path,
+            "videopath": P.join(self.work_dir, "videos"),
+            "liveleak": {"username": "benchmark", "password": "benchmark",
+                         "base_url": self.liveleak.base_url,
+                         "s3_url": self.liveleak.s3_url},
+            "reddit": {"username": "benchmark", "password": "benchmark"},
+            "hold_hours": 0,
+            #
+            # Enough to download every queued video in a single pass.
+            #
+            "deferred": {"enabled": self.deferred,
+                         "downloads_per_pass": self.scale.videos},
+            "subreddits": dict((name, {"liveleak_category": "Ukraine"})
+                               for name in subreddits),
+            #
+            # Enough to see every submission in a single pass.
+            #
+            "limit": self.scale.subreddits * self.scale.submissions,
+            "google_developer_key": "benchmark",
+            "youtube": {"api_url": self.youtube.url,
+                        "requests_per_second": 1000}
+        }
+
+    def teardown(self):
+        self.youtube.stop()
+        self.liveleak.stop()
+        self.bot.db.close()
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+    def _count_query(self, *args):
+        self.queries += 1
+
+    def counts(self):
+        downloads = metrics.REGISTRY.snapshot()["operations"].get(
+            "youtube.download", {}).get("count", 0)
+        return {"reddit": self.reddit.requests,
+                "youtube": self.youtube.requests,
+                "liveleak": self.liveleak.requests,
+                "youtube-dl": downloads,
+                "queries": self.queries}
+
+    def run(self):
+        """Run the phases and return the results."""
+        results = {"scale": self.scale.to_dict(), "latency": self.latency,
+                   "deferred": self.deferred, "phases": {}}
+        self.setup()
+        try:
+            for phase in PHASES:
+                results["phases"][phase] = self.run_phase(phase)
+            results["reposted"] = len(self.liveleak.items)
+            results["videos_by_state"] = dict(
+                (str(state), count) for (state, count) in self.bot.db.query(
+                    Video.state, func.count()).group_by(Video.state))
+        finally:
+            self.teardown()
+        return results
+
+    def run_phase(self, phase):
+        meth_name = "run_phase"
+        before = self.counts()
+        start = time.time()
+        getattr(self.bot, phase)()
+        seconds = time.time() - start
+        after = self.counts()
+        queries = after.pop("queries") - before.pop("queries")
+        requests = dict((name, after[name] - before[name])
+                        for name in after)
+        logger.info("%s: %s: %.2fs", meth_name, phase, seconds)
+        return {"seconds": seconds,
+                "requests": requests,
+                "total_requests": sum(requests.values()),
+                "queries": queries,
+                "peak_rss_kb": peak_rss_kb()}
+
+
+#
+# What compare checks in each phase.  Counts don't depend on the machine,
+# so any increase is a regression.  Times and memory get some slack: a
+# share of the baseline, but at least the amount here, so that the
+# phases that take next to no time don't trip it.
+#
+EXACT = ["total_requests", "queries"]
+TOLERANT = {"seconds": 0.1, "peak_rss_kb": 1024}
+
+
+def compare(results, baseline, tolerance=0.25):
+    """Return a list of the ways results are worse than baseline, e.g. a
+    phase that takes more than tolerance longer.  Raises ValueError if the
+    two weren't run at the same scale."""
+    if (results["scale"] != baseline["scale"] or
+            results["latency"] != baseline["latency"] or
+            results.get("deferred") != baseline.get("deferred")):
+        raise ValueError("the baseline was run at a different scale")
+    regressions = []
+    for phase in PHASES:
+        new = results["phases"].get(phase)
+        old = baseline["phases"].get(phase)
+        if new is None or old is None:
+            continue
+        for key in EXACT + sorted(TOLERANT):
+            limit = old[key]
+            if key in TOLERANT:
+                limit += max(old[key] * tolerance, TOLERANT[key])
+            if new[key] > limit:
+                regressions.append("%s: %s went from %s to %s" % (
+                    phase, key, old[key], new[key]))
+    if results.get("reposted") != baseline.get("reposted"):
+        regressions.append("reposted %s videos instead of %s" % (
+            results.get("reposted"), baseline.get("reposted")))
+    return regressions
+
+
+def format_results(results):
+    lines = ["%-24s %9s %9s %9s %11s" % ("phase", "seconds", "requests",
+                                         "queries", "peak RSS KB")]
+    for phase in PHASES:
+        r = results["phases"].get(phase)
+        if r is None:
+            continue
+        lines.append("%-24s %9.2f %9d %9d %11d" % (
+            phase, r["seconds"], r["total_requests"], r["queries"],
+            r["peak_rss_kb"]))
+    lines.append("reposted %d videos" % results["reposted"])
+    return "\n".join(lines)
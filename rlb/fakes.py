@@ -0,0 +1,451 @@
+"""Local stand-ins for the web services the bot talks to.
+
+They run an HTTP server on a random port of the local machine, so tests
+and benchmarks can exercise the real HTTP code without the network."""
+
+import hashlib
+import json
+import re
+import threading
+import time
+import urlparse
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class FakeServer(object):
+    """Base class for the fakes.  Subclasses implement handle, which gets
+    the request handler and returns (status_code, content_type, body).
+    To send more headers, handle can set extra_headers on the request
+    handler to a list of (name, value) pairs."""
+
+    def __init__(self, latency=0):
+        self.latency = latency
+        self.requests = 0
+        self.lock = threading.Lock()
+        self.server = None
+
+    def start(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                fake._dispatch(self)
+
+            def do_POST(self):
+                fake._dispatch(self)
+
+            def do_PUT(self):
+                fake._dispatch(self)
+
+            def do_DELETE(self):
+                fake._dispatch(self)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        #
+        # Poll often, so that stop doesn't keep the tests waiting.
+        #
+        thread = threading.Thread(target=self.server.serve_forever,
+                                  args=(0.01,))
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    @property
+    def base_url(self):
+        return "http://127.0.0.1:%d" % self.server.server_address[1]
+
+    def _dispatch(self, handler):
+        with self.lock:
+            self.requests += 1
+        if self.latency:
+            time.sleep(self.latency)
+        status_code, content_type, body = self.handle(handler)
+        handler.send_response(status_code)
+        handler.send_header("Content-Type", content_type)
+        handler.send_header("Content-Length", str(len(body)))
+        for name, value in getattr(handler, "extra_headers", []):
+            handler.send_header(name, value)
+        handler.end_headers()
+        handler.wfile.write(body)
+
+    def handle(self, handler):
+        raise NotImplementedError
+
+
+class FakeYoutubeApi(FakeServer):
+    """Stands in for the videos endpoint of the YouTube Data API.
+
+    Videos in alive exist, all others don't.  The first failures requests
+    get a 503 response.  When asked for their snippet and contentDetails,
+    the videos are on the channel that channels maps them to, or on
+    UCfake, and have the given published time and duration."""
+
+    def __init__(self, alive=(), latency=0, failures=0, channels=None,
+                 published="2014-07-16T12:00:00.000Z", duration="PT1M"):
+        FakeServer.__init__(self, latency)
+        self.alive = set(alive)
+        self.failures = failures
+        self.channels = channels or {}
+        self.published = published
+        self.duration = duration
+
+    @property
+    def url(self):
+        return self.base_url + "/youtube/v3/videos"
+
+    def handle(self, handler):
+        with self.lock:
+            if self.failures > 0:
+                self.failures -= 1
+                return 503, "text/plain", "backend error"
+        query = urlparse.parse_qs(urlparse.urlparse(handler.path).query)
+        ids = query.get("id", [""])[0].split(",")
+        parts = query.get("part", ["id"])[0].split(",")
+        items = [{"kind": "youtube#video", "id": i}
+                 for i in ids if i in self.alive]
+        for item in items:
+            if "snippet" in parts:
+                item["snippet"] = {
+                    "channelId": self.channels.get(item["id"], "UCfake"),
+                    "publishedAt": self.published}
+            if "contentDetails" in parts:
+                item["contentDetails"] = {"duration": self.duration}
+        body = json.dumps({"kind": "youtube#videoListResponse",
+                           "pageInfo": {"totalResults": len(items),
+                                        "resultsPerPage": len(items)},
+                           "items": items})
+        return 200, "application/json", body
+
+
+def read_body(handler):
+    length = int(handler.headers.getheader("Content-Length") or 0)
+    return handler.rfile.read(length)
+
+
+class FakeS3(FakeServer):
+    """Stands in for the multipart upload API of S3.
+
+    The first failures part uploads get a 500 response.  Completed uploads
+    end up in objects, keyed by object key."""
+
+    def __init__(self, latency=0, failures=0):
+        FakeServer.__init__(self, latency)
+        self.failures = failures
+        self.uploads = {}
+        self.objects = {}
+        self.part_requests = 0
+
+    def handle(self, handler):
+        url = urlparse.urlparse(handler.path)
+        key = urlparse.unquote(url.path.lstrip("/"))
+        query = urlparse.parse_qs(url.query, keep_blank_values=True)
+        upload_id = query.get("uploadId", [None])[0]
+        body = read_body(handler)
+        with self.lock:
+            if handler.command == "POST" and "uploads" in query:
+                upload_id = "upload%d" % (len(self.uploads) + 1)
+                self.uploads[upload_id] = {}
+                return 200, "application/xml", (
+                    "<InitiateMultipartUploadResult><Key>%s</Key>"
+                    "<UploadId>%s</UploadId>"
+                    "</InitiateMultipartUploadResult>" % (key, upload_id))
+            if upload_id not in self.uploads:
+                return 404, "application/xml", (
+                    "<Error><Code>NoSuchUpload</Code></Error>")
+            parts = self.uploads[upload_id]
+            if handler.command == "PUT":
+                self.part_requests += 1
+                if self.failures > 0:
+                    self.failures -= 1
+                    return 500, "text/plain", "internal error"
+                etag = '"%s"' % hashlib.md5(body).hexdigest()
+                parts[int(query["partNumber"][0])] = (etag, body)
+                handler.extra_headers = [("ETag", etag)]
+                return 200, "text/plain", ""
+            elif handler.command == "GET":
+                listing = "".join(
+                    "<Part><PartNumber>%d</PartNumber><ETag>%s</ETag>"
+                    "<Size>%d</Size></Part>" % (n, etag, len(data))
+                    for (n, (etag, data)) in sorted(parts.items()))
+                return 200, "application/xml", (
+                    "<ListPartsResult><IsTruncated>false</IsTruncated>%s"
+                    "</ListPartsResult>" % listing)
+            elif handler.command == "DELETE":
+                del self.uploads[upload_id]
+                return 204, "text/plain", ""
+            else:
+                numbers = [int(n) for n in re.findall(
+                    "<PartNumber>(\\d+)</PartNumber>", body)]
+                if numbers != sorted(parts) or numbers != range(
+                        1, len(numbers) + 1):
+                    return 400, "application/xml", (
+                        "<Error><Code>InvalidPart</Code></Error>")
+                self.objects[key] = "".join(parts[n][1] for n in numbers)
+                del self.uploads[upload_id]
+                return 200, "application/xml", (
+                    "<CompleteMultipartUploadResult><Location>%s/%s"
+                    "</Location><Bucket>fake</Bucket><Key>%s</Key>"
+                    "<ETag>etag</ETag></CompleteMultipartUploadResult>" % (
+                        self.base_url, key, key))
+
+
+class FakeLiveLeak(FakeServer):
+    """Stands in for the parts of LiveLeak the uploader uses, and for the
+    S3 bucket that the add_item form uploads to (at s3_url).
+
+    Serves add_item_html, e.g. the add_item.html fixture, as the add_item
+    form, with a new connection for every request.  Published items end up
+    in items, keyed by item token."""
+
+    #
+    # The connection in the add_item.html fixture.
+    #
+    FIXTURE_CONNECTION = "2f3_1405564338"
+
+    LOGIN_COOKIES = ["PHPSESSID", "liveleak_safe_mode",
+                     "liveleak_use_old_player", "liveleak_user_password",
+                     "liveleak_user_token", "user-agent"]
+
+    def __init__(self, add_item_html, latency=0):
+        FakeServer.__init__(self, latency)
+        self.add_item_html = add_item_html
+        self.connections = 0
+        self.files = {}
+        self.items = {}
+        self.bytes_received = 0
+
+    @property
+    def s3_url(self):
+        return self.base_url + "/s3/"
+
+    def handle(self, handler):
+        url = urlparse.urlparse(handler.path)
+        query = urlparse.parse_qs(url.query)
+        action = query.get("a", [None])[0]
+        body = read_body(handler)
+        if url.path == "/index.php":
+            handler.extra_headers = [("Set-Cookie", "%s=fake; path=/" % name)
+                                     for name in self.LOGIN_COOKIES]
+            return 200, "text/html", "<html></html>"
+        elif url.path == "/s3/":
+            with self.lock:
+                self.bytes_received += len(body)
+            match = re.search(r'name="key"\r\n\r\n([^\r]*)\r\n', body)
+            if match is None:
+                return 400, "application/xml", (
+                    "<Error><Code>InvalidArgument</Code></Error>")
+            key = match.group(1)
+            return 201, "application/xml", (
+                "<PostResponse><Location>%s%s</Location><Bucket>fake"
+                "</Bucket><Key>%s</Key><ETag>\"%s\"</ETag></PostResponse>" % (
+                    self.s3_url, key, key, hashlib.md5(body).hexdigest()))
+        elif url.path == "/item" and action == "add_item":
+            if handler.command == "GET":
+                with self.lock:
+                    self.connections += 1
+                    connection = "%x_%d" % (self.connections, 1405564338)
+                return 200, "text/html", self.add_item_html.replace(
+                    self.FIXTURE_CONNECTION, connection)
+            form = urlparse.parse_qs(body)
+            with self.lock:
+                token = "item%d" % (len(self.items) + 1)
+                self.items[token] = form.get("connection", [None])[0]
+            return 200, "application/json", json.dumps(
+                {"success": 1, "item_token": token})
+        elif url.path == "/file" and action == "add_file":
+            with self.lock:
+                token = "file%d" % (len(self.files) + 1)
+                self.files[token] = query.get("s3_key", [None])[0]
+            return 200, "application/json", json.dumps(
+                {"success": 1, "file_token": token})
+        elif url.path == "/file" and action == "delete_file":
+            with self.lock:
+                self.files.pop(query.get("file_token", [None])[0], None)
+            return 200, "application/json", json.dumps({"success": 1})
+        return 404, "text/plain", "not found"
+
+
+class FakeReddit(object):
+    """Stands in for a logged-in praw.Reddit, in-process.
+
+    PRAW talks to www.reddit.com and can't be pointed at a local server,
+    so this fakes the few calls the bot makes at the PRAW boundary.  Each
+    call (or page of a listing) counts as a request and takes latency
+    seconds.  Add submissions with add_submission, passing the data of a
+    submission as it comes in a reddit listing."""
+
+    #
+    # The number of items reddit sends per page of a listing.
+    #
+    PAGE_SIZE = 100
+
+    def __init__(self, latency=0):
+        self.latency = latency
+        self.requests = 0
+        self.lock = threading.Lock()
+        self.submissions = {}
+        self.comments = []
+        self.user = FakeRedditUser(self)
+
+    def request(self):
+        with self.lock:
+            self.requests += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def login(self, username, password):
+        self.request()
+
+    def add_submission(self, data):
+        submission = FakeSubmission(self, data)
+        self.submissions[submission.id] = submission
+        return submission
+
+    def get_subreddit(self, name):
+        return FakeSubreddit(self, name)
+
+    def get_info(self, thing_id):
+        self.request()
+        return self.submissions.get(thing_id.split("_", 1)[-1])
+
+    def get_submission(self, url):
+        self.request()
+        match = re.search(r"/comments/([a-z0-9]+)", url)
+        return self.submissions[match.group(1)]
+
+    def paginate(self, items, limit):
+        """Yield the items a page at a time, the way PRAW does."""
+        self.request()
+        for i, item in enumerate(items[:limit]):
+            if i and i % self.PAGE_SIZE == 0:
+                self.request()
+            yield item
+
+
+class FakeSubreddit(object):
+
+    def __init__(self, reddit, display_name):
+        self.reddit = reddit
+        self.display_name = display_name
+
+    def get_new(self, limit=25, params=None):
+        """Yield the newest submissions, newest first.  Like reddit, with
+        a before fullname in params, yield the limit submissions that
+        came just after it, or nothing if it's no longer there."""
+        names = set(n.lower() for n in self.display_name.split("+"))
+        submissions = sorted(
+            (s for s in self.reddit.submissions.values()
+             if s.subreddit.display_name.lower() in names),
+            key=lambda s: s.created_utc, reverse=True)
+        before = (params or {}).get("before")
+        if before:
+            cursor = self.reddit.submissions.get(before.split("_", 1)[-1])
+            if cursor is None:
+                submissions = []
+            else:
+                submissions = [s for s in submissions
+                               if s.created_utc > cursor.created_utc]
+                submissions = submissions[-limit:]
+        return self.reddit.paginate(submissions, limit)
+
+
+class FakeSubmission(object):
+
+    def __init__(self, reddit, data):
+        self.reddit = reddit
+        self.id = data["id"]
+        self.fullname = data["name"]
+        self.title = data["title"]
+        self.url = data["url"]
+        self.permalink = urlparse.urljoin("http://www.reddit.com",
+                                          data["permalink"])
+        self.created_utc = data["created_utc"]
+        self.score = data.get("score", 0)
+        self.author = data.get("author")
+        self.subreddit = FakeSubreddit(reddit, data["subreddit"])
+
+    def __repr__(self):
+        return "<FakeSubmission(id=%s)>" % repr(self.id)
+
+    def add_comment(self, text):
+        self.reddit.request()
+        with self.reddit.lock:
+            comment = FakeComment("c%d" % (len(self.reddit.comments) + 1),
+                                  self.fullname, text)
+            self.reddit.comments.append(comment)
+        return comment
+
+
+class FakeComment(object):
+
+    def __init__(self, id, link_id, body):
+        self.id = id
+        self.link_id = link_id
+        self.body = body
+
+
+class FakeRedditUser(object):
+
+    def __init__(self, reddit):
+        self.reddit = reddit
+
+    def get_comments(self, limit=25):
+        """Yield our comments, newest first."""
+        with self.reddit.lock:
+            comments = list(reversed(self.reddit.comments))
+        return self.reddit.paginate(comments, limit)
+
+
+class FakeYoutubeDL(object):
+    """Stands in for youtube_dl.YoutubeDL.  Every video is duration seconds
+    long, 720p and size bytes; downloading one writes size zeros to the
+    file the output template names.  The videos in unavailable fail to
+    download."""
+
+    def __init__(self, params, size=64 * 1024, duration=60,
+                 unavailable=()):
+        self.params = dict(params)
+        self.size = size
+        self.duration = duration
+        self.unavailable = set(unavailable)
+        self.hooks = []
+        self.extractions = 0
+
+    def add_progress_hook(self, hook):
+        self.hooks.append(hook)
+
+    def prepare_filename(self, info):
+        return self.params["outtmpl"] % info
+
+    def extract_info(self, url, download=True):
+        from youtube_dl.utils import DownloadError
+        self.extractions += 1
+        if url in self.unavailable:
+            raise DownloadError("ERROR: %s: video unavailable" % url)
+        info = {"id": url, "ext": "mp4", "title": url, "height": 720,
+                "duration": self.duration, "filesize": self.size}
+        return self.process_ie_result(info, download)
+
+    def process_ie_result(self, info, download=True):
+        if download:
+            filename = self.prepare_filename(info)
+            with open(filename, "wb") as fout:
+                fout.write("\0" * self.size)
+            for hook in self.hooks:
+                hook({"status": "finished", "filename": filename,
+                      "downloaded_bytes": self.size,
+                      "total_bytes": self.size})
+        return info
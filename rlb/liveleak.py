@@ -1,21 +1,26 @@
 """Upload a video to liveleak."""
 
-import requests
 import re
 import os.path as P
 import time
+import base64
+import calendar
 import xml.etree.ElementTree as ET
 import urllib
+import urlparse
 import json
 import logging
+import threading
 
 logger = logging.getLogger(__file__)
 logger.setLevel(logging.INFO)
 
-from StringIO import StringIO
-from lxml import etree
 from requests_toolbelt import MultipartEncoder
 
+import metrics
+import net
+import s3
+
 CATEGORIES = {
     "World News": 2, "Ukraine": 37, "Regional News": 3, "Other News": 4,
     "Politics": 5, "Syria": 33, "Afghanistan": 8, "Iraq": 7, "Iran": 9,
@@ -28,60 +33,220 @@ CATEGORIES = {
     "History": 32, "Other": 18
 }
 
+#
+# Where LiveLeak and its S3 bucket live.  Point them elsewhere to run
+# against a local stand-in (see fakes.FakeLiveLeak).
+#
+BASE_URL = "http://www.liveleak.com"
+S3_URL = "https://llbucs.s3.amazonaws.com/"
+
+#
+# How far ahead of the upload rate limit an upload may get, in bytes.
+#
+UPLOAD_BURST = 64 * 1024
+
+#
+# The fields of the add_item form that go into the POST to S3.
+#
+MULTIPART_PARAMS = ["key", "Filename", "acl", "Expires", "Content-Type",
+                    "success_action_status", "AWSAccessKeyId", "policy",
+                    "signature"]
+
+#
+# Picks out everything we need from the add_item page in a single pass:
+# the multipart_params object in the uploader's JavaScript, the
+# connect_string in its add_file URL, and the hidden connection input:
+#
+#   multipart_params: {
+#       'key': '2014/Jul/16/LiveLeak-dot-com-2f3_1405564338-${filename}',
+#       ...
+#   },
+#   $.getJSON('file?a=add_file&ajax=1&connect_string=e%2FZ9...&s3_key=...
+#   <input id="connection" name="connection" value="2f3_1405564338"
+#    type="hidden"/>
+#
+# The lookahead lets the scan skip quickly over the characters none of the
+# alternatives can start with.
+#
+ADD_ITEM_FORM = re.compile(r"""(?=[mc<])(?:
+    multipart_params:\s*\{(?P<params>[\s\S]*?)\n\s*\},
+  | connect_string=(?P<connect_string>[^&]+)
+  | (?P<input><input\b[^>]*\bid=["']connection["'][^>]*>))
+""", re.VERBOSE)
+MULTIPART_PARAM = re.compile(
+    "'(?P<key>%s)' *: *'(?P<value>[^']+)'" % "|".join(MULTIPART_PARAMS))
+INPUT_VALUE = re.compile(r"""\bvalue=["'](?P<value>[^"']*)["']""")
+
+#
+# Don't start an upload with a form whose policy expires sooner than this
+# (in seconds).
+#
+FORM_EXPIRY_MARGIN = 15 * 60
+
 
 class LiveLeakException(Exception):
     pass
 
 
+class FileNotAttached(LiveLeakException):
+    """The upload failed before the file got attached to the connection of
+    the add_item form, so the form can be used for another upload."""
+    pass
+
+
 class Uploader(object):
-    def __init__(self, user_agent):
-        self.cookies = None
+    def __init__(self, user_agent, session=None, s3_endpoint=None,
+                 part_size=s3.PART_SIZE, rate_limit=0, clock=time.time,
+                 base_url=BASE_URL, s3_url=S3_URL):
+        """Pass a session from net.create_session to share its connection
+        pool with other clients.
+
+        By default, a video is uploaded in a single POST, the way the
+        add_item form does it.  If s3_endpoint is set, videos are uploaded
+        to it in parts of part_size bytes instead, which can be resumed
+        if they get interrupted.
+
+        rate_limit caps the total upload bandwidth in bytes per second,
+        shared by all the uploads in progress.  Zero means unlimited.
+
+        base_url and s3_url are where to find LiveLeak and the bucket that
+        the add_item form uploads to."""
         self.user_agent = user_agent
+        self.base_url = base_url.rstrip("/")
+        self.s3_url = s3_url
+        if session is None:
+            session = net.create_session(user_agent)
+        self.session = session
+        self.s3_endpoint = s3_endpoint
+        self.part_size = part_size
+        self.limiter = None
+        if rate_limit:
+            self.limiter = net.RateLimiter(rate_limit, UPLOAD_BURST)
+        #
+        # Totals over all uploads, for working out our throughput.
+        #
+        self.lock = threading.Lock()
+        self.bytes_uploaded = 0
+        self.upload_seconds = 0.0
+        #
+        # Forms we've fetched but not used up, because the upload failed
+        # before the file got attached to the form's connection.  This
+        # isn't a cache: a form belongs to a single item, so every
+        # successful upload still fetches a form of its own.
+        #
+        self.clock = clock
+        self.spare_forms = []
 
+    @metrics.timed("liveleak.login")
     def login(self, username, password):
+        """Log in to LiveLeak.  The session keeps the login cookies for the
+        requests that follow."""
         meth_name = "login"
         data = {"user_name": username, "user_password": password, "login": 1}
-        r = requests.post(
-            "http://www.liveleak.com/index.php",
-            data=data, headers={"User-Agent": self.user_agent})
+        r = self.session.post(self.base_url + "/index.php", data=data)
         if r.status_code != 200:
             raise LiveLeakException("bad HTTP response (%d)" % r.status_code)
 
         keys = ["PHPSESSID", "liveleak_safe_mode", "liveleak_use_old_player",
                 "liveleak_user_password", "liveleak_user_token", "user-agent"]
-
-        self.cookies = {}
         for key in keys:
-            self.cookies[key] = r.cookies[key]
+            if key not in r.cookies:
+                raise LiveLeakException("missing login cookie: %s" % key)
 
-        logger.debug("%s: cookies: %s", meth_name, self.cookies)
+        logger.debug("%s: cookies: %s", meth_name, self.session.cookies)
 
-    def upload(self, path):
+    @metrics.timed("liveleak.upload")
+    def upload(self, path, resume=None, on_progress=None):
+        """Upload a video.  Returns a (file_token, connection) tuple.
+
+        With multipart uploads, on_progress(state) gets called when the
+        upload starts and after each part.  Save the state, and pass it
+        as resume to pick up an interrupted upload where it stopped."""
         meth_name = "upload"
-        r = requests.get(
-            "http://www.liveleak.com/item?a=add_item",
-            cookies=self.cookies, headers={"User-Agent": self.user_agent})
+        progress = net.UploadProgress(self.limiter)
+        try:
+            return self.__upload(path, resume, on_progress, progress)
+        finally:
+            progress.finish()
+            logger.info("%s: %s: sent %d bytes in %.1fs (%.0f bytes/s)",
+                        meth_name, path, progress.bytes_sent,
+                        progress.elapsed, progress.throughput)
+            with self.lock:
+                self.bytes_uploaded += progress.bytes_sent
+                self.upload_seconds += progress.elapsed
+            metrics.count("liveleak.upload_bytes", progress.bytes_sent)
+
+    def __upload(self, path, resume, on_progress, progress):
+        meth_name = "__upload"
+        if resume is not None:
+            try:
+                return (self.__multipart_upload(path, resume, on_progress,
+                                                progress),
+                        resume["connection"])
+            except s3.NoSuchUpload:
+                logger.info("%s: can't resume %s, starting over",
+                            meth_name, resume["upload_id"])
+
+        form = self.__take_form()
+        if self.s3_endpoint:
+            filename = upload_filename(path)
+            state = {
+                "key": form.multipart_params["key"].replace("${filename}",
+                                                            filename),
+                "filename": filename,
+                "connect_string": form.connect_string,
+                "connection": form.connection,
+                "upload_id": None
+            }
+            #
+            # The state of a multipart upload gets saved for resuming, and
+            # that holds on to the form, so it can't go back to the spares.
+            #
+            file_token = self.__multipart_upload(path, state, on_progress,
+                                                 progress)
+        else:
+            try:
+                file_token = self.__aws_upload(
+                    path, dict(form.multipart_params), form.connect_string,
+                    progress)
+            except FileNotAttached:
+                logger.info("%s: keeping form %s for the next upload",
+                            meth_name, form.connection)
+                with self.lock:
+                    self.spare_forms.append(form)
+                raise
+        return file_token, form.connection
+
+    def __take_form(self):
+        """Return an add_item form that's good for an upload: one we have
+        left over, if it hasn't expired, or a new one.
+
+        Only a failed upload leaves a form over, so back-to-back reposts
+        each fetch and parse the add_item page.  Fetching one ahead of time
+        would open a LiveLeak item that may never get used."""
+        meth_name = "__take_form"
+        deadline = self.clock() + FORM_EXPIRY_MARGIN
+        with self.lock:
+            while self.spare_forms:
+                form = self.spare_forms.pop()
+                if form.expiration > deadline:
+                    logger.debug("%s: reusing %s", meth_name, form.connection)
+                    return form
+
+        with metrics.timer("liveleak.add_item"):
+            r = self.session.get(self.base_url + "/item?a=add_item")
         logger.debug(
             "%s: add_item GET status_code: %d", meth_name, r.status_code)
         if r.status_code != 200:
             raise LiveLeakException("bad HTTP response (%d)" % r.status_code)
 
-        multipart_params = extract_multipart_params(r.text)
-        logger.debug(
-            "%s: multipart_params: %s", meth_name, repr(multipart_params))
-        if multipart_params is None:
+        form = parse_add_item(r.text)
+        logger.debug("%s: form: %s", meth_name, repr(form))
+        if form is None:
             raise LiveLeakException("unable to parse upload form")
+        return form
 
-        connection = extract_connection(r.text)
-        logger.debug("%s: connection: %s", meth_name, connection)
-
-        connect_string = re.search("connect_string=(?P<connect_string>[^&]+)",
-                                   r.text).group("connect_string")
-        logger.debug("%s: connect_string: %s", meth_name, repr(connect_string))
-
-        file_token = self.__aws_upload(path, multipart_params, connect_string)
-        return file_token, connection
-
+    @metrics.timed("liveleak.publish")
     def publish(self, title, body, tags, category, connection):
         meth_name = "publish"
         data = {
@@ -102,10 +267,8 @@ class Uploader(object):
             "connection": connection
         }
 
-        r = requests.post(
-            "http://www.liveleak.com/item?a=add_item&ajax=1",
-            data=data, cookies=self.cookies,
-            headers={"User-Agent": self.user_agent})
+        r = self.session.post(
+            self.base_url + "/item?a=add_item&ajax=1", data=data)
         logger.debug(
             "%s: add_item POST status_code: %d", meth_name, r.status_code)
         logger.debug("%s: add_item POST response: %s", meth_name, repr(r.text))
@@ -118,70 +281,37 @@ class Uploader(object):
 
     def delete(self, file_token):
         meth_name = "delete"
-        r = requests.get(
-            "http://www.liveleak.com/file",
-            params={"a": "delete_file", "file_token": file_token},
-            cookies=self.cookies, headers={"User-Agent": self.user_agent})
+        r = self.session.get(
+            self.base_url + "/file",
+            params={"a": "delete_file", "file_token": file_token})
         logger.debug("%s: GET status_code: %d", meth_name, r.status_code)
         # logger.debug("%s: GET response: %s", meth_name, repr(r.text))
 
-    def __aws_upload(self, path, multipart_params, connect_string):
+    def __aws_upload(self, path, multipart_params, connect_string,
+                     progress):
         """Upload a file to AWS.
         Raises Exception on failure.
         Returns a file_token in case of successs."""
         meth_name = "__aws_upload"
-        #
-        # Mangle the filename (add timestamp, remove special characters).
-        # This is similar to what the JS in the add_item form does.
-        # It isn't exactly the same, but it's good enough.
-        #
-        filename = P.basename(path)
-        fixed_file_name_part, extension = P.splitext(filename)
-        fixed_file_name_part = "".join(
-            [ch for ch in fixed_file_name_part if ch.isalnum()])
-        timestamp = time.time()
-        #
-        # Filename must be a raw Python string (not unicode)
-        #
-        filename = str(fixed_file_name_part + "_" + str(timestamp) + extension)
+        filename = upload_filename(path)
         multipart_params["name"] = filename
         multipart_params["key"] = multipart_params["key"].replace(
             "${filename}", filename)
 
         #
-        # Fields must be in the right order.
-        #
-        fields = ["name", "key", "Filename", "acl", "Expires",
-                  "Content-Type", "success_action_status", "AWSAccessKeyId",
-                  "policy", "signature"]
-        fields = [(name, multipart_params[name]) for name in fields]
-        fields.append(("file", ("filename", open(path, "rb"), "video/mp4")))
-        logger.debug("%s: fields: %s", meth_name, str(fields))
-
-        #
-        # http://toolbelt.readthedocs.org/en/latest/user.html#uploading-data
+        # Until we've told LiveLeak about the file, nothing is attached to
+        # the form's connection, and the form can be used again.
         #
-        m = MultipartEncoder(fields=fields)
-
-        headers = {
-            "Origin": "http://www.liveleak.com",
-            "Accept-Encoding": "gzip,deflate,sdch",
-            "Host": "llbucs.s3.amazonaws.com",
-            "Accept-Language": "en-US,en;q=0.8,ja;q=0.6,ru;q=0.4",
-            "User-Agent": self.user_agent,
-            "Content-Type": m.content_type,
-            "Accept": "*/*",
-            "Referer": "http://www.liveleak.com/item?a=add_item",
-            "Connection": "keep-alive"
-        }
-
-        r = requests.post(
-            "https://llbucs.s3.amazonaws.com/",
-            cookies=self.cookies, headers=headers, data=m)
+        try:
+            r = self.__aws_post(path, multipart_params, progress)
+        except Exception as ex:
+            raise FileNotAttached(str(ex))
         logger.debug("%s: POST status_code: %d", meth_name, r.status_code)
         logger.debug("%s: add_item POST response: %s", meth_name, repr(r.text))
 
-        assert r.status_code == 201, "couldn't upload to AWS"
+        if r.status_code != 201:
+            raise FileNotAttached("couldn't upload to AWS (%d)" %
+                                  r.status_code)
 
         root = ET.fromstring(r.text)
         amazon_response = {}
@@ -191,21 +321,84 @@ class Uploader(object):
         logger.debug(
             "%s: amazon_response: %s", meth_name, repr(amazon_response))
 
+        return self.__add_file(connect_string, amazon_response["Key"],
+                               filename, r.text)
+
+    def __aws_post(self, path, multipart_params, progress):
+        meth_name = "__aws_post"
+        #
+        # Fields must be in the right order.
+        #
+        fields = ["name", "key", "Filename", "acl", "Expires",
+                  "Content-Type", "success_action_status", "AWSAccessKeyId",
+                  "policy", "signature"]
+        fields = [(name, multipart_params[name]) for name in fields]
+        logger.debug("%s: fields: %s", meth_name, str(fields))
+
+        with open(path, "rb") as fin:
+            fields.append(("file", ("filename", fin, "video/mp4")))
+            #
+            # http://toolbelt.readthedocs.org/en/latest/user.html#uploading-data
+            #
+            m = progress.monitor(MultipartEncoder(fields=fields))
+
+            headers = {
+                "Origin": self.base_url,
+                "Accept-Encoding": "gzip,deflate,sdch",
+                "Host": urlparse.urlparse(self.s3_url).netloc,
+                "Accept-Language": "en-US,en;q=0.8,ja;q=0.6,ru;q=0.4",
+                "User-Agent": self.user_agent,
+                "Content-Type": m.content_type,
+                "Accept": "*/*",
+                "Referer": self.base_url + "/item?a=add_item",
+                "Connection": "keep-alive"
+            }
+
+            with metrics.timer("s3.post"):
+                return self.session.post(
+                    self.s3_url, headers=headers, data=m)
+
+    def __multipart_upload(self, path, state, on_progress, progress):
+        """Upload a file to the S3 endpoint in parts.
+        Raises Exception on failure.
+        Returns a file_token in case of success."""
+        upload = s3.MultipartUpload(
+            self.session, "%s/%s" % (self.s3_endpoint.rstrip("/"),
+                                     urllib.quote(state["key"])),
+            state["upload_id"], self.part_size)
+        if upload.upload_id is None:
+            state["upload_id"] = upload.start()
+            if on_progress:
+                on_progress(dict(state))
+
+        def on_part(part_number, part_count):
+            state["parts_done"] = part_number
+            state["parts"] = part_count
+            if on_progress:
+                on_progress(dict(state))
+
+        response = upload.upload(path, on_part, progress)
+        return self.__add_file(state["connect_string"], state["key"],
+                               state["filename"], response)
+
+    @metrics.timed("liveleak.add_file")
+    def __add_file(self, connect_string, s3_key, filename, response):
+        """Tell LiveLeak about a file we've uploaded to S3.
+        Returns its file_token."""
+        meth_name = "__add_file"
         query_params = {
             "a": "add_file",
             "ajax": 1,
             "connect_string": connect_string,
-            "s3_key": amazon_response["Key"],
+            "s3_key": s3_key,
             "fn": urllib.quote(filename),
-            "resp": urllib.quote(r.text)
+            "resp": urllib.quote(response)
         }
 
         logger.debug("%s: query_params: %s", meth_name, repr(query_params))
 
-        r = requests.get(
-            "http://www.liveleak.com/file",
-            params=query_params, cookies=self.cookies,
-            headers={"User-Agent": self.user_agent})
+        r = self.session.get(
+            self.base_url + "/file", params=query_params)
         logger.debug("%s: GET status_code: %d", meth_name, r.status_code)
         logger.debug("%s: GET response: %s", meth_name, repr(r.text))
 
@@ -220,40 +413,90 @@ class Uploader(object):
         return obj["file_token"]
 
 
+def upload_filename(path):
+    """Mangle the filename (add timestamp, remove special characters).
+    This is similar to what the JS in the add_item form does.
+    It isn't exactly the same, but it's good enough."""
+    filename = P.basename(path)
+    fixed_file_name_part, extension = P.splitext(filename)
+    fixed_file_name_part = "".join(
+        [ch for ch in fixed_file_name_part if ch.isalnum()])
+    timestamp = time.time()
+    #
+    # Filename must be a raw Python string (not unicode)
+    #
+    return str(fixed_file_name_part + "_" + str(timestamp) + extension)
+
+
+class UploadForm(object):
+    """What we need from the add_item page to upload a file.
+
+    The form belongs to a single connection, i.e. a single item, so it
+    can only be used for one upload.  The S3 policy in it is good until
+    expiration (seconds since the epoch)."""
+
+    def __init__(self, multipart_params, connect_string, connection):
+        self.multipart_params = multipart_params
+        self.connect_string = connect_string
+        self.connection = connection
+        self.expiration = policy_expiration(multipart_params["policy"])
+
+    def __repr__(self):
+        return "<UploadForm(connection=%s, expiration=%s)>" % (
+            repr(self.connection), repr(self.expiration))
+
+
+def parse_add_item(html):
+    """Parse the add_item page in a single pass.
+    Returns an UploadForm on success, None on failure."""
+    meth_name = "parse_add_item"
+    multipart_params = connect_string = connection = None
+    for match in ADD_ITEM_FORM.finditer(html):
+        if match.group("params") is not None and multipart_params is None:
+            multipart_params = dict(
+                (m.group("key"), m.group("value"))
+                for m in MULTIPART_PARAM.finditer(match.group("params")))
+        elif match.group("connect_string") and connect_string is None:
+            connect_string = match.group("connect_string")
+        elif match.group("input") and connection is None:
+            value = INPUT_VALUE.search(match.group("input"))
+            connection = value.group("value") if value else None
+    if multipart_params is None:
+        logger.error("%s: missing multipart_params", meth_name)
+        return None
+    for k in MULTIPART_PARAMS:
+        if k not in multipart_params:
+            logger.error("%s: missing key: %s", meth_name, repr(k))
+            return None
+    if connect_string is None or connection is None:
+        logger.error("%s: missing connect_string or connection", meth_name)
+        return None
+    return UploadForm(multipart_params, connect_string, connection)
+
+
+def policy_expiration(policy):
+    """Return the expiration time of a base64-encoded S3 POST policy, in
+    seconds since the epoch, or 0 if it can't be worked out."""
+    try:
+        expiration = json.loads(base64.b64decode(policy))["expiration"]
+        parsed = time.strptime(expiration.split(".")[0].rstrip("Z"),
+                               "%Y-%m-%dT%H:%M:%S")
+    except (TypeError, ValueError, KeyError):
+        return 0
+    return calendar.timegm(parsed)
+
+
 def extract_multipart_params(html):
     """Extract the multipart_params dict from the add_item.html.
     Returns a dictionary on success, None on failure."""
-    meth_name = "extract_multipart_params"
-    keys = ["key", "Filename", "acl", "Expires", "Content-Type",
-            "success_action_status", "AWSAccessKeyId", "policy", "signature"]
-    multipart_params = {}
-    ptn = re.compile("'(?P<key>%s)' *: *'(?P<value>[^']+)'" % "|".join(keys))
-    found_params = False
-    for line in [l.strip() for l in html.split("\n")]:
-        if found_params and line.startswith("},"):
-            break
-        elif found_params:
-            match = ptn.search(line)
-            if not match:
-                continue
-            multipart_params[match.group("key")] = match.group("value")
-        elif line.startswith("multipart_params: {"):
-            found_params = True
-            continue
-    for k in keys:
-        if k not in multipart_params:
-            logging.error("%s: missing key: %s", meth_name, repr(k))
-            return None
-    return multipart_params
+    form = parse_add_item(html)
+    return form.multipart_params if form else None
 
 
 def extract_connection(html):
-    #
-    # Get the connection number (the value of the hidden input below):
-    #
-    # <input id="connection" name="connection" value="772_1405579810"
-    #  type="hidden"/>
-    #
-    root = etree.parse(StringIO(html), etree.HTMLParser())
-    connection = root.xpath("//input[@id='connection']")
-    return connection[0].get("value")
+    """Extract the value of the hidden connection input, e.g.
+
+    <input id="connection" name="connection" value="772_1405579810"
+     type="hidden"/>"""
+    form = parse_add_item(html)
+    return form.connection if form else None
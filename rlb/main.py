@@ -1,11 +1,17 @@
 import praw
 from praw.errors import APIException
 import datetime as dt
+import functools
+import json
 import os
 import os.path as P
+import re
+import threading
+import time
 import yaml
 import logging
-import time
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
 
 #
 # http://blog.tplus1.com/blog/2007/09/28/the-python-logging-module-is-much-better-than-print-statements/
@@ -19,13 +25,21 @@ logger = logging.getLogger(__name__)
 requests_log = logging.getLogger("requests")
 requests_log.setLevel(logging.WARNING)
 
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, func, or_
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.orm.exc import NoResultFound
 
 import liveleak
+import metrics
+import net
+import priority
+import s3
 import youtube
-from orm import Subreddit, Video
+from orm import Subreddit, Video, Reply
+from pipeline import Pipeline, Stage
+from scheduler import Scheduler
+import storage
+from storage import VideoIndex, DiskBudget
 
 COMMENT_MIRROR = "[**Mirror**](http://www.liveleak.com/view?i=%s)"
 COMMENT_FOOTER = """
@@ -35,6 +49,25 @@ COMMENT_FOOTER = """
 ^| [^Feedback](http://www.reddit.com/r/redditliveleakbot/)
 ^| [^FAQ](http://www.reddit.com/r/redditliveleakbot/wiki/index) ^|"""
 
+#
+# The maximum length of a combined subreddit name, e.g. "a+b+c".
+# Keeps the listing URLs well within the usual limits.
+#
+MAX_MULTIREDDIT_LENGTH = 512
+
+#
+# The maximum number of values in an IN (...) clause.  SQLite doesn't allow
+# more than 999 parameters per statement.
+#
+MAX_IN_CLAUSE = 500
+
+#
+# Picks the ID out of a submission's permalink, e.g. 2b8dsl in
+# http://www.reddit.com/r/UkrainianConflict/comments/2b8dsl/some_title/
+#
+SUBMISSION_ID = re.compile(r"/comments/(?P<id>[a-z0-9]+)")
+SUBREDDIT = re.compile(r"/r/(?P<name>[^/]+)/comments/")
+
 
 def transaction(func):
     """Wrap up a function call as a transaction.
@@ -42,36 +75,100 @@ def transaction(func):
     If something goes wrong, roll the session back.
     Returns whatever the inner method returned on success,
     or None on failure."""
+    name = "db." + func.__name__
+
     def inner(self, *args, **kwargs):
+        start = time.time()
         try:
             ret = func(self, *args, **kwargs)
             self.db.commit()
+            metrics.observe(name, time.time() - start)
             return ret
         except Exception as ex:
             logger.exception(ex)
             self.db.rollback()
+            metrics.observe(name, time.time() - start, error=True)
             return None
     return inner
 
 
+def chunk_subreddits(subreddits, max_length=MAX_MULTIREDDIT_LENGTH):
+    """Group subreddit names so that each group, joined with "+",
+    is at most max_length characters long."""
+    chunks = []
+    length = 0
+    for subreddit in subreddits:
+        if chunks and length + 1 + len(subreddit) <= max_length:
+            chunks[-1].append(subreddit)
+            length += 1 + len(subreddit)
+        else:
+            chunks.append([subreddit])
+            length = len(subreddit)
+    return chunks
+
+
+def submission_id(permalink):
+    """Return the ID of the submission a permalink points to, or None."""
+    match = SUBMISSION_ID.search(permalink or "")
+    return match.group("id") if match else None
+
+
+def subreddit_name(permalink):
+    """Return the name of the subreddit a permalink points to, or None."""
+    match = SUBREDDIT.search(permalink or "")
+    return match.group("name") if match else None
+
+
+def format_policy(doc):
+    """Build a youtube.FormatPolicy from a formats section of the config.
+    A key left empty loads as None, and means no limit, like a missing
+    one."""
+    return youtube.FormatPolicy(
+        int(doc.get("max_height") or 0),
+        int(float(doc.get("max_filesize_mb") or 0) * 1024 * 1024),
+        int(float(doc.get("max_duration_minutes") or 0) * 60),
+        doc.get("container"))
+
+
 def error_prone_praw_api_call(func):
     """Used to decorate the most error-prone PRAW API calls.
 
     For example, commenting on a submission can fail if the submission has
     been deleted."""
+    name = "reddit." + func.__name__
+
     def inner(self, *args, **kwargs):
+        start = time.time()
         try:
-            return func(self, *args, **kwargs)
+            ret = func(self, *args, **kwargs)
+            metrics.observe(name, time.time() - start)
+            return ret
         except APIException as ex:
             logger.exception(ex)
+            metrics.observe(name, time.time() - start, error=True)
             return None
     return inner
 
 
-def locate_video(subdir, video_id):
-    for f in os.listdir(subdir):
-        if f.startswith(video_id):
-            return P.join(subdir, f)
+class RepostJob(object):
+    """What the stages of the repost pipeline need to know about a video.
+
+    The stages run in worker threads, so they get a copy of the video's
+    data instead of the Video instance, which belongs to the session."""
+
+    def __init__(self, video):
+        self.youtube_id = video.youtubeId
+        self.permalink = video.redditSubmissionPermalink
+        self.local_path = video.localPath
+        self.connection = video.liveleakConnection
+        self.liveleak_id = video.liveleakId
+        self.upload_state = None
+        if video.uploadState:
+            self.upload_state = json.loads(video.uploadState)
+        self.submission = None
+
+    def __repr__(self):
+        return "<RepostJob(youtube_id=%s)>" % repr(self.youtube_id)
 
 
 class Config(object):
@@ -93,39 +190,289 @@ class Config(object):
         self.reddit_password = doc["reddit"]["password"]
         self.google_developer_key = doc["google_developer_key"]
 
+        #
+        # When a submission isn't in our database of replies, we check
+        # whether it's among the submissions of our reply_check_limit most
+        # recent comments.  The list of comments is fetched at most once
+        # every reply_cache_minutes.
+        #
+        self.reply_check_limit = int(
+            doc["reddit"].get("reply_check_limit", 100))
+        self.reply_cache_minutes = float(
+            doc["reddit"].get("reply_cache_minutes", 10))
+
+        #
+        # An empty listing can mean that the submission our cursor points
+        # at has been deleted.  Checking costs a request, so we only check
+        # once the cursor is cursor_check_hours old, and then at most once
+        # every cursor_check_hours.
+        #
+        self.cursor_check_hours = float(
+            doc["reddit"].get("cursor_check_hours", 6))
+
+        #
+        # Upload videos to this S3-compatible endpoint in parts of
+        # part_size_mb megabytes, so that an interrupted upload can be
+        # resumed.  If unset, each video is uploaded in a single request.
+        #
+        self.liveleak_s3_endpoint = doc["liveleak"].get("s3_endpoint")
+        self.liveleak_part_size = max(
+            s3.MIN_PART_SIZE,
+            int(doc["liveleak"].get("part_size_mb", 8) * 1024 * 1024))
+
+        #
+        # Where to find LiveLeak, its S3 bucket and the YouTube Data API.
+        # Only worth changing to run against local stand-ins, e.g. for
+        # bin/benchmark.py.
+        #
+        self.liveleak_base_url = doc["liveleak"].get("base_url",
+                                                     liveleak.BASE_URL)
+        self.liveleak_s3_url = doc["liveleak"].get("s3_url", liveleak.S3_URL)
+
+        #
+        # Which format of each video to download, and which videos are too
+        # big or too long to download at all.  The formats section sets the
+        # defaults, and a subreddit can override them in a formats section
+        # of its own.  The policies are keyed by lowercase subreddit name.
+        #
+        formats = doc.get("formats") or {}
+        self.format_policy = format_policy(formats)
+        self.format_policies = {}
+
+        #
+        # Deferred downloads: when a scan finds a new video, only look up
+        # its metadata, and queue it for download with a priority (see
+        # priority.py).  Each pass of download_queued then downloads the
+        # downloads_per_pass queued videos with the highest priority.
+        # A subreddit's priority_weight scales the priority of its videos.
+        #
+        deferred = doc.get("deferred") or {}
+        self.deferred = bool(deferred.get("enabled", False))
+        self.downloads_per_pass = int(deferred.get("downloads_per_pass", 50))
+        self.age_half_life_hours = float(
+            deferred.get("age_half_life_hours", 24))
+        self.priority_weights = {}
+
         self.hold_hours = doc["hold_hours"]
         self.subreddits = {}
         for sub in doc["subreddits"]:
             self.subreddits[sub] = doc["subreddits"][sub]["liveleak_category"]
+            #
+            # A key left empty in the overrides doesn't override anything.
+            #
+            overrides = doc["subreddits"][sub].get("formats") or {}
+            overrides = dict((k, v) for (k, v) in overrides.items()
+                             if v is not None)
+            self.format_policies[sub.lower()] = format_policy(
+                dict(formats, **overrides))
+            self.priority_weights[sub.lower()] = float(
+                doc["subreddits"][sub].get("priority_weight", 1))
         self.dbpath = doc["dbpath"]
 
+        #
+        # Store videos in subdirectories of videopath named after their IDs.
+        # Use bin/shardvideos.py to move the videos of an existing
+        # installation.
+        #
+        self.shard_videos = bool(doc.get("shard_videos", False))
 
-class Bot(object):
+        #
+        # The HTTP connection pool shared by the LiveLeak and YouTube clients.
+        #
+        http = doc.get("http") or {}
+        self.http_pool_size = int(http.get("pool_size", 10))
+        self.http_max_retries = int(http.get("max_retries", 3))
+        self.http_backoff_factor = float(http.get("backoff_factor", 0.5))
+        self.http_timeout = float(http.get("timeout", 60))
 
-    def __init__(self, config_path=None):
+        #
+        # How hard to hit the YouTube Data API when checking for deleted
+        # videos.  Each request checks up to 50 videos.
+        #
+        yt = doc.get("youtube") or {}
+        self.youtube_max_in_flight = int(yt.get("max_in_flight", 4))
+        self.youtube_requests_per_second = float(
+            yt.get("requests_per_second", 5))
+        self.youtube_api_url = yt.get("api_url", youtube.API_URL)
 
+        #
+        # The number of worker threads for each stage of reposting.
+        #
+        repost = doc.get("repost") or {}
+        self.reply_workers = int(repost.get("reply_workers", 1))
+        self.upload_workers = int(repost.get("upload_workers", 2))
+        self.publish_workers = int(repost.get("publish_workers", 1))
+        self.comment_workers = int(repost.get("comment_workers", 1))
+
+        #
+        # The number of videos to download at the same time, and the total
+        # download bandwidth (bytes per second, 0 for unlimited) that they
+        # share.
+        #
+        self.download_workers = int(doc.get("download_workers", 1))
+        self.download_rate_limit = int(doc.get("download_rate_limit", 0))
+
+        #
+        # The total upload bandwidth (bytes per second, 0 for unlimited)
+        # for reposting to LiveLeak.  Keeps large uploads from starving
+        # the reddit and YouTube requests.
+        #
+        self.upload_rate_limit = int(doc.get("upload_rate_limit", 0))
+
+        #
+        # The number of files to delete at the same time when purging, and
+        # the number of purged videos to commit per transaction.
+        #
+        self.purge_workers = int(doc.get("purge_workers", 4))
+        self.purge_batch_size = int(doc.get("purge_batch_size", 100))
+
+        #
+        # How much disk space the videos may use.  Checked after every
+        # download; see Bot.enforce_disk_budget.
+        #
+        budget = doc.get("disk_budget") or {}
+        self.disk_budget = DiskBudget(
+            int(budget.get("max_bytes", 0)),
+            float(budget.get("min_free_percent", 0)))
+
+        #
+        # How often (in minutes) the daemon performs each of its tasks.
+        # Zero disables the task.
+        #
+        daemon = doc.get("daemon") or {}
+        self.scan_minutes = float(daemon.get("scan_minutes", 60))
+        self.download_minutes = float(daemon.get("download_minutes", 10))
+        self.deleted_minutes = float(daemon.get("deleted_minutes", 60))
+        self.stale_minutes = float(daemon.get("stale_minutes", 60))
+        self.purge_minutes = float(daemon.get("purge_minutes", 7 * 24 * 60))
+
+        #
+        # Where to write the counts and timings of the bot's operations at
+        # the end of each pass, as JSON and in the Prometheus text format.
+        # Either can be left out.
+        #
+        report = doc.get("metrics") or {}
+        self.metrics_json_path = report.get("json_path")
+        self.metrics_prometheus_path = report.get("prometheus_path")
+
+
+class Bot(object):
+
+    def __init__(self, config_path=None, reddit=None):
+        """reddit is a logged-in praw.Reddit, or something that behaves
+        like one.  By default, the bot logs in with the account in the
+        config."""
         self.cfg = Config(config_path)
         if not P.isdir(self.cfg.dest_dir):
             os.makedirs(self.cfg.dest_dir)
+        self.videos = VideoIndex(self.cfg.dest_dir, self.cfg.shard_videos)
 
         engine = create_engine(self.cfg.dbpath)
         Session = sessionmaker(bind=engine)
         self.db = Session()
 
-        self.r = praw.Reddit(self.cfg.user_agent)
-        self.r.login(self.cfg.reddit_username, self.cfg.reddit_password)
+        if reddit is None:
+            reddit = praw.Reddit(self.cfg.user_agent)
+            reddit.login(self.cfg.reddit_username, self.cfg.reddit_password)
+        self.r = reddit
+        #
+        # The IDs of the submissions our recent comments are on; see
+        # check_replies.
+        #
+        self.replies_lock = threading.Lock()
+        self.recent_replies = set()
+        self.recent_replies_fetched = None
+
+        self.http = net.create_session(
+            self.cfg.user_agent, self.cfg.http_pool_size,
+            self.cfg.http_max_retries, self.cfg.http_backoff_factor,
+            self.cfg.http_timeout)
 
-        self.uploader = liveleak.Uploader(self.cfg.user_agent)
+        self.uploader = liveleak.Uploader(
+            self.cfg.user_agent, self.http, self.cfg.liveleak_s3_endpoint,
+            self.cfg.liveleak_part_size, self.cfg.upload_rate_limit,
+            base_url=self.cfg.liveleak_base_url,
+            s3_url=self.cfg.liveleak_s3_url)
+        #
+        # The checker retries failed requests itself, through its rate
+        # limiter, so its session mustn't retry them as well.
+        #
+        youtube_http = net.create_session(
+            self.cfg.user_agent, self.cfg.http_pool_size, 0, 0,
+            self.cfg.http_timeout)
+        self.checker = youtube.AvailabilityChecker(
+            self.cfg.user_agent, self.cfg.google_developer_key, youtube_http,
+            self.cfg.youtube_max_in_flight,
+            self.cfg.youtube_requests_per_second,
+            url=self.cfg.youtube_api_url)
+        #
+        # The download workers share the bandwidth cap equally.
+        #
+        rate_limit = self.cfg.download_rate_limit / max(
+            1, self.cfg.download_workers)
+        self.downloader = youtube.DownloadEngine(rate_limit or None)
         self.uploader.login(self.cfg.liveleak_username,
                             self.cfg.liveleak_password)
 
     def monitor(self):
         """Monitor all subreddits specified in the config.xml file."""
-        for subreddit in self.cfg.subreddits:
-            self.download_new_videos(subreddit)
+        self.scan_subreddits()
+        self.download_queued()
         self.monitor_deleted_videos()
         self.make_stale()
 
+    def scan_subreddits(self):
+        """Download the videos from new submissions to all subreddits."""
+        for chunk in chunk_subreddits(sorted(self.cfg.subreddits)):
+            self.download_new_videos(*chunk)
+
+    def daemon(self):
+        """Keep running, performing each of the tasks on its own interval.
+
+        Unlike running monitor and purge from cron, this keeps the config,
+        the database session and the reddit and LiveLeak logins between
+        passes."""
+        scheduler = Scheduler()
+        tasks = [("scan_subreddits", self.cfg.scan_minutes),
+                 ("download_queued", self.cfg.download_minutes),
+                 ("monitor_deleted_videos", self.cfg.deleted_minutes),
+                 ("make_stale", self.cfg.stale_minutes),
+                 ("purge", self.cfg.purge_minutes)]
+        for name, minutes in tasks:
+            scheduler.add(name, minutes * 60, self._daemon_task(name))
+        scheduler.run_forever()
+
+    def _daemon_task(self, name):
+        """Make sure a failed task doesn't leave the session unusable for
+        the tasks that follow it."""
+        func = getattr(self, name)
+
+        def inner():
+            try:
+                func()
+            except Exception:
+                self.db.rollback()
+                raise
+            finally:
+                self.report_metrics()
+        return inner
+
+    def report_metrics(self):
+        """Log where the time went in this pass, and write the metrics
+        files.  The next pass starts counting from zero, except in the
+        Prometheus file, which keeps the totals."""
+        metrics.REGISTRY.log_summary()
+        try:
+            if self.cfg.metrics_json_path:
+                metrics.REGISTRY.write_json(self.cfg.metrics_json_path)
+            if self.cfg.metrics_prometheus_path:
+                metrics.REGISTRY.write_prometheus(
+                    self.cfg.metrics_prometheus_path)
+        except (IOError, OSError) as ex:
+            logger.exception(ex)
+        finally:
+            metrics.end_pass()
+
     @transaction
     def get_subreddit_info(self, sr):
         try:
@@ -135,21 +482,70 @@ class Bot(object):
             self.db.add(sub_info)
         return sub_info
 
-    def download_new_videos(self, subreddit):
-        """Monitors the specific subreddit for new submissions that
-        link to YouTube videos."""
+    def download_new_videos(self, *subreddits):
+        """Monitors the specific subreddits for new submissions that
+        link to YouTube videos.
+
+        Fetches a single combined listing (r/a+b+c/new) for all the
+        subreddits, and keeps track of the newest submission for each of
+        them separately."""
         meth_name = "download_new_videos"
-        sub_info = self.get_subreddit_info(subreddit)
+        sub_infos = dict((sr.lower(), self.get_subreddit_info(sr))
+                         for sr in subreddits)
+        #
+        # The combined listing has a cursor of its own: the newest
+        # submission it has returned, whichever subreddit it was in.  For a
+        # single subreddit, that's the subreddit's own cursor.
+        #
+        listing_info = self.get_subreddit_info("+".join(subreddits))
 
-        now = dt.datetime.now()
+        #
+        # Only ask for the submissions newer than the newest one the
+        # listing has returned, and skip the ones we've already seen in
+        # each subreddit.  If there are more than limit of them, we get the
+        # oldest ones, and catch up with the rest on the next pass.
+        #
+        # Until the listing has a cursor, start from the oldest of the
+        # subreddits' cursors.  Doing that on every pass would let a quiet
+        # subreddit hold the cursor back, and reddit would keep returning
+        # the same limit submissions after it.
+        #
+        cursors = [i for i in sub_infos.values() if i.newestSubmission]
+        anchor = None
+        oldest_cursor = None
+        if listing_info.newestSubmission:
+            anchor = listing_info
+        elif cursors:
+            anchor = min(cursors, key=lambda i: i.newestSubmissionCreated)
+            if len(cursors) == len(sub_infos):
+                oldest_cursor = anchor.newestSubmissionCreated
+        newest = {}
+        newest_listed = None
+        new_submissions = []
 
-        for new_submission in self.r.get_subreddit(
-                subreddit).get_new(limit=self.cfg.limit):
-            created = dt.datetime.fromtimestamp(new_submission.created_utc)
-            if created < sub_info.mostRecentSubmission:
+        for new_submission in self.get_new_submissions(subreddits, anchor):
+            if oldest_cursor is not None and \
+                    new_submission.created_utc <= oldest_cursor:
                 break
+            if newest_listed is None or new_submission.created_utc > \
+                    newest_listed.created_utc:
+                newest_listed = new_submission
+            key = new_submission.subreddit.display_name.lower()
+            sub_info = sub_infos.get(key)
+            if sub_info is None:
+                continue
+            if sub_info.newestSubmissionCreated is not None and \
+                    new_submission.created_utc <= \
+                    sub_info.newestSubmissionCreated:
+                continue
+            if key not in newest or new_submission.created_utc > \
+                    newest[key].created_utc:
+                newest[key] = new_submission
+            new_submissions.append(new_submission)
 
-            youtube_id = youtube.extract_id(new_submission.url)
+        candidates = OrderedDict()
+        youtube_ids = youtube.extract_ids(s.url for s in new_submissions)
+        for new_submission, youtube_id in zip(new_submissions, youtube_ids):
             logger.debug("%s: youtube_id: %s", meth_name, youtube_id)
             if youtube_id is None:
                 logger.debug("skipping submission URL: %s",
@@ -160,37 +556,310 @@ class Bot(object):
                         new_submission.permalink, new_submission.url,
                         youtube_id)
 
-            download = True
-            try:
-                v = self.db.query(Video).filter_by(youtubeId=youtube_id).one()
-                download = not v.has_file()
-            except NoResultFound:
-                pass
-            if download:
-                self.download_video(youtube_id, new_submission.permalink)
-
-        sub_info.mostRecentSubmission = now
+            if youtube_id not in candidates:
+                candidates[youtube_id] = new_submission
+
+        #
+        # Download the videos we haven't seen before, and the ones we've
+        # seen but no longer have the file for, unless we skipped them.
+        #
+        # In deferred mode, queue them instead.
+        #
+        known = self.find_videos(candidates.keys())
+        pending = [(youtube_id, submission)
+                   for (youtube_id, submission) in candidates.items()
+                   if youtube_id not in known or
+                   (youtube_id not in self.videos and
+                    known[youtube_id].state != Video.SKIPPED)]
+        if self.cfg.deferred:
+            self.queue_videos(pending, known)
+        else:
+            self.download_videos(((youtube_id, submission.permalink)
+                                  for (youtube_id, submission) in pending),
+                                 known)
+
+        if newest_listed is not None:
+            listing_info.newestSubmission = newest_listed.fullname
+            listing_info.newestSubmissionCreated = newest_listed.created_utc
+        for key, submission in newest.items():
+            sub_info = sub_infos[key]
+            sub_info.newestSubmission = submission.fullname
+            sub_info.newestSubmissionCreated = submission.created_utc
+            sub_info.mostRecentSubmission = dt.datetime.utcfromtimestamp(
+                submission.created_utc)
         self.db.commit()
 
-    @transaction
+    def get_new_submissions(self, subreddits, anchor=None):
+        """Yield the newest submissions to the subreddits, newest first.
+        If anchor is a Subreddit with a cursor, only yield the submissions
+        newer than the cursor.
+
+        Reddit returns nothing before a submission that has been deleted
+        or removed, so a cursor on one would never move again.  If the
+        listing is empty because of that, fetch the newest submissions
+        without the cursor instead, and leave the caller to skip the ones
+        it has already seen."""
+        meth_name = "get_new_submissions"
+        name = "+".join(subreddits)
+        params = {}
+        if anchor is not None:
+            params["before"] = anchor.newestSubmission
+        listing = self.r.get_subreddit(name).get_new(limit=self.cfg.limit,
+                                                     params=params)
+        empty = True
+        for new_submission in metrics.iterate("reddit.get_new", listing):
+            empty = False
+            yield new_submission
+        if not (empty and anchor is not None and self.cursor_gone(anchor)):
+            return
+        logger.info("%s: %s is gone, fetching %s without it", meth_name,
+                    anchor.newestSubmission, name)
+        listing = self.r.get_subreddit(name).get_new(limit=self.cfg.limit,
+                                                     params={})
+        for new_submission in metrics.iterate("reddit.get_new", listing):
+            yield new_submission
+
+    def cursor_gone(self, sub_info):
+        """Return True if the submission the cursor of sub_info points at
+        has been deleted or removed.
+
+        Most empty listings just mean that there's nothing new, so this
+        assumes the submission is still there until the cursor is
+        cursor_check_hours old, and then checks at most once every
+        cursor_check_hours."""
+        now = time.time()
+        last = max(sub_info.newestSubmissionCreated or 0,
+                   sub_info.newestSubmissionChecked or 0)
+        if now - last < self.cfg.cursor_check_hours * 3600:
+            return False
+        sub_info.newestSubmissionChecked = now
+        return self.submission_gone(sub_info.newestSubmission)
+
+    def submission_gone(self, fullname):
+        """Return True if the submission has been deleted or removed."""
+        with metrics.timer("reddit.get_info"):
+            submission = self.r.get_info(thing_id=fullname)
+        return (submission is None or submission.author is None or
+                bool(getattr(submission, "removed_by_category", None)))
+
     def download_video(self, youtube_id, permalink):
         """Download the video with the specified YouTube ID.
         If it has already been downloaded, the actual download is skipped.
         Returns a Video instance.
         """
+        started = dt.datetime.now()
+        youtube_id, permalink, path, skip_reason = self._fetch(
+            (youtube_id, permalink))
+        v = self.record_download(youtube_id, permalink, path,
+                                 skip_reason=skip_reason)
+        self.enforce_disk_budget(started)
+        return v
+
+    def queue_videos(self, pending, known=None):
+        """Look up the metadata of new videos, and queue them for
+        download_queued.
+
+        pending is a sequence of (youtube_id, submission) pairs.  known is
+        a dictionary of the Video instances we already have for them, as
+        returned by find_videos.  The metadata of up to 50 videos comes in
+        a single request, which is much cheaper than probing each video
+        with youtube_dl."""
+        pending = list(pending)
+        if not pending:
+            return
+        details, unknown = self.checker.details(
+            youtube_id for (youtube_id, _) in pending)
+        history = self.channel_history(set(
+            d["channel_id"] for d in details.values() if d["channel_id"]))
+        self.record_probes(pending, details, unknown, history, known)
+
+    def channel_history(self, channel_ids):
+        """Return how many of the videos we know of from each channel have
+        been taken down.  Returns a dictionary of (takedowns, videos) pairs
+        keyed by channel ID."""
+        channel_ids = list(channel_ids)
+        history = {}
+        for i in range(0, len(channel_ids), MAX_IN_CLAUSE):
+            chunk = channel_ids[i:i + MAX_IN_CLAUSE]
+            for channel_id, videos, takedowns in self.db.query(
+                    Video.channelId, func.count(), func.count(Video.deleted))\
+                    .filter(Video.channelId.in_(chunk))\
+                    .group_by(Video.channelId):
+                history[channel_id] = (takedowns, videos)
+        return history
+
+    @transaction
+    def record_probes(self, pending, details, unknown, history, known=None):
+        """Record what queue_videos found out, and work out the priority
+        of each video."""
+        meth_name = "record_probes"
+        now = time.time()
+        for youtube_id, submission in pending:
+            if known is not None:
+                v = known.get(youtube_id)
+            else:
+                v = self.db.query(Video).filter_by(
+                    youtubeId=youtube_id).first()
+            if v is None:
+                v = Video(youtube_id, submission.permalink)
+                self.db.add(v)
+
+            #
+            # If the lookup failed, queue the video with what we know from
+            # reddit.  If it worked but didn't find the video, the video
+            # is gone already.
+            #
+            if youtube_id not in details and youtube_id not in unknown:
+                logger.info("%s: %s is no longer available", meth_name,
+                            youtube_id)
+                v.state = Video.ERROR
+                continue
+            info = details.get(youtube_id, {})
+            v.channelId = info.get("channel_id")
+            v.duration = info.get("duration")
+            v.published = info.get("published") or \
+                dt.datetime.utcfromtimestamp(submission.created_utc)
+            v.redditScore = submission.score
+
+            reason = self.format_policy(submission.permalink).check(
+                {"duration": v.duration})
+            if reason is not None:
+                logger.info("%s: skipping %s: %s", meth_name, youtube_id,
+                            reason)
+                v.state = Video.SKIPPED
+                v.skipReason = reason
+                continue
+
+            takedowns, videos = history.get(v.channelId, (0, 0))
+            subreddit = submission.subreddit.display_name.lower()
+            v.priority = priority.priority(
+                v.published, self.cfg.priority_weights.get(subreddit, 1),
+                submission.score, now - submission.created_utc, takedowns,
+                videos, self.cfg.age_half_life_hours)
+            v.state = Video.PROBED
+        logger.info("%s: %d videos", meth_name, len(pending))
+
+    def download_queued(self):
+        """Download the queued videos with the highest priority, up to
+        downloads_per_pass of them.  Returns the number of videos."""
+        meth_name = "download_queued"
+        videos = self.db.query(Video).filter_by(state=Video.PROBED)\
+            .order_by(Video.priority.desc())\
+            .limit(self.cfg.downloads_per_pass).all()
+        logger.info("%s: %d videos", meth_name, len(videos))
+        self.download_videos(
+            [(v.youtubeId, v.redditSubmissionPermalink) for v in videos],
+            dict((v.youtubeId, v) for v in videos))
+        return len(videos)
+
+    def find_videos(self, youtube_ids):
+        """Look up several videos at once.
+        Returns a dictionary of the Video instances we know about, keyed by
+        YouTube ID."""
+        youtube_ids = list(youtube_ids)
+        videos = {}
+        for i in range(0, len(youtube_ids), MAX_IN_CLAUSE):
+            chunk = youtube_ids[i:i + MAX_IN_CLAUSE]
+            for v in self.db.query(Video).filter(Video.youtubeId.in_(chunk)):
+                videos[v.youtubeId] = v
+        return videos
+
+    def download_videos(self, pending, known=None):
+        """Download several videos in parallel.
+
+        pending is a sequence of (youtube_id, permalink) pairs.
+        known is a dictionary of the Video instances we already have for
+        them, as returned by find_videos.
+        The worker threads only download: the results are recorded in
+        the database from the calling thread, since the session isn't
+        thread-safe.  The disk budget is enforced once they're all
+        recorded, so that a failed eviction can't roll them back."""
+        pending = list(pending)
+        if not pending:
+            return
+        started = dt.datetime.now()
+        pool = ThreadPool(max(1, min(self.cfg.download_workers, len(pending))))
         try:
-            v = self.db.query(Video).filter_by(youtubeId=youtube_id).one()
-        except NoResultFound:
-            v = Video(youtube_id, permalink)
-            self.db.add(v)
+            self.record_downloads(pool.imap_unordered(self._fetch, pending),
+                                  known)
+        finally:
+            pool.close()
+            pool.join()
+        self.enforce_disk_budget(started)
 
-        v.localPath = locate_video(self.cfg.dest_dir, v.youtubeId)
+    def _fetch(self, job):
+        youtube_id, permalink = job
+        skip_reason = None
+        try:
+            path = self.fetch_video(youtube_id, self.format_policy(permalink))
+        except youtube.VideoSkipped as ex:
+            path = None
+            skip_reason = str(ex)
+        except Exception as ex:
+            logger.exception(ex)
+            path = None
+        return youtube_id, permalink, path, skip_reason
+
+    def format_policy(self, permalink):
+        """Return the format policy for a video submitted to reddit."""
+        name = (subreddit_name(permalink) or "").lower()
+        return self.cfg.format_policies.get(name, self.cfg.format_policy)
+
+    def fetch_video(self, youtube_id, policy=None):
+        """Download the video file unless we already have it.
+        Returns the path to the video file, or None if the download failed.
+        Raises youtube.VideoSkipped if the video is over the limits of the
+        policy.  Doesn't touch the database, so it's safe to call from a
+        worker."""
+        path = self.videos.locate(youtube_id)
+        if path is None:
+            subdir = self.videos.video_dir(youtube_id)
+            if self.cfg.shard_videos:
+                storage.ensure_dir(subdir)
+            path = self.downloader.download(subdir, youtube_id, policy)
+            if path is not None:
+                self.videos.add(youtube_id, path)
+        return path
+
+    @transaction
+    def record_download(self, youtube_id, permalink, path, known=None,
+                        skip_reason=None):
+        """Record the outcome of a download in the database.
+        If we've looked the video up already, pass in the result of
+        find_videos as known to save a query.  If the download was skipped,
+        pass in the reason.  Returns a Video instance."""
+        return self._record_download(youtube_id, permalink, path, known,
+                                     skip_reason)
+
+    @transaction
+    def record_downloads(self, results, known=None):
+        """Record the outcomes of several downloads as they come in, in a
+        single transaction.  Committing after each one would expire the
+        Video instances in known, and reload each of them with a query of
+        its own.  results is an iterable of the tuples _fetch returns.
+        Returns the number of downloads recorded."""
+        count = 0
+        for youtube_id, permalink, path, skip_reason in results:
+            self._record_download(youtube_id, permalink, path, known,
+                                  skip_reason)
+            count += 1
+        return count
 
-        if v.localPath is None:
-            youtube.download(self.cfg.dest_dir, v.youtubeId)
-            v.localPath = locate_video(self.cfg.dest_dir, v.youtubeId)
+    def _record_download(self, youtube_id, permalink, path, known=None,
+                         skip_reason=None):
+        if known is not None:
+            v = known.get(youtube_id)
+        else:
+            v = self.db.query(Video).filter_by(youtubeId=youtube_id).first()
+        if v is None:
+            v = Video(youtube_id, permalink)
+            self.db.add(v)
 
-        if v.localPath is None:
+        v.localPath = path
+        v.skipReason = skip_reason
+        if skip_reason is not None:
+            v.state = Video.SKIPPED
+        elif path is None:
             v.state = Video.ERROR
         else:
             v.state = Video.DOWNLOADED
@@ -201,102 +870,323 @@ class Bot(object):
     @transaction
     def make_stale(self):
         """Make all data that hasn't been updated in self.hold_hours
-        hours stale."""
-        cutoff = dt.datetime.now() - dt.timedelta(hours=self.cfg.hold_hours)
-        for video in self.db.query(Video).filter_by(state=Video.DOWNLOADED):
-            if video.discovered is None or video.discovered < cutoff:
-                video.state = Video.STALE
-                video.localModified = dt.datetime.now()
+        hours stale.  Returns the number of videos made stale."""
+        now = dt.datetime.now()
+        cutoff = now - dt.timedelta(hours=self.cfg.hold_hours)
+        count = self.db.query(Video)\
+            .filter(Video.state.in_([Video.DOWNLOADED, Video.PROBED]))\
+            .filter(or_(Video.discovered.is_(None),
+                        Video.discovered < cutoff))\
+            .update({Video.state: Video.STALE, Video.localModified: now},
+                    synchronize_session=False)
+        logger.info("make_stale: %d videos made stale", count)
+        return count
 
     def purge(self):
-        """Delete stale and reposted video data."""
-        for video in self.db.query(Video).filter_by(state=Video.STALE):
-            self.purge_video(video)
-        for video in self.db.query(Video).filter_by(state=Video.REPOSTED):
-            self.purge_video(video)
-        for video in self.db.query(Video):
-            if not video.has_file():
-                self.purge_video(video)
+        """Delete stale and reposted video data, and forget about videos
+        whose files have gone missing.
+        Returns the number of bytes reclaimed."""
+        meth_name = "purge"
+        candidates = []
+        for video in self.db.query(Video).filter(Video.state.in_(
+                [Video.DOWNLOADED, Video.REPOSTED, Video.STALE, Video.ERROR])):
+            if video.state in (Video.STALE, Video.REPOSTED) or \
+                    video.youtubeId not in self.videos:
+                candidates.append(video)
+        logger.info("%s: %d videos to purge", meth_name, len(candidates))
 
-    @transaction
-    def purge_video(self, video):
-        if video.has_file():
-            logger.info("removing %s", video.localPath)
-            try:
-                os.remove(video.localPath)
-            except OSError as ose:
-                logger.exception(ose)
+        reclaimed = 0
+        batch_size = self.cfg.purge_batch_size
+        pool = ThreadPool(self.cfg.purge_workers)
+        try:
+            for i in range(0, len(candidates), batch_size):
+                batch = candidates[i:i + batch_size]
+                reclaimed += self.purge_videos(batch, pool) or 0
+        finally:
+            pool.close()
+            pool.join()
+        logger.info("%s: reclaimed %d bytes", meth_name, reclaimed)
+        return reclaimed
+
+    def enforce_disk_budget(self, since=None):
+        """Evict videos until we're back within the disk budget.
+
+        Stale and reposted videos go first, since we no longer need them.
+        Then the downloaded videos go, oldest discovered first: a video that
+        has stayed up on YouTube for a long time is the least likely to be
+        taken down.  Videos downloaded since the datetime since are kept,
+        so that a download never evicts itself before it can be reposted.
+        Candidates are read in batches from the (state, discovered) index,
+        so this doesn't scan the table.
+        Returns the number of bytes reclaimed."""
+        meth_name = "enforce_disk_budget"
+        excess = self.cfg.disk_budget.excess(self.videos)
+        if excess <= 0:
+            return 0
+        logger.info("%s: need to free %d bytes", meth_name, excess)
 
-        video.localPath = None
-        video.state = Video.PURGED
-        video.localModified = dt.datetime.now()
+        downloaded = self.db.query(Video).filter(
+            Video.state == Video.DOWNLOADED)
+        if since is not None:
+            downloaded = downloaded.filter(or_(
+                Video.localModified.is_(None), Video.localModified < since))
+        queries = [
+            self.db.query(Video).filter(
+                Video.state.in_([Video.STALE, Video.REPOSTED])),
+            downloaded.order_by(Video.discovered)
+        ]
+        reclaimed = 0
+        pool = ThreadPool(self.cfg.purge_workers)
+        try:
+            for query in queries:
+                while reclaimed < excess:
+                    batch = query.limit(self.cfg.purge_batch_size).all()
+                    if not batch:
+                        break
+                    freed = self.purge_videos(batch, pool)
+                    if freed is None:
+                        logger.error("%s: failed to purge %d videos, "
+                                     "reclaimed %d of %d bytes", meth_name,
+                                     len(batch), reclaimed, excess)
+                        return reclaimed
+                    reclaimed += freed
+        finally:
+            pool.close()
+            pool.join()
+        logger.info("%s: reclaimed %d bytes", meth_name, reclaimed)
+        return reclaimed
 
     @transaction
-    def repost_video(self, video):
-        meth_name = "repost_video"
-        submission = self.r.get_submission(video.redditSubmissionPermalink)
-        subreddit = submission.subreddit.display_name
-        body = "repost of http://youtube.com/watch?v=%s from %s" % (
-            video.youtubeId, submission.permalink)
-        logger.info("%s: %s", meth_name, body)
-        if not video.has_file():
-            #
-            # If we're reposting, then the video has already been deleted from
-            # YouTube.  If we don't have the video downloaded by now, there's
-            # nothing we can do.
-            #
-            logger.info("%s: giving up on %s", meth_name, video.youtubeId)
-            video.state = Video.STALE
-        elif video.liveleakId is None:
-            category = self.cfg.subreddits[subreddit]
-            logger.debug("%s: category: %s", meth_name, category)
-
-            file_token, connection = self.uploader.upload(video.localPath)
-            video.liveleakId = self.uploader.publish(submission.title, body,
-                                                     subreddit, category,
-                                                     connection)
-            video.state = Video.REPOSTED
+    def purge_videos(self, videos, pool):
+        """Delete the files of several videos in parallel and mark the
+        videos as purged.  Returns the number of bytes reclaimed."""
+        paths = [v.localPath for v in videos if v.localPath]
+        reclaimed = sum(pool.map(storage.remove_file, paths))
+        now = dt.datetime.now()
+        for video in videos:
+            self.videos.discard(video.youtubeId)
+            video.localPath = None
+            video.state = Video.PURGED
+            video.localModified = now
+        return reclaimed
 
     def check_replies(self, submission):
         """Return true if we've replied to the submission already.
 
         Ideally, we shouldn't have to check for this over the wire, since
-        our database should be sufficient.  However, it avoids embarrassing
-        multi-posts in some cases, e.g. database has been reset."""
+        our database should be sufficient (see replied_submissions).
+        However, it avoids embarrassing multi-posts in some cases, e.g.
+        database has been reset.  Rather than download the submission's
+        whole comment tree, look for it among our own recent comments."""
         meth_name = "check_replies"
-        reply_authors = [r.author.name for r in submission.comments
-                         if r.author]
-        result = self.cfg.reddit_username in reply_authors
+        result = submission.id in self.get_recent_replies()
         if result:
             logger.info("%s: we have already replied to this submission: %s",
                         meth_name, submission.permalink)
         return result
 
+    def get_recent_replies(self):
+        """Return the IDs of the submissions our most recent comments are
+        on.  Fetches the comments again if the ones we have are older than
+        reply_cache_minutes.  Safe to call from several threads."""
+        meth_name = "get_recent_replies"
+        with self.replies_lock:
+            now = time.time()
+            max_age = self.cfg.reply_cache_minutes * 60
+            if (self.recent_replies_fetched is None or
+                    now - self.recent_replies_fetched > max_age):
+                comments = self.r.user.get_comments(
+                    limit=self.cfg.reply_check_limit)
+                #
+                # link_id is the fullname of the submission, e.g. t3_2auyay
+                #
+                self.recent_replies = set(
+                    c.link_id.split("_", 1)[-1]
+                    for c in metrics.iterate("reddit.get_comments",
+                                             comments))
+                self.recent_replies_fetched = now
+                logger.info("%s: fetched %d submissions", meth_name,
+                            len(self.recent_replies))
+            return set(self.recent_replies)
+
+    def replied_submissions(self, submission_ids):
+        """Return the IDs of the submissions we've commented on, according
+        to our database."""
+        submission_ids = [i for i in submission_ids if i]
+        replied = set()
+        for i in range(0, len(submission_ids), MAX_IN_CLAUSE):
+            chunk = submission_ids[i:i + MAX_IN_CLAUSE]
+            replied.update(r.redditSubmissionId for r in self.db.query(
+                Reply).filter(Reply.redditSubmissionId.in_(chunk)))
+        return replied
+
+    def record_reply(self, submission_id, comment_id=None):
+        """Remember that we've commented on a submission."""
+        self.db.merge(Reply(submission_id, comment_id))
+
     def monitor_deleted_videos(self):
         """Go through all our downloaded videos and check if they have
         been deleted from YouTube.  If yes, repost them."""
-        for v in self.db.query(Video).filter_by(state=Video.DOWNLOADED):
-            try:
-                if youtube.video_exists(v.youtubeId, self.cfg.user_agent,
-                                        self.cfg.google_developer_key):
-                    continue
-            except youtube.YoutubeException:
-                time.sleep(5)
-                continue
+        self.mark_deleted_videos()
+        self.repost_deleted_videos()
+
+    @transaction
+    def mark_deleted_videos(self):
+        """Find the downloaded videos that have been deleted from YouTube.
+        Returns the number of videos found.
 
-            submission = self.r.get_submission(v.redditSubmissionPermalink)
-            if self.check_replies(submission):
+        Queued videos are checked too.  It's too late to mirror those, but
+        their takedowns count towards the history of their channel."""
+        videos = self.db.query(Video).filter(
+            Video.state.in_([Video.DOWNLOADED, Video.PROBED])).all()
+        alive, unknown = self.checker.check(v.youtubeId for v in videos)
+
+        now = dt.datetime.now()
+        count = 0
+        missed = 0
+        for v in videos:
+            #
+            # If we couldn't check a video, try again on the next pass.
+            #
+            if v.youtubeId in alive or v.youtubeId in unknown:
                 continue
+            v.deleted = now
+            if v.state == Video.PROBED:
+                v.state = Video.STALE
+                missed += 1
+            else:
+                v.state = Video.DELETED
+                count += 1
+        logger.info("mark_deleted_videos: %d videos deleted", count)
+        if missed:
+            logger.info("mark_deleted_videos: %d queued videos missed",
+                        missed)
+            metrics.count("videos.missed", missed)
+        return count
 
-            self.repost_video(v)
-            if v.liveleakId is None:
+    def repost_deleted_videos(self):
+        """Repost the deleted videos to LiveLeak and comment on reddit.
+
+        Each video goes through a pipeline: check_replies, upload, publish
+        and comment.  Every stage has its own workers, so slow uploads
+        don't hold up the reddit calls.  The state of the video is saved
+        after each stage, and videos left halfway by an earlier pass pick
+        up where they stopped."""
+        meth_name = "repost_deleted_videos"
+        first_stage = {Video.DELETED: "check_replies",
+                       Video.UPLOADED: "publish",
+                       Video.PUBLISHED: "comment"}
+        videos = self.db.query(Video).filter(
+            Video.state.in_(first_stage.keys())).all()
+        replied = self.replied_submissions(
+            submission_id(v.redditSubmissionPermalink) for v in videos
+            if v.state == Video.DELETED)
+        jobs = []
+        for v in videos:
+            if (v.state == Video.DELETED and
+                    submission_id(v.redditSubmissionPermalink) in replied):
+                logger.info("%s: we have already replied to %s", meth_name,
+                            v.redditSubmissionPermalink)
+                v.state = Video.REPOSTED
                 continue
+            jobs.append((first_stage[v.state], RepostJob(v)))
+        self.db.commit()
+        if not jobs:
+            return
+        self.repost_pipeline = Pipeline([
+            Stage("check_replies", self._check_replies_stage,
+                  self.cfg.reply_workers),
+            Stage("upload", self._upload_stage, self.cfg.upload_workers),
+            Stage("publish", self._publish_stage, self.cfg.publish_workers),
+            Stage("comment", self._comment_stage, self.cfg.comment_workers)
+        ], self._repost_stage_done, self._repost_stage_failed,
+            self._repost_progress)
+        self.repost_pipeline.run(jobs)
 
-            self.post_comment(submission, v.liveleakId)
-            v.deleted = dt.datetime.now()
-            self.db.commit()
+    def _submission(self, job):
+        if job.submission is None:
+            with metrics.timer("reddit.get_submission"):
+                job.submission = self.r.get_submission(job.permalink)
+        return job.submission
+
+    def _check_replies_stage(self, job):
+        return self.check_replies(self._submission(job))
+
+    def _upload_stage(self, job):
+        """Returns the LiveLeak connection of the upload, or None if we
+        don't have the video."""
+        if not (job.local_path and P.isfile(job.local_path)):
+            return None
+        on_progress = functools.partial(self.repost_pipeline.progress,
+                                        "upload", job)
+        file_token, connection = self.uploader.upload(
+            job.local_path, job.upload_state, on_progress)
+        return connection
+
+    def _publish_stage(self, job):
+        meth_name = "_publish_stage"
+        submission = self._submission(job)
+        subreddit = submission.subreddit.display_name
+        body = "repost of http://youtube.com/watch?v=%s from %s" % (
+            job.youtube_id, submission.permalink)
+        logger.info("%s: %s", meth_name, body)
+        category = self.cfg.subreddits[subreddit]
+        return self.uploader.publish(submission.title, body, subreddit,
+                                     category, job.connection)
+
+    def _comment_stage(self, job):
+        return self.post_comment(self._submission(job), job.liveleak_id)
+
+    @transaction
+    def _repost_stage_done(self, stage_name, job, result):
+        """Save the outcome of a stage.  Returns the next stage."""
+        meth_name = "_repost_stage_done"
+        v = self.db.query(Video).filter_by(youtubeId=job.youtube_id).one()
+        v.localModified = dt.datetime.now()
+        if stage_name == "check_replies":
+            if result:
+                self.record_reply(job.submission.id)
+                v.state = Video.REPOSTED
+                return None
+            return "upload"
+        elif stage_name == "upload":
+            if result is None:
+                #
+                # If we don't have the video downloaded by now, there's
+                # nothing we can do.
+                #
+                logger.info("%s: giving up on %s", meth_name, job.youtube_id)
+                v.state = Video.STALE
+                return None
+            v.uploadState = None
+            v.liveleakConnection = job.connection = result
+            v.state = Video.UPLOADED
+            return "publish"
+        elif stage_name == "publish":
+            v.liveleakId = job.liveleak_id = result
+            v.state = Video.PUBLISHED
+            return "comment"
+        else:
+            if result is not None:
+                self.record_reply(job.submission.id, result.id)
+            v.state = Video.REPOSTED
+            return None
+
+    @transaction
+    def _repost_progress(self, stage_name, job, state):
+        """Save how far an upload has got, so it can be resumed."""
+        v = self.db.query(Video).filter_by(youtubeId=job.youtube_id).one()
+        v.uploadState = json.dumps(state)
+
+    def _repost_stage_failed(self, stage_name, job, ex):
+        logger.error("%s failed for %s", stage_name, job.youtube_id)
+        logger.exception(ex)
 
     @error_prone_praw_api_call
     def post_comment(self, submission, liveleak_id):
-        comment = (COMMENT_MIRROR % liveleak_id) + COMMENT_FOOTER
-        submission.add_comment(comment)
+        """Returns the comment we posted."""
+        text = (COMMENT_MIRROR % liveleak_id) + COMMENT_FOOTER
+        comment = submission.add_comment(text)
+        with self.replies_lock:
+            self.recent_replies.add(submission.id)
+        return comment
@@ -0,0 +1,277 @@
+"""Count and time the bot's operations, and report on them.
+
+Every operation (an external call, a database transaction) gets a counter
+of calls and errors and a histogram of latencies, keyed by a dotted name
+such as "reddit.get_submission" or "db.record_download":
+
+    @metrics.timed("youtube.download")
+    def download(...):
+        ...
+
+    with metrics.timer("reddit.get_new"):
+        ...
+
+Each pass of the bot gets numbers of its own: end_pass starts a new pass.
+log_summary and write_json report on the current pass, so they show where
+that pass spent its time.  write_prometheus reports the totals over the
+life of the process, which is what Prometheus expects."""
+
+import bisect
+import functools
+import json
+import logging
+import os
+import os.path as P
+import tempfile
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+#
+# The upper bounds of the histogram buckets, in seconds.  Covers everything
+# from a cached database query to a long upload.
+#
+BUCKETS = [0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+           30, 60, 300, 900]
+
+
+class Histogram(object):
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        #
+        # The last count is for values larger than the largest bucket.
+        #
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q):
+        """Estimate a quantile from the buckets.  Returns the upper bound of
+        the bucket it falls into, or max if it's beyond the last bucket."""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "mean": self.sum / self.count if self.count else 0.0,
+            "max": self.max,
+            "p50": self.quantile(0.5),
+            "p95": self.quantile(0.95),
+        }
+
+
+class Totals(object):
+    """The counters, error counts and histograms since started."""
+
+    def __init__(self, started):
+        self.started = started
+        self.counters = {}
+        self.histograms = {}
+        self.errors = {}
+
+    def count(self, name, amount):
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    def observe(self, name, seconds, error):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = Histogram()
+        histogram.observe(seconds)
+        if error:
+            self.errors[name] = self.errors.get(name, 0) + 1
+
+
+class Registry(object):
+    """Holds the totals for the life of the process and for the current
+    pass.  Thread-safe."""
+
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            now = self.clock()
+            self.total = Totals(now)
+            self.current = Totals(now)
+
+    def end_pass(self):
+        """Start counting the next pass from zero.  The totals for the
+        life of the process carry on."""
+        with self.lock:
+            self.current = Totals(self.clock())
+
+    def count(self, name, amount=1):
+        """Add to a plain counter, e.g. the number of bytes uploaded."""
+        with self.lock:
+            self.total.count(name, amount)
+            self.current.count(name, amount)
+
+    def observe(self, name, seconds, error=False):
+        """Record one call of an operation."""
+        with self.lock:
+            self.total.observe(name, seconds, error)
+            self.current.observe(name, seconds, error)
+
+    def timer(self, name):
+        return Timer(self, name)
+
+    def timed(self, name):
+        """Decorate a function to time each call to it."""
+        def decorator(func):
+            @functools.wraps(func)
+            def inner(*args, **kwargs):
+                with Timer(self, name):
+                    return func(*args, **kwargs)
+            return inner
+        return decorator
+
+    def iterate(self, name, iterable):
+        """Go through a lazy iterable, such as a reddit listing, recording
+        the time spent waiting for its items as a single call."""
+        elapsed = 0.0
+        error = False
+        iterator = iter(iterable)
+        try:
+            while True:
+                start = self.clock()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+                except Exception:
+                    error = True
+                    raise
+                finally:
+                    elapsed += self.clock() - start
+                yield item
+        finally:
+            self.observe(name, elapsed, error)
+
+    def snapshot(self):
+        """Return the metrics of the current pass as a dictionary that can
+        be serialized to JSON."""
+        with self.lock:
+            totals = self.current
+            operations = {}
+            for name, histogram in totals.histograms.items():
+                operations[name] = histogram.summary()
+                operations[name]["errors"] = totals.errors.get(name, 0)
+            return {
+                "started": totals.started,
+                "generated": self.clock(),
+                "counters": dict(totals.counters),
+                "operations": operations,
+            }
+
+    def prometheus(self, prefix="rlb"):
+        """Return the totals for the life of the process in the Prometheus
+        text format."""
+        lines = []
+        with self.lock:
+            totals = self.total
+            for name in sorted(totals.counters):
+                metric = "%s_%s_total" % (prefix, name.replace(".", "_"))
+                lines.append("# TYPE %s counter" % metric)
+                lines.append("%s %s" % (metric, totals.counters[name]))
+
+            family = "%s_operation_seconds" % prefix
+            if totals.histograms:
+                lines.append("# TYPE %s histogram" % family)
+            for name in sorted(totals.histograms):
+                histogram = totals.histograms[name]
+                cumulative = 0
+                for bound, count in zip(histogram.buckets + ["+Inf"],
+                                        histogram.counts):
+                    cumulative += count
+                    lines.append('%s_bucket{operation="%s",le="%s"} %d' % (
+                        family, name, bound, cumulative))
+                lines.append('%s_sum{operation="%s"} %f' % (
+                    family, name, histogram.sum))
+                lines.append('%s_count{operation="%s"} %d' % (
+                    family, name, histogram.count))
+
+            if totals.histograms:
+                lines.append("# TYPE %s_operation_errors_total counter" %
+                             prefix)
+            for name in sorted(totals.histograms):
+                lines.append('%s_operation_errors_total{operation="%s"} %d' %
+                             (prefix, name, totals.errors.get(name, 0)))
+        return "\n".join(lines) + "\n"
+
+    def write_json(self, path):
+        write_atomically(path, json.dumps(self.snapshot(), indent=2,
+                                          sort_keys=True))
+
+    def write_prometheus(self, path):
+        write_atomically(path, self.prometheus())
+
+    def log_summary(self, top=10):
+        """Log the operations that took the most time in total in the
+        current pass."""
+        meth_name = "log_summary"
+        with self.lock:
+            histograms = sorted(self.current.histograms.items(),
+                                key=lambda item: -item[1].sum)[:top]
+            for name, histogram in histograms:
+                logger.info("%s: %s: %d calls, %.1fs total, %.3fs max",
+                            meth_name, name, histogram.count, histogram.sum,
+                            histogram.max)
+
+
+class Timer(object):
+    """Times the block of a with statement.  An exception that escapes the
+    block counts as an error."""
+
+    def __init__(self, registry, name):
+        self.registry = registry
+        self.name = name
+
+    def __enter__(self):
+        self.start = self.registry.clock()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.registry.observe(self.name, self.registry.clock() - self.start,
+                              exc_type is not None)
+        return False
+
+
+def write_atomically(path, text):
+    """Write the file so that readers never see it half-written."""
+    fd, tmp_path = tempfile.mkstemp(dir=P.dirname(P.abspath(path)))
+    with os.fdopen(fd, "w") as fout:
+        fout.write(text)
+    os.chmod(tmp_path, 0644)
+    os.rename(tmp_path, path)
+
+
+#
+# The registry the bot uses.
+#
+REGISTRY = Registry()
+count = REGISTRY.count
+observe = REGISTRY.observe
+timer = REGISTRY.timer
+timed = REGISTRY.timed
+iterate = REGISTRY.iterate
+end_pass = REGISTRY.end_pass
@@ -0,0 +1,170 @@
+"""HTTP sessions shared by the LiveLeak and YouTube clients."""
+
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+from requests_toolbelt import MultipartEncoderMonitor
+
+
+#
+# The requests that are safe to send again.  A PUT is idempotent too, but
+# its body may be a stream that has already been read, e.g. an S3 part
+# going through an UploadProgress.  The callers that PUT retry on their
+# own.
+#
+RETRY_METHODS = frozenset(["HEAD", "GET", "OPTIONS"])
+
+
+class TimeoutAdapter(HTTPAdapter):
+    """Gives up on requests that get no response for timeout seconds,
+    unless the request sets a timeout of its own."""
+
+    def __init__(self, timeout=None, **kwargs):
+        self.timeout = timeout
+        HTTPAdapter.__init__(self, **kwargs)
+
+    def send(self, request, **kwargs):
+        if kwargs.get("timeout") is None:
+            kwargs["timeout"] = self.timeout
+        return HTTPAdapter.send(self, request, **kwargs)
+
+
+def create_retry(max_retries, backoff_factor):
+    kwargs = dict(total=max_retries, backoff_factor=backoff_factor,
+                  status_forcelist=[500, 502, 503, 504],
+                  raise_on_status=False)
+    #
+    # urllib3 1.26 renamed method_whitelist to allowed_methods.
+    #
+    if hasattr(Retry, "DEFAULT_ALLOWED_METHODS"):
+        kwargs["allowed_methods"] = RETRY_METHODS
+    else:
+        kwargs["method_whitelist"] = RETRY_METHODS
+    return Retry(**kwargs)
+
+
+def create_session(user_agent, pool_size=10, max_retries=3,
+                   backoff_factor=0.5, timeout=60):
+    """Create a session that keeps up to pool_size connections per host
+    alive, and retries failed requests with exponential backoff.
+
+    Only connection errors and the requests in RETRY_METHODS are retried,
+    so a POST doesn't get sent twice.  A request that gets no response for
+    timeout seconds fails instead of hanging."""
+    session = requests.Session()
+    session.headers["User-Agent"] = user_agent
+    adapter = TimeoutAdapter(timeout, pool_connections=pool_size,
+                             pool_maxsize=pool_size,
+                             max_retries=create_retry(max_retries,
+                                                      backoff_factor))
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+class RateLimiter(object):
+    """Lets through at most rate calls (or bytes) per second on average,
+    across all threads.  Allows bursts of up to burst."""
+
+    def __init__(self, rate, burst=1, clock=time.time, sleep=time.sleep):
+        self.rate = float(rate)
+        self.burst = burst
+        self.clock = clock
+        self.sleep = sleep
+        self.tokens = float(burst)
+        self.updated = clock()
+        self.lock = threading.Lock()
+
+    def acquire(self, amount=1):
+        """Block until amount more is allowed.  An amount larger than the
+        burst goes through once the bucket is full, and the calls that
+        follow wait until it's paid off."""
+        needed = min(amount, self.burst)
+        while True:
+            with self.lock:
+                now = self.clock()
+                self.tokens = min(self.burst, self.tokens +
+                                  (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= needed:
+                    self.tokens -= amount
+                    return
+                wait = (needed - self.tokens) / self.rate
+            self.sleep(wait)
+
+
+class UploadProgress(object):
+    """Throttles an upload and measures its throughput.
+
+    Wrap the request body with monitor (for a MultipartEncoder) or reader
+    (for a plain string).  The body then passes each block it sends
+    through the limiter, if there is one, so that uploads don't take up
+    all of our bandwidth.  Share the limiter between uploads to cap their
+    total rate."""
+
+    def __init__(self, limiter=None, clock=time.time):
+        self.limiter = limiter
+        self.clock = clock
+        self.bytes_sent = 0
+        self.started = clock()
+        self.finished = None
+
+    def __repr__(self):
+        return "<UploadProgress(bytes_sent=%d, elapsed=%.1f)>" % (
+            self.bytes_sent, self.elapsed)
+
+    def sent(self, nbytes):
+        if self.limiter and nbytes:
+            self.limiter.acquire(nbytes)
+        self.bytes_sent += nbytes
+
+    def monitor(self, encoder):
+        """Return a MultipartEncoderMonitor that reports to this object."""
+        last = [0]
+
+        def callback(monitor):
+            self.sent(monitor.bytes_read - last[0])
+            last[0] = monitor.bytes_read
+        return MultipartEncoderMonitor(encoder, callback)
+
+    def reader(self, data):
+        """Return a file-like object that streams data and reports to this
+        object."""
+        return ThrottledReader(data, self)
+
+    def finish(self):
+        self.finished = self.clock()
+
+    @property
+    def elapsed(self):
+        return (self.finished or self.clock()) - self.started
+
+    @property
+    def throughput(self):
+        """The average rate of the upload in bytes per second."""
+        elapsed = self.elapsed
+        return self.bytes_sent / elapsed if elapsed > 0 else 0.0
+
+
+class ThrottledReader(object):
+    """Reads a string in blocks, reporting each to an UploadProgress."""
+
+    def __init__(self, data, progress):
+        self.data = data
+        self.progress = progress
+        self.offset = 0
+        #
+        # requests uses this for the Content-Length header.
+        #
+        self.len = len(data)
+
+    def read(self, size=-1):
+        if size < 0:
+            size = len(self.data) - self.offset
+        block = self.data[self.offset:self.offset + size]
+        self.offset += len(block)
+        self.progress.sent(len(block))
+        return block
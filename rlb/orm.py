@@ -1,8 +1,12 @@
 import os.path as P
 import datetime
-from sqlalchemy import Column, Integer, String, DateTime
+import logging
+from sqlalchemy import Column, Integer, String, DateTime, Float, Index, \
+    inspect
 from sqlalchemy.ext.declarative import declarative_base
 
+logger = logging.getLogger(__name__)
+
 Base = declarative_base()
 
 
@@ -11,6 +15,17 @@ class Subreddit(Base):
     id = Column(String, primary_key=True)
     mostRecentSubmission = Column(DateTime)
     mostRecentComment = Column(DateTime)
+    #
+    # The fullname (e.g. t3_2auyay) and created_utc of the newest submission
+    # we've seen.  The next scan only asks reddit for newer submissions.
+    #
+    newestSubmission = Column(String)
+    newestSubmissionCreated = Column(Float)
+    #
+    # When we last checked that the newest submission is still there (a
+    # UTC timestamp); see Bot.cursor_gone.
+    #
+    newestSubmissionChecked = Column(Float)
 
     def __init__(self, id):
         self.id = id
@@ -19,8 +34,9 @@ class Subreddit(Base):
 
     def __repr__(self):
         return "<Subreddit(id=%s, mostRecentSubmission=%s,\
-mostRecentComment=%s)>" % (repr(self.id), repr(self.mostRecentSubmission),
-                           repr(self.mostRecentComment))
+mostRecentComment=%s, newestSubmission=%s)>" % (
+            repr(self.id), repr(self.mostRecentSubmission),
+            repr(self.mostRecentComment), repr(self.newestSubmission))
 
 
 class Video(Base):
@@ -29,13 +45,60 @@ class Video(Base):
     STALE = 4
     ERROR = 5
     PURGED = 6
+    #
+    # The stages of reposting a video that has been deleted from YouTube.
+    # A video moves from DELETED to UPLOADED to PUBLISHED to REPOSTED, so
+    # if something goes wrong halfway, we can pick up where we stopped.
+    #
+    DELETED = 7
+    UPLOADED = 8
+    PUBLISHED = 9
+    #
+    # Over the limits of the format policy, so not downloaded; see
+    # skipReason.
+    #
+    SKIPPED = 10
+    #
+    # Known from its metadata only, waiting for its turn to be downloaded,
+    # highest priority first; see Bot.download_queued.
+    #
+    PROBED = 11
 
     __tablename__ = "videos"
+    #
+    # Most queries filter by state.  The leading column of the composite
+    # index serves those, so a separate index on state isn't necessary.
+    #
+    __table_args__ = (
+        Index("ix_videos_state_discovered", "state", "discovered"),
+        Index("ix_videos_state_priority", "state", "priority"),
+    )
     youtubeId = Column(String, primary_key=True)
     redditSubmissionPermalink = Column(String)
     downloadAttempts = Column(Integer)
     localPath = Column(String)
-    liveleakId = Column(String)
+    liveleakId = Column(String, index=True)
+    liveleakConnection = Column(String)
+    #
+    # JSON describing a multipart upload to LiveLeak that hasn't finished
+    # yet, so that it can be resumed; see liveleak.Uploader.upload.
+    #
+    uploadState = Column(String)
+    #
+    # Why we didn't download the video, e.g. "duration 5400s over 1800s".
+    #
+    skipReason = Column(String)
+    #
+    # What we know about a video before downloading it: the YouTube
+    # channel it's on, when it was published and how long it is (in
+    # seconds), and the score of the submission that linked to it.  The
+    # priority of the download is worked out from these; see priority.py.
+    #
+    channelId = Column(String, index=True)
+    published = Column(DateTime)
+    duration = Column(Integer)
+    redditScore = Column(Integer)
+    priority = Column(Float)
     state = Column(Integer)
     discovered = Column(DateTime)
     localModified = Column(DateTime)
@@ -52,3 +115,46 @@ class Video(Base):
 
     def has_file(self):
         return self.localPath and P.isfile(self.localPath)
+
+
+class Reply(Base):
+    """A submission we've commented on."""
+    __tablename__ = "replies"
+    #
+    # The base36 ID of the submission, e.g. 2auyay, and of our comment.
+    #
+    redditSubmissionId = Column(String, primary_key=True)
+    redditCommentId = Column(String)
+    posted = Column(DateTime)
+
+    def __init__(self, submission_id, comment_id=None):
+        self.redditSubmissionId = submission_id
+        self.redditCommentId = comment_id
+        self.posted = datetime.datetime.now()
+
+    def __repr__(self):
+        return "<Reply(redditSubmissionId=%s, redditCommentId=%s)>" % (
+            repr(self.redditSubmissionId), repr(self.redditCommentId))
+
+
+def upgrade(engine):
+    """Bring the schema of an existing database up to date.
+    Creates any missing tables, columns and indexes."""
+    meth_name = "upgrade"
+    Base.metadata.create_all(engine)
+    inspector = inspect(engine)
+    for table in Base.metadata.sorted_tables:
+        existing = set(c["name"] for c in inspector.get_columns(table.name))
+        for column in table.columns:
+            if column.name not in existing:
+                logger.info("%s: adding column %s.%s",
+                            meth_name, table.name, column.name)
+                engine.execute('ALTER TABLE %s ADD COLUMN "%s" %s' % (
+                    table.name, column.name,
+                    column.type.compile(dialect=engine.dialect)))
+
+        existing = set(i["name"] for i in inspector.get_indexes(table.name))
+        for index in table.indexes:
+            if index.name not in existing:
+                logger.info("%s: creating index %s", meth_name, index.name)
+                index.create(engine)
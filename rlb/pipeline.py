@@ -0,0 +1,111 @@
+"""Run jobs through a sequence of stages, each with its own workers."""
+
+import logging
+import threading
+from Queue import Queue
+
+logger = logging.getLogger(__name__)
+
+#
+# Tells a worker to exit.
+#
+STOP = object()
+
+#
+# The kinds of messages the workers send back to the calling thread.
+#
+RESULT = "result"
+ERROR = "error"
+PROGRESS = "progress"
+
+
+class Stage(object):
+
+    def __init__(self, name, func, workers=1):
+        """func gets called with a job from one of the stage's worker
+        threads, and returns the result of the stage."""
+        self.name = name
+        self.func = func
+        self.workers = workers
+        self.queue = Queue()
+
+    def __repr__(self):
+        return "<Stage(name=%s, workers=%d)>" % (repr(self.name), self.workers)
+
+
+class Pipeline(object):
+    """Runs jobs through stages.
+
+    Every stage has its own queue and pool of worker threads, so a slow
+    stage (e.g. uploading a large file) doesn't hold up the jobs that are
+    in the other stages.
+
+    The results are handled by the thread that called run, one at a time:
+    on_result(stage_name, job, result) is called after a stage succeeds,
+    and returns the name of the stage the job goes to next, or None if the
+    job is done.  on_error(stage_name, job, exception) is called when a
+    stage raises, and the job goes no further.  Stages that take a while
+    can report how far they've got through progress, which leads to a call
+    to on_progress(stage_name, job, info)."""
+
+    def __init__(self, stages, on_result, on_error, on_progress=None):
+        self.stages = dict((stage.name, stage) for stage in stages)
+        self.on_result = on_result
+        self.on_error = on_error
+        self.on_progress = on_progress
+        self.results = Queue()
+
+    def progress(self, stage_name, job, info):
+        """Called from a worker thread to hand info to on_progress."""
+        self.results.put((PROGRESS, stage_name, job, info))
+
+    def run(self, jobs):
+        """Run the jobs, which are (stage_name, job) pairs, and wait for
+        all of them to finish."""
+        threads = []
+        for stage in self.stages.values():
+            for _ in range(stage.workers):
+                thread = threading.Thread(target=self._work, args=(stage,))
+                thread.daemon = True
+                thread.start()
+                threads.append(thread)
+
+        pending = 0
+        for stage_name, job in jobs:
+            self.stages[stage_name].queue.put(job)
+            pending += 1
+
+        try:
+            while pending:
+                kind, stage_name, job, value = self.results.get()
+                if kind is PROGRESS:
+                    if self.on_progress:
+                        self.on_progress(stage_name, job, value)
+                    continue
+                elif kind is RESULT:
+                    next_stage = self.on_result(stage_name, job, value)
+                else:
+                    self.on_error(stage_name, job, value)
+                    next_stage = None
+                if next_stage is None:
+                    pending -= 1
+                else:
+                    self.stages[next_stage].queue.put(job)
+        finally:
+            for stage in self.stages.values():
+                for _ in range(stage.workers):
+                    stage.queue.put(STOP)
+            for thread in threads:
+                thread.join()
+
+    def _work(self, stage):
+        while True:
+            job = stage.queue.get()
+            if job is STOP:
+                return
+            try:
+                result = stage.func(job)
+            except Exception as ex:
+                self.results.put((ERROR, stage.name, job, ex))
+            else:
+                self.results.put((RESULT, stage.name, job, result))
@@ -0,0 +1,51 @@
+"""Decide which videos to download first, when downloads are deferred.
+
+Only a small share of the videos we find ever get deleted from YouTube, so
+the bandwidth and disk go first to the videos most likely to need a
+mirror.  The priority of a video combines:
+
+ - the weight of the subreddit it was submitted to (priority_weight in the
+   config), e.g. to favour subreddits whose videos often get taken down
+ - how fast its submission is gaining score, since popular videos draw
+   takedown requests
+ - how often videos from its YouTube channel have been taken down before
+ - how recently it was published: takedowns mostly come soon after upload
+
+Priorities are on a log scale, and, like reddit's "hot" ranking, newer
+videos get a bonus that grows with time instead of older videos decaying.
+A stored priority therefore stays comparable to the ones computed later,
+and the queue never has to be re-sorted."""
+
+import calendar
+import math
+
+#
+# The priority of a submission's score is based on points per hour, with
+# submissions younger than this treated as this old, so that a brand new
+# submission with a couple of points doesn't jump the queue.
+#
+MIN_SUBMISSION_AGE = 3600.0
+
+
+def channel_risk(takedowns, videos):
+    """Estimate how likely a video from a channel is to be taken down,
+    given that takedowns of the videos we've seen from it were.  Unknown
+    channels come out at 0.5."""
+    return (takedowns + 1.0) / (videos + 2.0)
+
+
+def priority(published, subreddit_weight=1.0, reddit_score=0,
+             submission_age=0, takedowns=0, channel_videos=0,
+             half_life_hours=24):
+    """Return the priority of downloading a video.  Higher goes first.
+
+    published is when the video was published (a UTC datetime), and
+    submission_age the age of the submission in seconds.  The priority of
+    a video halves for every half_life_hours it was published earlier."""
+    velocity = max(reddit_score, 0) / (
+        max(submission_age, MIN_SUBMISSION_AGE) / 3600.0)
+    return (math.log(max(subreddit_weight, 1e-6)) +
+            math.log1p(velocity) +
+            math.log(2 * channel_risk(takedowns, channel_videos)) +
+            calendar.timegm(published.utctimetuple()) * math.log(2) /
+            (half_life_hours * 3600.0))
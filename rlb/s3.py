@@ -0,0 +1,187 @@
+"""Resumable multipart uploads to S3 or an S3-compatible service.
+
+http://docs.aws.amazon.com/AmazonS3/latest/dev/mpuoverview.html"""
+
+import os.path as P
+import time
+import logging
+import xml.etree.ElementTree as ET
+from xml.sax.saxutils import escape
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+#
+# S3 requires all parts but the last to be at least 5MB.
+#
+MIN_PART_SIZE = 5 * 1024 * 1024
+PART_SIZE = 8 * 1024 * 1024
+
+
+class S3Exception(Exception):
+    pass
+
+
+class NoSuchUpload(S3Exception):
+    """The upload has been aborted, completed or has expired, so it can't
+    be resumed."""
+    pass
+
+
+def find_text(root, tag):
+    """Return the text of the first element with the tag, ignoring XML
+    namespaces, or None if there is no such element."""
+    for element in root.iter():
+        if element.tag == tag or element.tag.endswith("}" + tag):
+            return element.text
+    return None
+
+
+def find_all(root, tag):
+    return [element for element in root.iter()
+            if element.tag == tag or element.tag.endswith("}" + tag)]
+
+
+class MultipartUpload(object):
+    """Uploads a file to url in fixed-size parts.
+
+    Each part is retried on its own, so a failure only costs the part that
+    was in flight.  Create the object with the upload_id of an earlier,
+    interrupted upload to resume it: the parts that S3 has already
+    confirmed don't get sent again."""
+
+    def __init__(self, session, url, upload_id=None, part_size=PART_SIZE,
+                 max_retries=3, backoff=1.0, sleep=time.sleep):
+        self.session = session
+        self.url = url
+        self.upload_id = upload_id
+        self.part_size = part_size
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.sleep = sleep
+
+    def __repr__(self):
+        return "<MultipartUpload(url=%s, upload_id=%s)>" % (
+            repr(self.url), repr(self.upload_id))
+
+    @metrics.timed("s3.start")
+    def start(self):
+        """Start a new upload.  Returns its ID."""
+        r = self.session.post(self.url, params={"uploads": ""})
+        self._check(r, "start")
+        self.upload_id = find_text(ET.fromstring(r.content), "UploadId")
+        if not self.upload_id:
+            raise S3Exception("start: no UploadId in response")
+        logger.info("start: %s", self.upload_id)
+        return self.upload_id
+
+    @metrics.timed("s3.list_parts")
+    def uploaded_parts(self):
+        """Return a dictionary of the parts S3 has confirmed, keyed by part
+        number.  The values are (etag, size) tuples."""
+        parts = {}
+        marker = 0
+        while True:
+            r = self.session.get(self.url, params={
+                "uploadId": self.upload_id, "part-number-marker": marker})
+            self._check(r, "uploaded_parts")
+            root = ET.fromstring(r.content)
+            for part in find_all(root, "Part"):
+                number = int(find_text(part, "PartNumber"))
+                parts[number] = (find_text(part, "ETag"),
+                                 int(find_text(part, "Size")))
+            if find_text(root, "IsTruncated") != "true":
+                return parts
+            marker = int(find_text(root, "NextPartNumberMarker"))
+
+    def upload(self, path, on_part=None, progress=None):
+        """Upload the file, starting a new upload if necessary.
+
+        on_part(part_number, part_count) gets called after each part is
+        confirmed.  The parts are streamed through progress, a
+        net.UploadProgress, if given.  Returns the body of the response to
+        the final request, which describes the uploaded object."""
+        meth_name = "upload"
+        if self.upload_id is None:
+            self.start()
+            uploaded = {}
+        else:
+            uploaded = self.uploaded_parts()
+
+        size = P.getsize(path)
+        part_count = max(1, (size + self.part_size - 1) // self.part_size)
+        etags = []
+        with open(path, "rb") as fin:
+            for number in range(1, part_count + 1):
+                offset = (number - 1) * self.part_size
+                length = min(self.part_size, size - offset)
+                if number in uploaded and uploaded[number][1] == length:
+                    etags.append(uploaded[number][0])
+                    continue
+                fin.seek(offset)
+                etags.append(self._upload_part(number, fin.read(length),
+                                               progress))
+                logger.debug("%s: part %d of %d done", meth_name, number,
+                             part_count)
+                if on_part:
+                    on_part(number, part_count)
+        logger.info("%s: %s: %d parts, %d resumed", meth_name, path,
+                    part_count, len(uploaded))
+        return self.complete(etags)
+
+    def _upload_part(self, number, data, progress=None):
+        """Upload a part, retrying with exponential backoff.  Returns the
+        ETag of the part."""
+        meth_name = "_upload_part"
+        params = {"partNumber": number, "uploadId": self.upload_id}
+        for attempt in range(self.max_retries + 1):
+            try:
+                body = progress.reader(data) if progress else data
+                with metrics.timer("s3.upload_part"):
+                    r = self.session.put(self.url, params=params, data=body)
+                if r.status_code == 404:
+                    raise NoSuchUpload("%s: %s" % (meth_name, self.upload_id))
+                if r.status_code == 200:
+                    return r.headers["ETag"]
+                logger.warning("%s: part %d: bad HTTP response (%d)",
+                               meth_name, number, r.status_code)
+            except NoSuchUpload:
+                raise
+            except Exception as ex:
+                logger.warning("%s: part %d: %s", meth_name, number, ex)
+            if attempt < self.max_retries:
+                self.sleep(self.backoff * 2 ** attempt)
+        raise S3Exception("%s: part %d failed after %d attempts" % (
+            meth_name, number, self.max_retries + 1))
+
+    @metrics.timed("s3.complete")
+    def complete(self, etags):
+        parts = "".join(
+            "<Part><PartNumber>%d</PartNumber><ETag>%s</ETag></Part>" % (
+                number, escape(etag))
+            for (number, etag) in enumerate(etags, 1))
+        body = ("<CompleteMultipartUpload>%s</CompleteMultipartUpload>" %
+                parts)
+        r = self.session.post(self.url, params={"uploadId": self.upload_id},
+                              data=body)
+        self._check(r, "complete")
+        #
+        # S3 can report an error in the body of a 200 response.
+        #
+        if find_text(ET.fromstring(r.content), "Code"):
+            raise S3Exception("complete: %s" % r.text)
+        return r.text
+
+    def abort(self):
+        r = self.session.delete(self.url,
+                                params={"uploadId": self.upload_id})
+        if r.status_code not in (204, 404):
+            self._check(r, "abort")
+
+    def _check(self, r, meth_name):
+        if r.status_code == 404 and self.upload_id:
+            raise NoSuchUpload("%s: %s" % (meth_name, self.upload_id))
+        if r.status_code != 200:
+            raise S3Exception("%s: bad HTTP response (%d)" % (
+                meth_name, r.status_code))
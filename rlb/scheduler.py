@@ -0,0 +1,67 @@
+"""Run tasks periodically from within a single long-lived process."""
+
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class Task(object):
+
+    def __init__(self, name, interval, func, next_run):
+        self.name = name
+        self.interval = interval
+        self.func = func
+        self.next_run = next_run
+
+    def __repr__(self):
+        return "<Task(name=%s, interval=%s, next_run=%s)>" % (
+            repr(self.name), repr(self.interval), repr(self.next_run))
+
+
+class Scheduler(object):
+    """Runs each task every interval seconds.
+
+    Tasks run one at a time, in the order they were added.
+    If a task takes longer than its interval, the missed runs are skipped
+    rather than queued up.  An exception in one task is logged and doesn't
+    affect the others."""
+
+    def __init__(self, clock=time.time, sleep=time.sleep):
+        self.clock = clock
+        self.sleep = sleep
+        self.tasks = []
+
+    def add(self, name, interval, func):
+        """Schedule func to run every interval seconds, starting now.
+        Tasks with a non-positive interval are disabled."""
+        if interval <= 0:
+            logger.info("add: task %s is disabled", name)
+            return
+        self.tasks.append(Task(name, interval, func, self.clock()))
+
+    def run_pending(self):
+        """Run all the tasks that are due.
+        Returns the number of seconds until the next task is due."""
+        meth_name = "run_pending"
+        for task in self.tasks:
+            if task.next_run > self.clock():
+                continue
+            logger.info("%s: running %s", meth_name, task.name)
+            start = self.clock()
+            try:
+                task.func()
+            except Exception as ex:
+                logger.exception(ex)
+            end = self.clock()
+            logger.info("%s: %s took %.1fs", meth_name, task.name, end - start)
+            task.next_run = max(task.next_run + task.interval, end)
+        if not self.tasks:
+            return None
+        return max(0, min(t.next_run for t in self.tasks) - self.clock())
+
+    def run_forever(self):
+        if not self.tasks:
+            raise ValueError("nothing to schedule")
+        while True:
+            self.sleep(self.run_pending())
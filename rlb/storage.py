@@ -0,0 +1,205 @@
+"""Keep track of the downloaded video files."""
+
+import errno
+import os
+import os.path as P
+import logging
+import shutil
+import threading
+
+logger = logging.getLogger(__name__)
+
+#
+# Files that youtube-dl is still working on.
+#
+PARTIAL_EXTENSIONS = [".part", ".ytdl", ".temp"]
+
+
+def video_id_from_filename(filename):
+    """Return the YouTube ID a video file was saved under, or None if the
+    file isn't a complete video."""
+    for ext in PARTIAL_EXTENSIONS:
+        if filename.endswith(ext):
+            return None
+    youtube_id = filename.split(".", 1)[0]
+    return youtube_id or None
+
+
+def video_dir(dest_dir, youtube_id, sharded):
+    """Return the directory a video is stored in.
+
+    With the sharded layout, videos go into two levels of subdirectories
+    named after the start of their ID, e.g. dest_dir/IU/5N/IU5NSSzYygk.mp4,
+    so that no single directory gets too large."""
+    if not sharded:
+        return dest_dir
+    return P.join(dest_dir, youtube_id[:2], youtube_id[2:4])
+
+
+def file_size(path):
+    try:
+        return P.getsize(path)
+    except OSError:
+        return 0
+
+
+def remove_file(path):
+    """Delete a file.  Returns the number of bytes freed."""
+    try:
+        size = P.getsize(path)
+        os.remove(path)
+    except OSError as ose:
+        if ose.errno != errno.ENOENT:
+            logger.exception(ose)
+        return 0
+    logger.info("remove_file: removed %s", path)
+    return size
+
+
+def ensure_dir(path):
+    """Create the directory unless it exists already.  Safe to call from
+    several threads at once."""
+    try:
+        os.makedirs(path)
+    except OSError:
+        if not P.isdir(path):
+            raise
+
+
+def list_dirs(path):
+    return [P.join(path, d) for d in os.listdir(path)
+            if P.isdir(P.join(path, d))]
+
+
+def shard_directory(dest_dir):
+    """Move the videos in a flat directory into the sharded layout.
+    Returns the number of files moved."""
+    moved = 0
+    for f in os.listdir(dest_dir):
+        src = P.join(dest_dir, f)
+        youtube_id = video_id_from_filename(f)
+        if youtube_id is None or not P.isfile(src):
+            continue
+        subdir = video_dir(dest_dir, youtube_id, True)
+        ensure_dir(subdir)
+        shutil.move(src, P.join(subdir, f))
+        moved += 1
+    logger.info("shard_directory: moved %d videos", moved)
+    return moved
+
+
+class VideoIndex(object):
+    """An in-memory index of the video files in a directory, keyed by YouTube
+    ID.
+
+    Build it once, then keep it up to date with add and discard as files
+    come and go, so that looking up a video doesn't need to list the
+    directory.  The download workers update it, so it's thread-safe."""
+
+    def __init__(self, dest_dir, sharded=False):
+        self.dest_dir = dest_dir
+        self.sharded = sharded
+        self.lock = threading.Lock()
+        self.paths = {}
+        #
+        # The sizes of the files, keyed by YouTube ID, or None until
+        # total_bytes is first asked for.
+        #
+        self.sizes = None
+        self._total_bytes = 0
+        self.rebuild()
+
+    def video_dir(self, youtube_id):
+        """Return the directory the video should be downloaded to."""
+        return video_dir(self.dest_dir, youtube_id, self.sharded)
+
+    def rebuild(self):
+        """Rebuild the index from scratch by listing the directory.  This
+        doesn't stat the files; see total_bytes."""
+        paths = {}
+        if not P.isdir(self.dest_dir):
+            subdirs = []
+        elif self.sharded:
+            subdirs = [d for top in list_dirs(self.dest_dir)
+                       for d in list_dirs(top)]
+        else:
+            subdirs = [self.dest_dir]
+        for subdir in subdirs:
+            for f in os.listdir(subdir):
+                youtube_id = video_id_from_filename(f)
+                if youtube_id:
+                    paths[youtube_id] = P.join(subdir, f)
+        with self.lock:
+            self.paths = paths
+            self.sizes = None
+        logger.info("rebuild: %d videos in %s", len(paths), self.dest_dir)
+
+    @property
+    def total_bytes(self):
+        """The total size of the video files.  Working it out stats every
+        file, so that's only done the first time it's asked for, e.g. when
+        a DiskBudget has a max_bytes.  add and discard keep it up to date
+        from then on."""
+        with self.lock:
+            if self.sizes is None:
+                self.sizes = dict((youtube_id, file_size(path))
+                                  for (youtube_id, path) in self.paths.items())
+                self._total_bytes = sum(self.sizes.values())
+            return self._total_bytes
+
+    def locate(self, youtube_id):
+        """Return the path to the video file, or None if we don't have it."""
+        return self.paths.get(youtube_id)
+
+    def add(self, youtube_id, path):
+        """Add a video file we know the path of, e.g. one the download
+        engine has just saved."""
+        with self.lock:
+            self._discard(youtube_id)
+            self.paths[youtube_id] = path
+            if self.sizes is not None:
+                size = file_size(path)
+                self.sizes[youtube_id] = size
+                self._total_bytes += size
+
+    def discard(self, youtube_id):
+        """Remove a video from the index, e.g. after its file was deleted."""
+        with self.lock:
+            self._discard(youtube_id)
+
+    def _discard(self, youtube_id):
+        self.paths.pop(youtube_id, None)
+        if self.sizes is not None:
+            self._total_bytes -= self.sizes.pop(youtube_id, 0)
+
+    def __contains__(self, youtube_id):
+        return youtube_id in self.paths
+
+    def __len__(self):
+        return len(self.paths)
+
+
+class DiskBudget(object):
+    """Limits how much disk space the downloaded videos may use.
+
+    max_bytes limits the total size of the videos in the index.
+    min_free_percent is the share of the volume that must be kept free.
+    Zero disables either limit."""
+
+    def __init__(self, max_bytes=0, min_free_percent=0):
+        self.max_bytes = max_bytes
+        self.min_free_percent = min_free_percent
+
+    def excess(self, index):
+        """Return the number of bytes that must be freed to get back within
+        the budget, or zero if the budget isn't exceeded."""
+        excess = 0
+        if self.max_bytes:
+            excess = max(excess, index.total_bytes - self.max_bytes)
+        if self.min_free_percent:
+            st = os.statvfs(index.dest_dir)
+            size = st.f_blocks * st.f_frsize
+            free = st.f_bavail * st.f_frsize
+            wanted = int(size * self.min_free_percent / 100.0)
+            excess = max(excess, wanted - free)
+        return excess
@@ -0,0 +1,74 @@
+import copy
+import unittest
+
+from rlb.benchmark import Benchmark, Scale, compare, make_submissions
+from rlb.fakes import FakeReddit
+
+
+class TestFakeReddit(unittest.TestCase):
+
+    def setUp(self):
+        self.reddit = FakeReddit()
+        for data in make_submissions(Scale(2, 3, 6), now=1000):
+            self.reddit.add_submission(data)
+
+    def test_get_new(self):
+        subreddit = self.reddit.get_subreddit("UkrainianConflict0")
+        created = [s.created_utc for s in subreddit.get_new(limit=10)]
+        self.assertEquals(created, [998, 996, 994])
+
+    def test_get_new_before(self):
+        #
+        # Like reddit, only the submissions that came just after the
+        # cursor.
+        #
+        oldest = min(self.reddit.submissions.values(),
+                     key=lambda s: s.created_utc)
+        subreddit = self.reddit.get_subreddit(
+            "UkrainianConflict0+UkrainianConflict1")
+        created = [s.created_utc for s in subreddit.get_new(
+            limit=2, params={"before": oldest.fullname})]
+        self.assertEquals(created, [996, 995])
+
+    def test_comments(self):
+        submission = self.reddit.submissions.values()[0]
+        comment = submission.add_comment("text")
+        self.assertEquals([c.id for c in self.reddit.user.get_comments()],
+                          [comment.id])
+        self.assertEquals(comment.link_id, submission.fullname)
+
+
+class TestBenchmark(unittest.TestCase):
+
+    def test_run(self):
+        results = Benchmark(Scale(2, 5, 4, 0.5, 1024)).run()
+        self.assertEquals(results["reposted"], 2)
+        scan = results["phases"]["scan_subreddits"]
+        self.assertEquals(scan["requests"]["youtube-dl"], 4)
+        self.assertTrue(scan["queries"] > 0)
+        self.assertEquals(compare(results, results), [])
+
+    def test_run_deferred(self):
+        results = Benchmark(Scale(2, 5, 4, 0.5, 1024), deferred=True).run()
+        self.assertEquals(results["reposted"], 0)
+        phases = results["phases"]
+        self.assertEquals(phases["scan_subreddits"]["requests"]["youtube-dl"],
+                          0)
+        self.assertEquals(phases["download_queued"]["requests"]["youtube-dl"],
+                          2)
+
+    def test_compare(self):
+        baseline = {"scale": {}, "latency": 0, "reposted": 1, "phases": {
+            "purge": {"seconds": 10.0, "total_requests": 5, "queries": 3,
+                      "peak_rss_kb": 10000}}}
+        results = copy.deepcopy(baseline)
+        results["phases"]["purge"]["seconds"] = 11.0
+        self.assertEquals(compare(results, baseline, 0.25), [])
+        results["phases"]["purge"]["seconds"] = 13.0
+        results["phases"]["purge"]["queries"] = 4
+        self.assertEquals(len(compare(results, baseline, 0.25)), 2)
+
+    def test_compare_scale(self):
+        baseline = {"scale": {"videos": 1}, "latency": 0, "phases": {}}
+        results = {"scale": {"videos": 2}, "latency": 0, "phases": {}}
+        self.assertRaises(ValueError, compare, results, baseline)
@@ -1,9 +1,14 @@
 import unittest
+import mock
 import nose.tools
+import os
 import os.path as P
+import tempfile
 
 import rlb.main
 import rlb.liveleak
+import rlb.net
+from rlb.fakes import FakeS3
 
 CURRENT_DIR = P.dirname(P.abspath(__file__))
 
@@ -35,6 +40,90 @@ class TestUpload(unittest.TestCase):
     #
 
 
+class TestLogin(unittest.TestCase):
+
+    def setUp(self):
+        self.session = mock.Mock()
+        self.up = rlb.liveleak.Uploader("user_agent", self.session)
+
+    def test_login(self):
+        cookies = ["PHPSESSID", "liveleak_safe_mode",
+                   "liveleak_use_old_player", "liveleak_user_password",
+                   "liveleak_user_token", "user-agent"]
+        self.session.post.return_value = mock.Mock(
+            status_code=200, cookies=dict((c, "dummy") for c in cookies))
+        self.up.login("username", "password")
+        self.assertEquals(self.session.post.call_count, 1)
+
+    def test_login_failure(self):
+        self.session.post.return_value = mock.Mock(status_code=200,
+                                                   cookies={})
+        self.assertRaises(rlb.liveleak.LiveLeakException,
+                          self.up.login, "username", "password")
+
+
+class TestResumeUpload(unittest.TestCase):
+
+    def setUp(self):
+        self.s3 = FakeS3().start()
+        self.addCleanup(self.s3.stop)
+        self.session = rlb.net.create_session("user_agent")
+        #
+        # Send the requests for LiveLeak itself to a mock.
+        #
+        s3_get = self.session.get
+        self.liveleak_get = mock.Mock(return_value=mock.Mock(
+            status_code=200, text='{"success": 1, "file_token": "token"}'))
+        self.session.get = lambda url, **kwargs: (
+            s3_get if url.startswith(self.s3.base_url)
+            else self.liveleak_get)(url, **kwargs)
+
+        self.up = rlb.liveleak.Uploader("user_agent", self.session,
+                                        self.s3.base_url + "/", 1024)
+        self.data = os.urandom(2500)
+        fd, self.path = tempfile.mkstemp()
+        with os.fdopen(fd, "wb") as fout:
+            fout.write(self.data)
+        self.addCleanup(os.remove, self.path)
+
+    def test_part_failure(self):
+        #
+        # The uploader retries the part, without urllib3 sending the
+        # already-read body again.
+        #
+        self.s3.failures = 1
+        result = self.up.upload(self.path, {
+            "key": "dir/video.mp4", "filename": "video.mp4",
+            "connect_string": "connect", "connection": "conn",
+            "upload_id": None})
+
+        self.assertEquals(result, ("token", "conn"))
+        self.assertEquals(self.s3.objects["dir/video.mp4"], self.data)
+        self.assertEquals(self.s3.part_requests, 4)
+
+    def test_resume(self):
+        upload = rlb.s3.MultipartUpload(
+            self.session, self.s3.base_url + "/dir/video.mp4",
+            part_size=1024)
+        upload.start()
+        upload._upload_part(1, self.data[:1024])
+        state = {"key": "dir/video.mp4", "filename": "video.mp4",
+                 "connect_string": "connect", "connection": "conn",
+                 "upload_id": upload.upload_id}
+        progress = []
+
+        result = self.up.upload(self.path, state, progress.append)
+
+        self.assertEquals(result, ("token", "conn"))
+        self.assertEquals(self.s3.objects["dir/video.mp4"], self.data)
+        self.assertEquals(self.s3.part_requests, 3)
+        self.assertEquals([p["parts_done"] for p in progress], [2, 3])
+        self.assertEquals(self.up.bytes_uploaded, len(self.data) - 1024)
+        params = self.liveleak_get.call_args[1]["params"]
+        self.assertEquals(params["s3_key"], "dir/video.mp4")
+        self.assertEquals(params["connect_string"], "connect")
+
+
 class TestMultipartParams(unittest.TestCase):
 
     def test_parse(self):
@@ -63,3 +152,74 @@ oIiwiJENvbnRlbnQtVHlwZSIsIiJdLFsiY29udGVudC1sZW5ndGgtcmFuZ2UiLDAsIjIwOTcxNTIw\
 MDAiXSx7InN1Y2Nlc3NfYWN0aW9uX3N0YXR1cyI6IjIwMSJ9LFsic3RhcnRzLXdpdGgiLCIkbmFtZ\
 SIsIiJdLFsic3RhcnRzLXdpdGgiLCIkRmlsZW5hbWUiLCIiXV19")
         self.assertEqual(p["signature"], "VufnGKzbNncIeL0AMZ7nWi55FTo=")
+
+
+class TestParseAddItem(unittest.TestCase):
+
+    def setUp(self):
+        with open(P.join(CURRENT_DIR, "add_item.html")) as fin:
+            self.html = fin.read()
+
+    def test_parse(self):
+        form = rlb.liveleak.parse_add_item(self.html)
+        self.assertEquals(form.connection, "2f3_1405564338")
+        self.assertTrue(form.connect_string.startswith("e%2FZ9dAcklsBygQ"))
+        self.assertTrue(form.connect_string.endswith("XRCyls%3D"))
+        self.assertEquals(form.multipart_params["acl"], "private")
+        #
+        # 2014-07-17T22:32:18.000Z
+        #
+        self.assertEquals(form.expiration, 1405636338)
+
+    def test_connection(self):
+        self.assertEquals(rlb.liveleak.extract_connection(self.html),
+                          "2f3_1405564338")
+
+    def test_missing(self):
+        html = self.html.replace('id="connection"', 'id="other"')
+        self.assertEquals(rlb.liveleak.parse_add_item(html), None)
+
+
+class TestFormReuse(unittest.TestCase):
+
+    def setUp(self):
+        with open(P.join(CURRENT_DIR, "add_item.html")) as fin:
+            html = fin.read()
+        self.session = mock.Mock()
+        self.session.get.return_value = mock.Mock(status_code=200, text=html)
+        self.session.post.return_value = mock.Mock(status_code=500, text="")
+        self.now = 1405600000
+        self.up = rlb.liveleak.Uploader("user_agent", self.session,
+                                        clock=lambda: self.now)
+        self.path = P.join(CURRENT_DIR, "foreman_cif.mp4")
+
+    def test_reuse(self):
+        for _ in range(3):
+            self.assertRaises(rlb.liveleak.FileNotAttached,
+                              self.up.upload, self.path)
+        self.assertEquals(self.session.get.call_count, 1)
+        self.assertEquals(self.session.post.call_count, 3)
+
+    def test_expired(self):
+        self.assertRaises(rlb.liveleak.FileNotAttached,
+                          self.up.upload, self.path)
+        self.now += 24 * 60 * 60
+        self.assertRaises(rlb.liveleak.FileNotAttached,
+                          self.up.upload, self.path)
+        self.assertEquals(self.session.get.call_count, 2)
+
+    def test_used(self):
+        self.session.post.return_value = mock.Mock(
+            status_code=201, text="<PostResponse><Location>l</Location>"
+            "<Bucket>b</Bucket><Key>k</Key><ETag>e</ETag></PostResponse>")
+        #
+        # The file gets attached, but LiveLeak's reply is garbled.
+        #
+        add_item = self.session.get.return_value
+        add_file = mock.Mock(status_code=200, text="not json")
+        self.session.get.side_effect = [add_item, add_file] * 2
+        for _ in range(2):
+            self.assertRaises(rlb.liveleak.LiveLeakException,
+                              self.up.upload, self.path)
+        self.assertEquals(self.session.get.call_count, 4)
+        self.assertEquals(self.up.spare_forms, [])
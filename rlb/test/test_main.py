@@ -1,30 +1,39 @@
 import unittest
+import os
 import os.path as P
+import shutil
+import tempfile
 import datetime as dt
+import time
 import json
+import errno
 
 import praw.objects
+import yaml
 
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
 from sqlalchemy.orm import sessionmaker
 from mock import patch, Mock
 
 import rlb.main
-from rlb.orm import Base, Video, Subreddit
+import rlb.metrics
+import rlb.youtube as youtube
+from rlb.fakes import FakeReddit
+from rlb.orm import Base, Video, Subreddit, Reply
+from rlb.storage import VideoIndex, DiskBudget
 
 CURRENT_DIR = P.dirname(P.abspath(__file__))
 
 
-class TestLocateVideo(unittest.TestCase):
+class TestChunkSubreddits(unittest.TestCase):
 
-    def test_positive(self):
-        actual = rlb.main.locate_video(CURRENT_DIR, "foreman_cif")
-        expected = P.join(CURRENT_DIR, "foreman_cif.mp4")
-        self.assertEqual(expected, actual)
+    def test_chunks(self):
+        chunks = rlb.main.chunk_subreddits(["a" * 4, "b" * 4, "c" * 4], 9)
+        self.assertEquals(chunks, [["aaaa", "bbbb"], ["cccc"]])
 
-    def test_negative(self):
-        actual = rlb.main.locate_video(CURRENT_DIR, "not_there")
-        self.assertEqual(None, actual)
+    def test_long_name(self):
+        chunks = rlb.main.chunk_subreddits(["a" * 10, "b"], 9)
+        self.assertEquals(chunks, [["a" * 10], ["b"]])
 
 
 def empty_db():
@@ -52,23 +61,33 @@ class TestMakeStale(unittest.TestCase):
         new_video = Video("new_video", "permalink2")
         new_video.state = Video.DOWNLOADED
 
+        undiscovered_video = Video("undiscovered_video", "permalink4")
+        undiscovered_video.state = Video.DOWNLOADED
+        undiscovered_video.discovered = None
+
         reposted_video = Video("reposted_video", "permalink3")
         reposted_video.state = Video.REPOSTED
         reposted_video.discovered = dt.datetime.min
 
         self.bot.db.add(old_video)
         self.bot.db.add(new_video)
+        self.bot.db.add(undiscovered_video)
         self.bot.db.add(reposted_video)
         self.bot.db.commit()
 
     def test(self):
-        self.bot.make_stale()
+        self.assertEquals(self.bot.make_stale(), 2)
 
         old_video = self.bot.db.query(Video)\
             .filter_by(youtubeId="old_video")\
             .one()
         self.assertEqual(old_video.state, Video.STALE)
 
+        undiscovered_video = self.bot.db.query(Video)\
+            .filter_by(youtubeId="undiscovered_video")\
+            .one()
+        self.assertEqual(undiscovered_video.state, Video.STALE)
+
         #
         # Videos that are younger than the cutoff should not be marked as stale
         #
@@ -86,6 +105,79 @@ class TestMakeStale(unittest.TestCase):
         self.assertEqual(reposted_video.state, Video.REPOSTED)
 
 
+class TestConfig(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+
+    def load(self, **overrides):
+        with open(P.join(CURRENT_DIR, "../conf/config.yml.sample")) as fin:
+            doc = yaml.safe_load(fin)
+        doc.update(overrides)
+        path = P.join(self.tmpdir, "config.yml")
+        with open(path, "w") as fout:
+            yaml.safe_dump(doc, fout)
+        return rlb.main.Config(path)
+
+    def test_empty_sections(self):
+        #
+        # A section with nothing under it loads as None.
+        #
+        cfg = self.load(daemon=None, disk_budget=None, http=None,
+                        youtube=None, repost=None)
+        self.assertEquals(cfg.scan_minutes, 60)
+        self.assertEquals(cfg.disk_budget.max_bytes, 0)
+        self.assertEquals(cfg.http_max_retries, 3)
+        self.assertEquals(cfg.youtube_max_in_flight, 4)
+        self.assertEquals(cfg.upload_workers, 2)
+
+    def test_empty_keys(self):
+        cfg = self.load(formats={"max_height": None, "max_filesize_mb": 500,
+                                 "max_duration_minutes": None,
+                                 "container": None},
+                        subreddits={"UkrainianConflict": {
+                            "liveleak_category": "Ukraine",
+                            "formats": {"max_filesize_mb": None}}})
+        self.assertEquals(cfg.format_policy.max_height, 0)
+        self.assertEquals(cfg.format_policy.max_duration, 0)
+        self.assertEquals(cfg.format_policy.container, None)
+        policy = cfg.format_policies["ukrainianconflict"]
+        self.assertEquals(policy.max_filesize, 500 * 1024 * 1024)
+
+
+class TestTransaction(unittest.TestCase):
+
+    @patch("rlb.liveleak.Uploader")
+    @patch("praw.Reddit")
+    def setUp(self, mock_reddit, mock_llu):
+        self.bot = rlb.main.Bot()
+        self.bot.db = empty_db()
+        rlb.metrics.REGISTRY.reset()
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+
+    def test_metrics(self):
+        self.bot.make_stale()
+        self.bot.db = Mock()
+        self.bot.db.query.side_effect = Exception("database is locked")
+        self.bot.make_stale()
+
+        self.bot.cfg.metrics_json_path = P.join(self.tmpdir, "m.json")
+        self.bot.cfg.metrics_prometheus_path = P.join(self.tmpdir, "m.prom")
+        self.bot.report_metrics()
+
+        with open(self.bot.cfg.metrics_json_path) as fin:
+            operations = json.load(fin)["operations"]
+        self.assertEquals(operations["db.make_stale"]["count"], 2)
+        self.assertEquals(operations["db.make_stale"]["errors"], 1)
+        self.assertTrue(P.isfile(self.bot.cfg.metrics_prometheus_path))
+        #
+        # The next pass starts from zero.
+        #
+        self.assertEquals(rlb.metrics.REGISTRY.snapshot()["operations"], {})
+
+
 class TestPurgeVideo(unittest.TestCase):
 
     @patch("rlb.liveleak.Uploader")
@@ -99,25 +191,135 @@ class TestPurgeVideo(unittest.TestCase):
         self.bot.db.add(video)
         self.bot.db.commit()
 
-    def test_purge_video(self):
-        video = self.bot.db.query(Video)\
-            .filter_by(youtubeId="to_be_deleted")\
-            .one()
-        video.has_file = Mock(return_value=True)
+    def test_purge(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+
+        def add_video(youtube_id, state, size=None):
+            video = Video(youtube_id, "dummy_permalink")
+            video.state = state
+            if size is not None:
+                video.localPath = P.join(tmpdir, youtube_id + ".mp4")
+                with open(video.localPath, "wb") as fout:
+                    fout.write("x" * size)
+            self.bot.db.add(video)
+        add_video("stale", Video.STALE, 100)
+        add_video("reposted", Video.REPOSTED, 20)
+        add_video("downloaded", Video.DOWNLOADED, 3)
+        add_video("missing", Video.DOWNLOADED)
+        self.bot.db.commit()
+        self.bot.videos = VideoIndex(tmpdir)
+        self.bot.cfg.purge_batch_size = 2
 
-        with patch("os.remove") as mock_method:
-            self.bot.purge_video(video)
-            mock_method.assert_called_with("/path/to/video.mp4")
+        self.assertEquals(self.bot.purge(), 120)
 
-        self.assertEquals(video.state, Video.PURGED)
+        states = dict(self.bot.db.query(Video.youtubeId, Video.state))
+        self.assertEquals(states, {"to_be_deleted": Video.PURGED,
+                                   "stale": Video.PURGED,
+                                   "reposted": Video.PURGED,
+                                   "downloaded": Video.DOWNLOADED,
+                                   "missing": Video.PURGED})
+        self.assertEquals(os.listdir(tmpdir), ["downloaded.mp4"])
+        self.assertEquals(len(self.bot.videos), 1)
 
-    def test_purge(self):
-        video = self.bot.db.query(Video)\
-            .filter_by(youtubeId="to_be_deleted")\
-            .one()
-        with patch.object(rlb.main.Bot, "purge_video") as mock_method:
-            self.bot.purge()
-            mock_method.assert_called_with(video)
+
+class TestDiskBudget(unittest.TestCase):
+
+    @patch("rlb.liveleak.Uploader")
+    @patch("praw.Reddit")
+    def setUp(self, mock_reddit, mock_uploader):
+        self.bot = rlb.main.Bot()
+        self.bot.db = empty_db()
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+
+        now = dt.datetime.now()
+        for i, state in enumerate([Video.DOWNLOADED, Video.DOWNLOADED,
+                                   Video.DOWNLOADED, Video.STALE]):
+            video = Video("video%d" % i, "dummy_permalink")
+            video.state = state
+            video.discovered = now - dt.timedelta(hours=i)
+            video.localPath = P.join(self.tmpdir, video.youtubeId + ".mp4")
+            with open(video.localPath, "wb") as fout:
+                fout.write("x" * 100)
+            self.bot.db.add(video)
+        self.bot.db.commit()
+        self.bot.videos = VideoIndex(self.tmpdir)
+        self.bot.cfg.purge_batch_size = 1
+
+    def states(self):
+        return dict(self.bot.db.query(Video.youtubeId, Video.state))
+
+    def test_within_budget(self):
+        self.bot.cfg.disk_budget = DiskBudget(max_bytes=400)
+        self.assertEquals(self.bot.enforce_disk_budget(), 0)
+        self.assertEquals(len(os.listdir(self.tmpdir)), 4)
+
+    def test_evict(self):
+        self.bot.cfg.disk_budget = DiskBudget(max_bytes=250)
+        self.assertEquals(self.bot.enforce_disk_budget(), 200)
+        #
+        # The stale video goes first, then the oldest downloaded one.
+        #
+        self.assertEquals(self.states(), {"video0": Video.DOWNLOADED,
+                                          "video1": Video.DOWNLOADED,
+                                          "video2": Video.PURGED,
+                                          "video3": Video.PURGED})
+        self.assertEquals(self.bot.videos.total_bytes, 200)
+
+    def test_download_video(self):
+        self.bot.cfg.disk_budget = DiskBudget(max_bytes=150)
+        self.bot.fetch_video = Mock(return_value=None)
+        self.bot.download_video("dl", "permalink")
+        self.assertEquals(self.bot.videos.total_bytes, 100)
+
+    def test_keep_new(self):
+        self.bot.cfg.disk_budget = DiskBudget(max_bytes=50)
+
+        def fetch_video(youtube_id, policy):
+            path = P.join(self.tmpdir, youtube_id + ".mp4")
+            with open(path, "wb") as fout:
+                fout.write("x" * 100)
+            self.bot.videos.add(youtube_id, path)
+            return path
+        self.bot.fetch_video = fetch_video
+        self.bot.download_video("dl", "permalink")
+        #
+        # Everything else goes, but the new download stays.
+        #
+        self.assertEquals(self.states(), {"video0": Video.PURGED,
+                                          "video1": Video.PURGED,
+                                          "video2": Video.PURGED,
+                                          "video3": Video.PURGED,
+                                          "dl": Video.DOWNLOADED})
+        self.assertEquals(self.bot.videos.total_bytes, 100)
+
+    @patch("rlb.main.logger")
+    @patch("rlb.storage.remove_file")
+    def test_purge_fails(self, mock_remove_file, mock_logger):
+        mock_remove_file.side_effect = OSError(errno.EACCES,
+                                               "Permission denied")
+        self.bot.cfg.disk_budget = DiskBudget(max_bytes=250)
+        self.assertEquals(self.bot.enforce_disk_budget(), 0)
+        self.assertTrue(mock_logger.error.called)
+        self.assertEquals(self.states()["video3"], Video.STALE)
+
+    @patch("rlb.storage.remove_file")
+    def test_evict_fails(self, mock_remove_file):
+        mock_remove_file.side_effect = OSError(errno.EACCES,
+                                               "Permission denied")
+        self.bot.cfg.disk_budget = DiskBudget(max_bytes=150)
+        self.bot.fetch_video = Mock(side_effect=lambda youtube_id, policy:
+                                    P.join(self.tmpdir, youtube_id + ".mp4"))
+        self.bot.download_videos([("v%d" % i, "permalink")
+                                  for i in range(3)])
+        #
+        # The downloads stay recorded, even though nothing got evicted.
+        #
+        states = self.states()
+        for i in range(3):
+            self.assertEquals(states["v%d" % i], Video.DOWNLOADED)
+        self.assertEquals(states["video3"], Video.STALE)
 
 
 class TestDownloadVideo(unittest.TestCase):
@@ -131,40 +333,43 @@ class TestDownloadVideo(unittest.TestCase):
         downloaded_video = Video("dl", "permalink1")
         downloaded_video.localPath = "dl.mp4"
 
-    @patch("rlb.main.locate_video")
-    @patch("subprocess.call")
-    def test_already_downloaded(self, mock_call, mock_locate_video):
-        mock_call.return_value = 0
-        mock_locate_video.return_value = "dl.mp4"
+    @patch("rlb.youtube.DownloadEngine.download")
+    def test_already_downloaded(self, mock_download):
+        self.bot.videos = Mock()
+        self.bot.videos.locate.return_value = "dl.mp4"
 
         v = self.bot.download_video("dl", "permalink1")
 
-        self.assertEquals(mock_call.called, False)
-        mock_locate_video.assert_called_once_with(self.bot.cfg.dest_dir, "dl")
+        self.assertEquals(mock_download.called, False)
+        self.bot.videos.locate.assert_called_once_with("dl")
         self.assertEquals(v.state, Video.DOWNLOADED)
 
-    @patch("rlb.youtube.download")
-    @patch("rlb.main.locate_video")
-    def test_new(self, mock_locate_video, mock_download):
-        mock_locate_video.side_effect = [None, "dl.mp4"]
+    @patch("rlb.youtube.DownloadEngine.download")
+    def test_new(self, mock_download):
+        self.bot.videos = Mock()
+        self.bot.videos.locate.return_value = None
+        self.bot.videos.video_dir.return_value = self.bot.cfg.dest_dir
+        mock_download.return_value = "dl.mp4"
 
         v = self.bot.download_video("dl", "permalink1")
 
-        self.assertEquals(mock_locate_video.call_count, 2)
-        mock_download.assert_called_once_with(self.bot.cfg.dest_dir, "dl")
+        mock_download.assert_called_once_with(self.bot.cfg.dest_dir, "dl",
+                                              self.bot.cfg.format_policy)
+        self.bot.videos.add.assert_called_once_with("dl", "dl.mp4")
         self.assertEquals(v.state, Video.DOWNLOADED)
         self.assertEquals(v.localPath, "dl.mp4")
 
-    @patch("rlb.main.locate_video")
-    @patch("subprocess.call")
-    def test_error(self, mock_call, mock_locate_video):
-        mock_call.return_value = -1
-        mock_locate_video.return_value = None
+    @patch("rlb.youtube.DownloadEngine.download")
+    def test_error(self, mock_download):
+        self.bot.videos = Mock()
+        self.bot.videos.locate.return_value = None
+        self.bot.videos.video_dir.return_value = self.bot.cfg.dest_dir
+        mock_download.return_value = None
 
         v = self.bot.download_video("dl", "permalink1")
 
-        mock_call.assert_called_once()
-        self.assertEquals(mock_locate_video.call_count, 2)
+        self.assertEquals(mock_download.call_count, 1)
+        self.assertEquals(self.bot.videos.add.called, False)
         self.assertEquals(v.localPath, None)
         self.assertEquals(v.state, Video.ERROR)
 
@@ -193,6 +398,12 @@ class TestBot(unittest.TestCase):
         self.bot.db.add(info)
         self.bot.db.commit()
 
+        #
+        # Run the downloads on a single worker, so that the mocks below
+        # don't get called from several threads at once.
+        #
+        self.bot.cfg.download_workers = 1
+
         self.bot.uploader.upload.return_value = "dummy_token", "dummy_conn"
         self.bot.uploader.publish.return_value = "dummy_liveleak_id"
 
@@ -207,20 +418,12 @@ class TestBot(unittest.TestCase):
         subreddit.get_new.return_value = subs
         return subreddit
 
-    def mock_comments(self):
-        with open(P.join(CURRENT_DIR, "submission.json")) as fin:
-            json_dict = json.load(fin)
-        json_comments = json_dict[1]["data"]["children"]
+    def test_checker_session(self):
         #
-        # I'm not sure why we have to do this, but the Comment constructor
-        # raises an exception if we don't create these keys.
+        # The checker retries on its own, so its session doesn't.
         #
-        for comment in json_comments:
-            comment["_replies"] = []
-            comment["name"] = "dummy"
-            comment["author"] = "dummy"
-        return [praw.objects.Comment(self.bot.r, json_dict=child)
-                for child in json_comments]
+        adapter = self.bot.checker.session.get_adapter(youtube.API_URL)
+        self.assertEquals(adapter.max_retries.total, 0)
 
     @patch("os.makedirs")
     @patch("rlb.liveleak.Uploader")
@@ -231,14 +434,158 @@ class TestBot(unittest.TestCase):
         bot.r.login.assert_called_once()
         bot.uploader.login.assert_called_once()
 
-    @patch("rlb.youtube.extract_id")
+    @patch("rlb.youtube.extract_ids")
     def test_download_new_videos(self, mock_eyid):
         num_submissions = len(self.subreddit.get_new())
-        mock_eyid.return_value = "dQw4w9WgXcQ"
-        self.bot.download_video = Mock()
+        mock_eyid.side_effect = lambda urls: [
+            "video%d" % i for (i, _) in enumerate(urls)]
+        self.bot.fetch_video = Mock(return_value="video.mp4")
+        self.bot.download_new_videos("UkrainianConflict")
+        self.assertEquals(mock_eyid.call_count, 1)
+        self.assertEquals(self.bot.fetch_video.call_count, num_submissions)
+        self.assertEquals(
+            self.bot.db.query(Video).filter_by(state=Video.DOWNLOADED).count(),
+            num_submissions)
+
+    def test_download_new_videos_cursor(self):
+        submissions = self.subreddit.get_new()
+        newest = max(submissions, key=lambda s: s.created_utc)
+        self.bot.fetch_video = Mock(return_value=None)
+
+        self.bot.download_new_videos("UkrainianConflict")
+
+        info = self.bot.get_subreddit_info("UkrainianConflict")
+        self.assertEquals(info.newestSubmission, newest.fullname)
+        self.assertEquals(info.newestSubmissionCreated, newest.created_utc)
+        num_videos = self.bot.db.query(Video).count()
+        self.assertTrue(num_videos > 0)
+
+        #
+        # The next pass only asks for newer submissions, and ignores the
+        # ones it has already seen.
+        #
+        self.bot.fetch_video.reset_mock()
         self.bot.download_new_videos("UkrainianConflict")
-        self.assertEquals(mock_eyid.call_count, num_submissions)
-        self.assertEquals(self.bot.download_video.call_count, num_submissions)
+        self.subreddit.get_new.assert_called_with(
+            limit=self.bot.cfg.limit, params={"before": newest.fullname})
+        self.assertEquals(self.bot.fetch_video.called, False)
+        self.assertEquals(info.newestSubmission, newest.fullname)
+
+    def test_download_new_videos_combined(self):
+        submissions = self.subreddit.get_new()
+        newest = max(submissions, key=lambda s: s.created_utc)
+        self.bot.fetch_video = Mock(return_value=None)
+
+        self.bot.download_new_videos("UkrainianConflict", "ukraina")
+
+        self.bot.r.get_subreddit.assert_called_once_with(
+            "UkrainianConflict+ukraina")
+        info = self.bot.get_subreddit_info("UkrainianConflict")
+        self.assertEquals(info.newestSubmission, newest.fullname)
+        #
+        # We haven't seen anything from the other subreddit yet.
+        #
+        info = self.bot.get_subreddit_info("ukraina")
+        self.assertEquals(info.newestSubmission, None)
+
+    @patch("rlb.youtube.extract_ids")
+    def test_download_new_videos_duplicates(self, mock_eyid):
+        mock_eyid.side_effect = lambda urls: ["dQw4w9WgXcQ" for _ in urls]
+        self.bot.fetch_video = Mock(return_value=None)
+        self.bot.download_new_videos("UkrainianConflict")
+        self.bot.fetch_video.assert_called_once_with(
+            "dQw4w9WgXcQ", self.bot.cfg.format_policies["ukrainianconflict"])
+        video = self.bot.db.query(Video).one()
+        self.assertEquals(video.state, Video.ERROR)
+
+    def test_format_policy(self):
+        policy = self.bot.format_policy(
+            "http://www.reddit.com/r/UkrainianConflict/comments/2b8dsl/x/")
+        self.assertEquals(policy.max_duration, 30 * 60)
+        self.assertEquals(policy.max_filesize, 500 * 1024 * 1024)
+        self.assertEquals(policy.container, "mp4")
+        self.assertEquals(self.bot.format_policy("permalink"),
+                          self.bot.cfg.format_policy)
+
+    @patch("rlb.youtube.extract_ids")
+    def test_download_new_videos_skipped(self, mock_eyid):
+        mock_eyid.side_effect = lambda urls: ["dQw4w9WgXcQ" for _ in urls]
+        self.bot.fetch_video = Mock(
+            side_effect=rlb.youtube.VideoSkipped("duration 5400s over 1800s"))
+        self.bot.download_new_videos("UkrainianConflict")
+        video = self.bot.db.query(Video).one()
+        self.assertEquals(video.state, Video.SKIPPED)
+        self.assertEquals(video.skipReason, "duration 5400s over 1800s")
+        self.assertEquals(video.localPath, None)
+
+        #
+        # A skipped video doesn't get downloaded when it comes up again.
+        #
+        self.bot.fetch_video.reset_mock()
+        self.bot.get_subreddit_info("UkrainianConflict").newestSubmission = \
+            None
+        self.bot.get_subreddit_info("UkrainianConflict") \
+            .newestSubmissionCreated = None
+        self.bot.download_new_videos("UkrainianConflict")
+        self.assertEquals(self.bot.fetch_video.called, False)
+
+    @patch("rlb.youtube.extract_ids")
+    def test_download_new_videos_known(self, mock_eyid):
+        num_submissions = len(self.subreddit.get_new())
+        ids = ["video%d" % i for i in range(num_submissions)]
+        mock_eyid.return_value = ids
+
+        #
+        # We have the first video already, and the files for the others
+        # have gone missing.
+        #
+        for youtube_id in ids:
+            video = Video(youtube_id, "permalink")
+            video.state = Video.DOWNLOADED
+            self.bot.db.add(video)
+        self.bot.db.commit()
+        self.bot.videos = VideoIndex(CURRENT_DIR)
+        self.bot.videos.paths[ids[0]] = "video0.mp4"
+
+        self.bot.fetch_video = Mock(return_value="video.mp4")
+        queries = []
+        listener = lambda *args: queries.append(args[2])
+        event.listen(self.bot.db.bind, "before_cursor_execute", listener)
+        try:
+            self.bot.download_new_videos("UkrainianConflict")
+        finally:
+            event.remove(self.bot.db.bind, "before_cursor_execute", listener)
+
+        self.assertEquals(self.bot.fetch_video.call_count, num_submissions - 1)
+        #
+        # One query looks up all the videos, and none of them gets loaded
+        # again while we record the downloads.
+        #
+        selects = [q for q in queries if q.startswith("SELECT videos.")]
+        self.assertEquals(len(selects), 1, selects)
+        self.assertEquals(
+            self.bot.db.query(Video).filter_by(state=Video.DOWNLOADED)
+            .count(), num_submissions)
+
+    def test_download_videos_parallel(self):
+        self.bot.cfg.download_workers = 4
+        pending = [("video%d" % i, "permalink%d" % i) for i in range(10)]
+        #
+        # Mock isn't thread-safe, so keep track of the calls ourselves.
+        #
+        fetched = []
+
+        def fetch_video(youtube_id, policy=None):
+            fetched.append(youtube_id)
+            return youtube_id + ".mp4"
+        self.bot.fetch_video = fetch_video
+        self.bot.download_videos(pending)
+        self.assertEquals(sorted(fetched), sorted(i for (i, _) in pending))
+        for youtube_id, permalink in pending:
+            video = self.bot.db.query(Video).filter_by(
+                youtubeId=youtube_id).one()
+            self.assertEquals(video.localPath, youtube_id + ".mp4")
+            self.assertEquals(video.redditSubmissionPermalink, permalink)
 
     def test_get_subreddit_info_known(self):
         info = self.bot.get_subreddit_info("UkrainianConflict")
@@ -248,41 +595,412 @@ class TestBot(unittest.TestCase):
         info = self.bot.get_subreddit_info("ukraina")
         self.assertEquals(info.mostRecentSubmission, dt.datetime.min)
 
-    def test_repost_video_give_up(self):
-        video = Video("dQw4w9WgXcQ", "dummy_permalink")
-
-        self.bot.repost_video(video)
+    def test_upload_stage_give_up(self):
+        job = rlb.main.RepostJob(Video("dQw4w9WgXcQ", "dummy_permalink"))
 
+        self.assertEquals(self.bot._upload_stage(job), None)
         self.assertEquals(self.bot.uploader.upload.called, False)
-        self.assertEquals(video.state, Video.STALE)
 
-    @patch("rlb.orm.Video")
-    def test_repost_video(self, mock_video):
-        video = mock_video()
-        video.youtubeId = "dQw4w9WgXcQ"
-        video.permalink = "dummy_permalink"
-        video.has_file.return_value = True
-        video.liveleakId = None
+    def test_publish_stage(self):
+        video = Video("dQw4w9WgXcQ", "dummy_permalink")
+        video.liveleakConnection = "dummy_conn"
+        job = rlb.main.RepostJob(video)
+        submission = self.bot.r.get_submission.return_value
 
-        self.bot.repost_video(video)
+        self.assertEquals(self.bot._publish_stage(job), "dummy_liveleak_id")
+        args = self.bot.uploader.publish.call_args[0]
+        self.assertEquals(args[0], submission.title)
+        self.assertTrue("dQw4w9WgXcQ" in args[1])
+        self.assertEquals(args[2:], ("UkrainianConflict", "Ukraine",
+                                     "dummy_conn"))
 
-        self.assertEquals(self.bot.uploader.upload.called, True)
-        self.assertEquals(video.state, Video.REPOSTED)
-        self.assertEquals(video.liveleakId, "dummy_liveleak_id")
+    def mock_recent_comments(self, *submission_ids):
+        self.bot.r.user.get_comments.return_value = [
+            Mock(link_id="t3_" + i) for i in submission_ids]
 
     def test_check_replies_negative(self):
         submission = self.subreddit.get_new()[0]
-        submission.comments = self.mock_comments()
+        self.mock_recent_comments("other")
         self.assertEquals(self.bot.check_replies(submission), False)
 
     def test_check_replies_positive(self):
         submission = self.subreddit.get_new()[0]
-        submission.comments = self.mock_comments()
-        submission.comments.append(praw.objects.Comment(
-            self.bot.r, json_dict={"_replies": [],
-                                   "author": self.bot.cfg.reddit_username,
-                                   "name": "dummy"}))
+        self.mock_recent_comments("other", submission.id)
         self.assertEquals(self.bot.check_replies(submission), True)
+        self.bot.r.user.get_comments.assert_called_once_with(
+            limit=self.bot.cfg.reply_check_limit)
 
-    def test_monitor(self):
+    def test_check_replies_cached(self):
+        submission = self.subreddit.get_new()[0]
+        self.mock_recent_comments("other")
+        self.assertEquals(self.bot.check_replies(submission), False)
+        self.mock_recent_comments(submission.id)
+        self.assertEquals(self.bot.check_replies(submission), False)
+        self.assertEquals(self.bot.r.user.get_comments.call_count, 1)
+
+        self.bot.recent_replies_fetched -= (
+            self.bot.cfg.reply_cache_minutes * 60 + 1)
+        self.assertEquals(self.bot.check_replies(submission), True)
+        self.assertEquals(self.bot.r.user.get_comments.call_count, 2)
+
+    def test_post_comment(self):
+        submission = Mock(id="abc")
+        self.mock_recent_comments()
+        self.assertEquals(self.bot.check_replies(submission), False)
+        self.bot.post_comment(submission, "liveleak_id")
+        self.assertEquals(submission.add_comment.call_count, 1)
+        self.assertEquals(self.bot.check_replies(submission), True)
+
+    def test_monitor_deleted_videos(self):
+        for youtube_id in ["alive", "deleted", "unknown"]:
+            video = Video(youtube_id, "permalink")
+            video.state = Video.DOWNLOADED
+            self.bot.db.add(video)
+        self.bot.db.commit()
+        self.bot.checker = Mock()
+        self.bot.checker.check.return_value = set(["alive"]), set(["unknown"])
+        self.bot.repost_deleted_videos = Mock()
+
+        self.bot.monitor_deleted_videos()
+
+        states = dict((v.youtubeId, v.state)
+                      for v in self.bot.db.query(Video))
+        self.assertEquals(states, {"alive": Video.DOWNLOADED,
+                                   "deleted": Video.DELETED,
+                                   "unknown": Video.DOWNLOADED})
+        self.assertEquals(self.bot.repost_deleted_videos.call_count, 1)
+
+    def test_mark_deleted_queued_videos(self):
+        for youtube_id in ["queued", "queued_alive"]:
+            video = Video(youtube_id, "permalink")
+            video.state = Video.PROBED
+            self.bot.db.add(video)
+        self.bot.db.commit()
+        self.bot.checker = Mock()
+        self.bot.checker.check.return_value = set(["queued_alive"]), set()
+
+        self.assertEquals(self.bot.mark_deleted_videos(), 0)
+
+        video = self.bot.db.query(Video).filter_by(youtubeId="queued").one()
+        self.assertEquals(video.state, Video.STALE)
+        self.assertNotEquals(video.deleted, None)
+        video = self.bot.db.query(Video).filter_by(
+            youtubeId="queued_alive").one()
+        self.assertEquals(video.state, Video.PROBED)
+
+    @patch("rlb.youtube.extract_ids")
+    def test_download_new_videos_deferred(self, mock_eyid):
+        self.bot.cfg.deferred = True
+        num_submissions = len(self.subreddit.get_new())
+        ids = ["video%d" % i for i in range(num_submissions)]
+        mock_eyid.return_value = ids
+        published = dt.datetime(2014, 7, 16)
+        self.bot.checker = Mock()
+        self.bot.checker.details.return_value = dict(
+            (i, {"channel_id": "UCabc", "published": published,
+                 "duration": 60}) for i in ids[1:]), set()
+        self.bot.fetch_video = Mock()
+
+        self.bot.download_new_videos("UkrainianConflict")
+
+        self.assertEquals(self.bot.fetch_video.called, False)
+        #
+        # The first video is gone already.
+        #
+        video = self.bot.db.query(Video).filter_by(youtubeId=ids[0]).one()
+        self.assertEquals(video.state, Video.ERROR)
+        queued = self.bot.db.query(Video).filter_by(state=Video.PROBED).all()
+        self.assertEquals(len(queued), num_submissions - 1)
+        for video in queued:
+            self.assertEquals(video.channelId, "UCabc")
+            self.assertEquals(video.published, published)
+            self.assertNotEquals(video.priority, None)
+
+    @patch("rlb.youtube.extract_ids")
+    def test_download_new_videos_deferred_too_long(self, mock_eyid):
+        self.bot.cfg.deferred = True
+        mock_eyid.side_effect = lambda urls: ["dQw4w9WgXcQ" for _ in urls]
+        self.bot.checker = Mock()
+        self.bot.checker.details.return_value = {"dQw4w9WgXcQ": {
+            "channel_id": None, "published": None, "duration": 7200}}, set()
+
+        self.bot.download_new_videos("UkrainianConflict")
+
+        video = self.bot.db.query(Video).one()
+        self.assertEquals(video.state, Video.SKIPPED)
+        self.assertEquals(video.skipReason, "duration 7200s over 1800s")
+
+    def test_channel_history(self):
+        for i, (channel_id, deleted) in enumerate(
+                [("a", True), ("a", False), ("b", False), ("c", True)]):
+            video = Video("video%d" % i, "permalink")
+            video.channelId = channel_id
+            if deleted:
+                video.deleted = dt.datetime.now()
+            self.bot.db.add(video)
+        self.bot.db.commit()
+        self.assertEquals(self.bot.channel_history(["a", "b", "d"]),
+                          {"a": (1, 2), "b": (0, 1)})
+
+    def test_download_queued(self):
+        for i, priority in enumerate([1.0, 3.0, 2.0]):
+            video = Video("video%d" % i, "permalink%d" % i)
+            video.state = Video.PROBED
+            video.priority = priority
+            self.bot.db.add(video)
+        self.bot.db.commit()
+        self.bot.cfg.downloads_per_pass = 2
+        fetched = []
+
+        def fetch_video(youtube_id, policy=None):
+            fetched.append(youtube_id)
+            return youtube_id + ".mp4"
+        self.bot.fetch_video = fetch_video
+
+        self.assertEquals(self.bot.download_queued(), 2)
+
+        self.assertEquals(fetched, ["video1", "video2"])
+        states = dict((v.youtubeId, v.state)
+                      for v in self.bot.db.query(Video))
+        self.assertEquals(states, {"video0": Video.PROBED,
+                                   "video1": Video.DOWNLOADED,
+                                   "video2": Video.DOWNLOADED})
+
+    def add_deleted_video(self, youtube_id, state=Video.DELETED):
+        video = Video(youtube_id, "permalink")
+        video.state = state
+        video.localPath = P.join(self.tmpdir, youtube_id + ".mp4")
+        with open(video.localPath, "w") as fout:
+            fout.write("video")
+        self.bot.db.add(video)
+        self.bot.db.commit()
+        return video
+
+    def setup_repost(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        #
+        # One worker per stage, so that each mock is called from one
+        # thread at a time.
+        #
+        self.bot.cfg.upload_workers = 1
+        self.bot.check_replies = Mock(return_value=False)
+        self.bot.post_comment = Mock(return_value=Mock(id="comment"))
+
+    def test_repost_deleted_videos(self):
+        self.setup_repost()
+        self.add_deleted_video("deleted")
+
+        self.bot.repost_deleted_videos()
+
+        video = self.bot.db.query(Video).one()
+        self.assertEquals(video.state, Video.REPOSTED)
+        self.assertEquals(video.liveleakConnection, "dummy_conn")
+        self.assertEquals(video.liveleakId, "dummy_liveleak_id")
+        self.assertEquals(self.bot.uploader.upload.call_args[0][:2],
+                          (video.localPath, None))
+        submission = self.bot.r.get_submission.return_value
+        self.bot.post_comment.assert_called_once_with(submission,
+                                                      "dummy_liveleak_id")
+        reply = self.bot.db.query(Reply).one()
+        self.assertEquals(reply.redditSubmissionId, submission.id)
+        self.assertEquals(reply.redditCommentId, "comment")
+
+    def test_repost_replied(self):
+        self.setup_repost()
+        self.add_deleted_video("deleted")
+        self.bot.check_replies.return_value = True
+
+        self.bot.repost_deleted_videos()
+
+        video = self.bot.db.query(Video).one()
+        self.assertEquals(video.state, Video.REPOSTED)
+        self.assertEquals(self.bot.uploader.upload.call_count, 0)
+        submission = self.bot.r.get_submission.return_value
+        self.assertEquals(self.bot.db.query(Reply).one().redditSubmissionId,
+                          submission.id)
+
+    def test_repost_replied_in_db(self):
+        self.setup_repost()
+        video = self.add_deleted_video("deleted")
+        video.redditSubmissionPermalink = (
+            "http://www.reddit.com/r/UkrainianConflict/comments/2b8dsl/title/")
+        self.bot.db.add(Reply("2b8dsl"))
+        self.bot.db.commit()
+
+        self.bot.repost_deleted_videos()
+
+        video = self.bot.db.query(Video).one()
+        self.assertEquals(video.state, Video.REPOSTED)
+        self.assertEquals(self.bot.check_replies.call_count, 0)
+        self.assertEquals(self.bot.r.get_submission.call_count, 0)
+
+    def test_repost_missing_file(self):
+        self.setup_repost()
+        video = self.add_deleted_video("deleted")
+        os.remove(video.localPath)
+
+        self.bot.repost_deleted_videos()
+
+        video = self.bot.db.query(Video).one()
+        self.assertEquals(video.state, Video.STALE)
+        self.assertEquals(self.bot.uploader.publish.call_count, 0)
+
+    def test_repost_resume(self):
+        self.setup_repost()
+        video = self.add_deleted_video("uploaded", Video.UPLOADED)
+        video.liveleakConnection = "earlier_conn"
+        self.bot.db.commit()
+
+        self.bot.repost_deleted_videos()
+
+        video = self.bot.db.query(Video).one()
+        self.assertEquals(video.state, Video.REPOSTED)
+        self.assertEquals(self.bot.uploader.upload.call_count, 0)
+        self.assertEquals(self.bot.uploader.publish.call_args[0][-1],
+                          "earlier_conn")
+
+    def test_repost_failure(self):
+        self.setup_repost()
+        self.add_deleted_video("deleted")
+        self.bot.uploader.publish.side_effect = Exception("publish failed")
+
+        self.bot.repost_deleted_videos()
+
+        video = self.bot.db.query(Video).one()
+        self.assertEquals(video.state, Video.UPLOADED)
+        self.assertEquals(video.liveleakConnection, "dummy_conn")
+        self.assertEquals(self.bot.post_comment.call_count, 0)
+
+    def test_repost_upload_progress(self):
+        self.setup_repost()
+        self.add_deleted_video("deleted")
+
+        def upload(path, resume, on_progress):
+            on_progress({"upload_id": "upload1", "parts_done": 1})
+            raise Exception("connection dropped")
+
+        self.bot.uploader.upload.side_effect = upload
+        self.bot.repost_deleted_videos()
+
+        video = self.bot.db.query(Video).one()
+        self.assertEquals(video.state, Video.DELETED)
+        self.assertEquals(json.loads(video.uploadState),
+                          {"upload_id": "upload1", "parts_done": 1})
+
+        self.bot.uploader.upload.side_effect = None
+        self.bot.repost_deleted_videos()
+
+        self.assertEquals(self.bot.uploader.upload.call_args[0][1],
+                          {"upload_id": "upload1", "parts_done": 1})
+        video = self.bot.db.query(Video).one()
+        self.assertEquals(video.state, Video.REPOSTED)
+        self.assertEquals(video.uploadState, None)
+
+    @patch("rlb.youtube.DownloadEngine.download")
+    def test_monitor(self, mock_download):
         self.bot.monitor()
+
+
+class TestListing(unittest.TestCase):
+    """Several passes of download_new_videos against a fake reddit."""
+
+    @patch("os.makedirs")
+    @patch("rlb.liveleak.Uploader")
+    @patch("praw.Reddit")
+    def setUp(self, mock_reddit, mock_llu, mock_makedirs):
+        self.bot = rlb.main.Bot(P.join(CURRENT_DIR,
+                                       "../conf/config.yml.sample"))
+        self.bot.db = empty_db()
+        self.bot.r = self.reddit = FakeReddit()
+        self.bot.fetch_video = Mock(return_value="video.mp4")
+        self.count = 0
+        #
+        # The submissions are an hour old, a second apart.
+        #
+        self.created = time.time() - 3600
+
+    def add_submissions(self, subreddit, count):
+        for _ in range(count):
+            self.count += 1
+            self.created += 1
+            submission_id = "s%d" % self.count
+            self.reddit.add_submission({
+                "id": submission_id,
+                "name": "t3_" + submission_id,
+                "title": submission_id,
+                "author": "someone",
+                "url": "https://www.youtube.com/watch?v=%011d" % self.count,
+                "permalink": "/r/%s/comments/%s/title/" % (subreddit,
+                                                          submission_id),
+                "created_utc": self.created,
+                "subreddit": subreddit})
+
+    def count_videos(self, subreddit):
+        return self.bot.db.query(Video).filter(
+            Video.redditSubmissionPermalink.like(
+                "%%/r/%s/%%" % subreddit)).count()
+
+    def test_anchor_gone(self):
+        self.bot.cfg.cursor_check_hours = 0.5
+        self.add_submissions("UkrainianConflict", 3)
+        self.bot.download_new_videos("UkrainianConflict")
+        self.assertEquals(self.count_videos("UkrainianConflict"), 3)
+
+        #
+        # The newest submission gets deleted, and the cursor points at it.
+        #
+        del self.reddit.submissions["s3"]
+        self.add_submissions("UkrainianConflict", 2)
+        self.bot.download_new_videos("UkrainianConflict")
+
+        self.assertEquals(self.count_videos("UkrainianConflict"), 5)
+        info = self.bot.get_subreddit_info("UkrainianConflict")
+        self.assertEquals(info.newestSubmission, "t3_s5")
+
+    def test_quiet(self):
+        self.add_submissions("UkrainianConflict", 3)
+        self.bot.download_new_videos("UkrainianConflict")
+        requests = self.reddit.requests
+
+        #
+        # Nothing new: just the listing, and the cursor doesn't move.
+        #
+        for i in range(3):
+            self.bot.download_new_videos("UkrainianConflict")
+            self.assertEquals(self.reddit.requests, requests + i + 1)
+        info = self.bot.get_subreddit_info("UkrainianConflict")
+        self.assertEquals(info.newestSubmission, "t3_s3")
+
+    def test_quiet_old_cursor(self):
+        self.bot.cfg.cursor_check_hours = 0.5
+        self.add_submissions("UkrainianConflict", 3)
+        self.bot.download_new_videos("UkrainianConflict")
+        requests = self.reddit.requests
+
+        #
+        # The cursor is old enough to check that it's still there, but
+        # once checked, it isn't checked again for a while.
+        #
+        self.bot.download_new_videos("UkrainianConflict")
+        self.assertEquals(self.reddit.requests, requests + 2)
+        self.bot.download_new_videos("UkrainianConflict")
+        self.assertEquals(self.reddit.requests, requests + 3)
+        info = self.bot.get_subreddit_info("UkrainianConflict")
+        self.assertEquals(info.newestSubmission, "t3_s3")
+
+    def test_busy_and_quiet(self):
+        self.bot.cfg.limit = 100
+        self.add_submissions("Quiet", 1)
+        self.add_submissions("Busy", 250)
+        #
+        # The first pass starts from the quiet subreddit's cursor.
+        #
+        self.bot.download_new_videos("Quiet")
+        for _ in range(4):
+            self.bot.download_new_videos("Busy", "Quiet")
+
+        self.assertEquals(self.count_videos("Quiet"), 1)
+        self.assertEquals(self.count_videos("Busy"), 250)
+        info = self.bot.get_subreddit_info("Busy")
+        self.assertEquals(info.newestSubmissionCreated, self.created)
@@ -0,0 +1,113 @@
+import json
+import os.path as P
+import shutil
+import tempfile
+import unittest
+
+from rlb.metrics import Histogram, Registry
+
+
+class FakeClock(object):
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestHistogram(unittest.TestCase):
+
+    def test_summary(self):
+        histogram = Histogram([1, 2, 5])
+        for value in [0.5, 0.5, 1.5, 4, 10]:
+            histogram.observe(value)
+        self.assertEquals(histogram.counts, [2, 1, 1, 1])
+        summary = histogram.summary()
+        self.assertEquals(summary["count"], 5)
+        self.assertAlmostEquals(summary["sum"], 16.5)
+        self.assertEquals(summary["max"], 10)
+        self.assertEquals(summary["p50"], 2)
+        self.assertEquals(summary["p95"], 10)
+
+
+class TestRegistry(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.registry = Registry(self.clock)
+
+    def test_timed(self):
+        @self.registry.timed("op")
+        def op(fail):
+            self.clock.now += 2
+            if fail:
+                raise ValueError()
+
+        op(False)
+        self.assertRaises(ValueError, op, True)
+
+        summary = self.registry.snapshot()["operations"]["op"]
+        self.assertEquals(summary["count"], 2)
+        self.assertEquals(summary["errors"], 1)
+        self.assertEquals(summary["sum"], 4)
+
+    def test_iterate(self):
+        def listing():
+            for i in range(5):
+                self.clock.now += 1
+                yield i
+
+        for i in self.registry.iterate("listing", listing()):
+            self.clock.now += 10
+            if i == 2:
+                break
+
+        summary = self.registry.snapshot()["operations"]["listing"]
+        self.assertEquals(summary["count"], 1)
+        self.assertEquals(summary["sum"], 3)
+
+    def test_prometheus(self):
+        self.registry.count("upload.bytes", 100)
+        self.registry.observe("reddit.get_new", 0.2)
+        self.registry.observe("reddit.get_new", 20, error=True)
+        lines = self.registry.prometheus().splitlines()
+        self.assertTrue("rlb_upload_bytes_total 100" in lines)
+        self.assertTrue('rlb_operation_seconds_bucket{'
+                        'operation="reddit.get_new",le="0.25"} 1' in lines)
+        self.assertTrue('rlb_operation_seconds_bucket{'
+                        'operation="reddit.get_new",le="+Inf"} 2' in lines)
+        self.assertTrue('rlb_operation_seconds_count{'
+                        'operation="reddit.get_new"} 2' in lines)
+        self.assertTrue('rlb_operation_errors_total{'
+                        'operation="reddit.get_new"} 1' in lines)
+
+    def test_end_pass(self):
+        self.registry.count("videos", 3)
+        self.registry.observe("reddit.get_new", 0.2)
+        self.clock.now = 60
+        self.registry.end_pass()
+        self.registry.observe("reddit.get_new", 20)
+
+        snapshot = self.registry.snapshot()
+        self.assertEquals(snapshot["started"], 60)
+        self.assertEquals(snapshot["counters"], {})
+        summary = snapshot["operations"]["reddit.get_new"]
+        self.assertEquals(summary["count"], 1)
+        self.assertEquals(summary["max"], 20)
+        #
+        # Prometheus gets the totals.
+        #
+        lines = self.registry.prometheus().splitlines()
+        self.assertTrue("rlb_videos_total 3" in lines)
+        self.assertTrue('rlb_operation_seconds_count{'
+                        'operation="reddit.get_new"} 2' in lines)
+
+    def test_write(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self.registry.count("videos", 3)
+        path = P.join(tmpdir, "metrics.json")
+        self.registry.write_json(path)
+        with open(path) as fin:
+            self.assertEquals(json.load(fin)["counters"], {"videos": 3})
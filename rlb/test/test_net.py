@@ -0,0 +1,90 @@
+import unittest
+from StringIO import StringIO
+
+from mock import patch
+from requests_toolbelt import MultipartEncoder
+
+import rlb.net
+
+
+class TestCreateSession(unittest.TestCase):
+
+    def test_session(self):
+        session = rlb.net.create_session("user_agent", pool_size=7,
+                                         max_retries=2)
+        self.assertEquals(session.headers["User-Agent"], "user_agent")
+        for prefix in ["http://", "https://"]:
+            adapter = session.get_adapter(prefix + "www.liveleak.com/")
+            self.assertEquals(adapter._pool_maxsize, 7)
+            self.assertEquals(adapter.max_retries.total, 2)
+            self.assertFalse(adapter.max_retries.is_retry("POST", 503))
+            self.assertFalse(adapter.max_retries.is_retry("PUT", 503))
+            self.assertTrue(adapter.max_retries.is_retry("GET", 503))
+            self.assertEquals(adapter.timeout, 60)
+
+    def test_timeout(self):
+        adapter = rlb.net.TimeoutAdapter(5)
+        with patch("requests.adapters.HTTPAdapter.send") as mock_send:
+            adapter.send("request", timeout=None)
+            mock_send.assert_called_with(adapter, "request", timeout=5)
+            adapter.send("request", timeout=1)
+            mock_send.assert_called_with(adapter, "request", timeout=1)
+
+
+class FakeClock(object):
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+class TestRateLimiter(unittest.TestCase):
+
+    def test_bytes(self):
+        clock = FakeClock()
+        limiter = rlb.net.RateLimiter(1024, 128, clock, clock.sleep)
+        for _ in range(9):
+            limiter.acquire(128)
+        self.assertAlmostEquals(clock.now, 1.0)
+
+    def test_more_than_burst(self):
+        clock = FakeClock()
+        limiter = rlb.net.RateLimiter(1024, 128, clock, clock.sleep)
+        limiter.acquire(640)
+        self.assertAlmostEquals(clock.now, 0.0)
+        limiter.acquire(128)
+        self.assertAlmostEquals(clock.now, 0.625)
+
+
+class TestUploadProgress(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        limiter = rlb.net.RateLimiter(1024, 128, self.clock,
+                                      self.clock.sleep)
+        self.progress = rlb.net.UploadProgress(limiter, self.clock)
+
+    def test_reader(self):
+        reader = self.progress.reader("x" * 1152)
+        self.assertEquals(reader.len, 1152)
+        blocks = iter(lambda: reader.read(128), "")
+        self.assertEquals("".join(blocks), "x" * 1152)
+        self.progress.finish()
+        self.assertEquals(self.progress.bytes_sent, 1152)
+        self.assertAlmostEquals(self.progress.elapsed, 1.0)
+        self.assertAlmostEquals(self.progress.throughput, 1152)
+
+    def test_monitor(self):
+        fin = StringIO("x" * 2000)
+        encoder = MultipartEncoder(fields=[("name", "value"),
+                                           ("file", ("f", fin, "video/mp4"))])
+        monitor = self.progress.monitor(encoder)
+        body = "".join(iter(lambda: monitor.read(128), ""))
+        self.assertTrue("x" * 2000 in body)
+        self.assertEquals(self.progress.bytes_sent, len(body))
+        self.assertTrue(self.clock.now > 1.5)
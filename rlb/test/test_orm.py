@@ -0,0 +1,101 @@
+import unittest
+import datetime as dt
+
+from sqlalchemy import create_engine, inspect
+from sqlalchemy.orm import sessionmaker
+
+from rlb.orm import Base, Video, Subreddit, upgrade
+
+#
+# The videos table as bin/createdb.py used to create it.
+#
+OLD_VIDEOS_TABLE = """CREATE TABLE videos (
+    "youtubeId" VARCHAR NOT NULL,
+    "redditSubmissionPermalink" VARCHAR,
+    "downloadAttempts" INTEGER,
+    "localPath" VARCHAR,
+    "liveleakId" VARCHAR,
+    state INTEGER,
+    discovered DATETIME,
+    "localModified" DATETIME,
+    deleted DATETIME,
+    PRIMARY KEY ("youtubeId")
+)"""
+
+OLD_SUBREDDITS_TABLE = """CREATE TABLE subreddits (
+    id VARCHAR NOT NULL,
+    "mostRecentSubmission" DATETIME,
+    "mostRecentComment" DATETIME,
+    PRIMARY KEY (id)
+)"""
+
+
+def query_plan(engine, query):
+    compiled = query.statement.compile(dialect=engine.dialect)
+    params = tuple(compiled.params[key] for key in compiled.positiontup)
+    rows = engine.execute("EXPLAIN QUERY PLAN " + str(compiled),
+                          params).fetchall()
+    return " ".join(str(r[-1]) for r in rows)
+
+
+class TestIndexes(unittest.TestCase):
+
+    def setUp(self):
+        self.engine = create_engine("sqlite:///")
+        Base.metadata.create_all(self.engine)
+        self.db = sessionmaker(bind=self.engine)()
+
+    def test_state(self):
+        plan = query_plan(self.engine,
+                          self.db.query(Video).filter_by(state=Video.STALE))
+        self.assertTrue("ix_videos_state_discovered" in plan, plan)
+
+    def test_state_discovered(self):
+        query = self.db.query(Video)\
+            .filter(Video.state == Video.DOWNLOADED)\
+            .filter(Video.discovered < dt.datetime.now())
+        plan = query_plan(self.engine, query)
+        self.assertTrue("ix_videos_state_discovered" in plan, plan)
+
+    def test_queue(self):
+        query = self.db.query(Video).filter_by(state=Video.PROBED)\
+            .order_by(Video.priority.desc()).limit(10)
+        plan = query_plan(self.engine, query)
+        self.assertTrue("ix_videos_state_priority" in plan, plan)
+        self.assertFalse("TEMP B-TREE" in plan, plan)
+
+    def test_liveleak_id(self):
+        plan = query_plan(self.engine,
+                          self.db.query(Video).filter_by(liveleakId="abc"))
+        self.assertTrue("ix_videos_liveleakId" in plan, plan)
+
+
+class TestUpgrade(unittest.TestCase):
+
+    def test_upgrade(self):
+        engine = create_engine("sqlite:///")
+        engine.execute(OLD_VIDEOS_TABLE)
+        engine.execute(OLD_SUBREDDITS_TABLE)
+        engine.execute("INSERT INTO subreddits VALUES "
+                       "('UkrainianConflict', NULL, NULL)")
+
+        upgrade(engine)
+
+        inspector = inspect(engine)
+        names = set(i["name"] for i in inspector.get_indexes("videos"))
+        self.assertEquals(
+            names, set(["ix_videos_state_discovered", "ix_videos_liveleakId",
+                        "ix_videos_state_priority", "ix_videos_channelId"]))
+        columns = set(c["name"] for c in inspector.get_columns("subreddits"))
+        self.assertTrue("newestSubmission" in columns)
+        self.assertTrue("newestSubmissionCreated" in columns)
+        self.assertTrue("newestSubmissionChecked" in columns)
+
+        db = sessionmaker(bind=engine)()
+        sub_info = db.query(Subreddit).one()
+        self.assertEquals(sub_info.newestSubmission, None)
+
+        #
+        # Upgrading an up-to-date database does nothing.
+        #
+        upgrade(engine)
@@ -0,0 +1,65 @@
+import threading
+import unittest
+
+from rlb.pipeline import Pipeline, Stage
+
+
+class TestPipeline(unittest.TestCase):
+
+    def test_run(self):
+        results = []
+
+        def on_result(stage_name, job, result):
+            results.append((stage_name, job, result))
+            return "double" if stage_name == "increment" else None
+
+        pipeline = Pipeline([Stage("increment", lambda x: x + 1, 2),
+                             Stage("double", lambda x: x * 2, 3)],
+                            on_result, None)
+        pipeline.run([("increment", 1), ("increment", 2), ("double", 5)])
+
+        self.assertEquals(sorted(results),
+                          [("double", 1, 2), ("double", 2, 4),
+                           ("double", 5, 10), ("increment", 1, 2),
+                           ("increment", 2, 3)])
+
+    def test_error(self):
+        errors = []
+
+        def fail(job):
+            raise ValueError(job)
+
+        pipeline = Pipeline([Stage("fail", fail)], None,
+                            lambda *args: errors.append(args))
+        pipeline.run([("fail", "job")])
+
+        self.assertEquals(len(errors), 1)
+        stage_name, job, ex = errors[0]
+        self.assertEquals((stage_name, job), ("fail", "job"))
+        self.assertTrue(isinstance(ex, ValueError))
+
+    def test_results_on_calling_thread(self):
+        threads = []
+        pipeline = Pipeline(
+            [Stage("noop", lambda x: x, 4)],
+            lambda *args: threads.append(threading.current_thread()), None)
+        pipeline.run([("noop", i) for i in range(10)])
+
+        self.assertEquals(threads, [threading.current_thread()] * 10)
+
+    def test_no_jobs(self):
+        pipeline = Pipeline([Stage("noop", lambda x: x)], None, None)
+        pipeline.run([])
+
+    def test_progress(self):
+        progress = []
+        pipeline = Pipeline([Stage("report", None)], lambda *args: None, None,
+                            lambda *args: progress.append(args))
+
+        def report(job):
+            pipeline.progress("report", job, "halfway")
+
+        pipeline.stages["report"].func = report
+        pipeline.run([("report", "job")])
+
+        self.assertEquals(progress, [("report", "job", "halfway")])
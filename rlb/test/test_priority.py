@@ -0,0 +1,38 @@
+import unittest
+import datetime as dt
+
+from rlb.priority import channel_risk, priority
+
+PUBLISHED = dt.datetime(2014, 7, 16, 12, 0, 0)
+
+
+class TestPriority(unittest.TestCase):
+
+    def test_subreddit_weight(self):
+        self.assertTrue(priority(PUBLISHED, subreddit_weight=2) >
+                        priority(PUBLISHED, subreddit_weight=1))
+
+    def test_velocity(self):
+        fast = priority(PUBLISHED, reddit_score=100, submission_age=3600)
+        slow = priority(PUBLISHED, reddit_score=100, submission_age=36000)
+        self.assertTrue(fast > slow)
+
+    def test_new_submission(self):
+        #
+        # A couple of points in the first minute isn't a lot of velocity.
+        #
+        self.assertAlmostEquals(
+            priority(PUBLISHED, reddit_score=2, submission_age=60),
+            priority(PUBLISHED, reddit_score=2, submission_age=3600))
+
+    def test_channel_history(self):
+        self.assertEquals(channel_risk(0, 0), 0.5)
+        risky = priority(PUBLISHED, takedowns=3, channel_videos=4)
+        safe = priority(PUBLISHED, takedowns=0, channel_videos=4)
+        self.assertTrue(risky > priority(PUBLISHED) > safe)
+
+    def test_half_life(self):
+        older = PUBLISHED - dt.timedelta(hours=24)
+        self.assertAlmostEquals(
+            priority(PUBLISHED, subreddit_weight=1, half_life_hours=24),
+            priority(older, subreddit_weight=2, half_life_hours=24))
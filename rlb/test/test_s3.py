@@ -0,0 +1,76 @@
+import os
+import tempfile
+import unittest
+
+import rlb.net
+import rlb.s3 as s3
+from rlb.fakes import FakeS3
+
+PART_SIZE = 1024
+
+
+class TestMultipartUpload(unittest.TestCase):
+
+    def setUp(self):
+        self.s3 = FakeS3().start()
+        self.addCleanup(self.s3.stop)
+        #
+        # The same retries as the bot's session, so that we see how they
+        # combine with MultipartUpload's own.
+        #
+        self.session = rlb.net.create_session("user_agent")
+        self.data = os.urandom(PART_SIZE * 5 / 2)
+        fd, self.path = tempfile.mkstemp()
+        with os.fdopen(fd, "wb") as fout:
+            fout.write(self.data)
+        self.addCleanup(os.remove, self.path)
+
+    def upload(self, upload_id=None, **kwargs):
+        return s3.MultipartUpload(
+            self.session, self.s3.base_url + "/bucket/key.mp4", upload_id,
+            PART_SIZE, sleep=lambda seconds: None, **kwargs)
+
+    def test_upload(self):
+        parts = []
+        response = self.upload().upload(
+            self.path, lambda *args: parts.append(args))
+        self.assertEquals(self.s3.objects["bucket/key.mp4"], self.data)
+        self.assertEquals(parts, [(1, 3), (2, 3), (3, 3)])
+        self.assertTrue("<Key>bucket/key.mp4</Key>" in response)
+
+    def test_retry(self):
+        self.s3.failures = 2
+        self.upload().upload(self.path)
+        self.assertEquals(self.s3.objects["bucket/key.mp4"], self.data)
+        self.assertEquals(self.s3.part_requests, 5)
+
+    def test_give_up(self):
+        self.s3.failures = 1000
+        self.assertRaises(s3.S3Exception, self.upload(max_retries=1).upload,
+                          self.path)
+        self.assertEquals(self.s3.part_requests, 2)
+
+    def test_resume(self):
+        #
+        # The first part makes it, then the connection drops.
+        #
+        first = self.upload(max_retries=0)
+        upload_id = first.start()
+        parts = []
+
+        def on_part(number, count):
+            parts.append(number)
+            self.s3.failures = 1
+
+        self.assertRaises(s3.S3Exception, first.upload, self.path, on_part)
+        self.assertEquals(parts, [1])
+
+        second = self.upload(upload_id)
+        self.assertEquals(second.uploaded_parts().keys(), [1])
+        second.upload(self.path, lambda number, count: parts.append(number))
+        self.assertEquals(parts, [1, 2, 3])
+        self.assertEquals(self.s3.objects["bucket/key.mp4"], self.data)
+
+    def test_no_such_upload(self):
+        self.assertRaises(s3.NoSuchUpload, self.upload("expired").upload,
+                          self.path)
@@ -0,0 +1,63 @@
+import unittest
+from mock import Mock
+
+from rlb.scheduler import Scheduler
+
+
+class FakeClock(object):
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+class TestScheduler(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.scheduler = Scheduler(clock=self.clock, sleep=self.clock.sleep)
+
+    def test_intervals(self):
+        fast = Mock()
+        slow = Mock()
+        self.scheduler.add("fast", 10, fast)
+        self.scheduler.add("slow", 25, slow)
+
+        while self.clock.now <= 60:
+            self.clock.sleep(self.scheduler.run_pending())
+
+        self.assertEquals(fast.call_count, 7)  # 0, 10, ..., 60
+        self.assertEquals(slow.call_count, 3)  # 0, 25, 50
+
+    def test_disabled(self):
+        func = Mock()
+        self.scheduler.add("disabled", 0, func)
+        self.assertEquals(self.scheduler.run_pending(), None)
+        self.assertEquals(func.called, False)
+
+    def test_exception(self):
+        def broken():
+            raise RuntimeError("broken")
+        other = Mock()
+        self.scheduler.add("broken", 10, broken)
+        self.scheduler.add("other", 10, other)
+
+        self.assertEquals(self.scheduler.run_pending(), 10)
+        self.assertEquals(other.call_count, 1)
+
+    def test_overrun(self):
+        def slow():
+            self.clock.now += 30
+        self.scheduler.add("slow", 10, slow)
+        self.scheduler.run_pending()
+        #
+        # Missed runs are skipped, not queued up.
+        #
+        self.assertEquals(self.scheduler.tasks[0].next_run, 30)
+        self.assertEquals(self.scheduler.run_pending(), 0)
+        self.assertEquals(self.scheduler.tasks[0].next_run, 60)
@@ -0,0 +1,165 @@
+import unittest
+import os
+import os.path as P
+import shutil
+import tempfile
+
+from mock import patch
+
+from rlb.storage import VideoIndex, video_id_from_filename, video_dir, \
+    shard_directory, ensure_dir, DiskBudget
+
+CURRENT_DIR = P.dirname(P.abspath(__file__))
+
+
+class TestVideoIdFromFilename(unittest.TestCase):
+
+    def test_positive(self):
+        self.assertEquals(video_id_from_filename("-8_0eAME3Xw.mp4"),
+                          "-8_0eAME3Xw")
+
+    def test_partial(self):
+        self.assertEquals(video_id_from_filename("-8_0eAME3Xw.mp4.part"),
+                          None)
+
+
+class TestVideoIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        for f in ["IU5NSSzYygk.mp4", "co9IZOSssFw.webm",
+                  "Cy0RPWK_5wg.mp4.part"]:
+            open(P.join(self.tmpdir, f), "w").close()
+        self.index = VideoIndex(self.tmpdir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_positive(self):
+        index = VideoIndex(CURRENT_DIR)
+        actual = index.locate("foreman_cif")
+        expected = P.join(CURRENT_DIR, "foreman_cif.mp4")
+        self.assertEqual(expected, actual)
+
+    def test_negative(self):
+        index = VideoIndex(CURRENT_DIR)
+        self.assertEqual(None, index.locate("not_there"))
+
+    def test_build(self):
+        self.assertEquals(len(self.index), 2)
+        self.assertEquals(self.index.locate("co9IZOSssFw"),
+                          P.join(self.tmpdir, "co9IZOSssFw.webm"))
+        self.assertFalse("Cy0RPWK_5wg" in self.index)
+
+    def test_add(self):
+        path = P.join(self.tmpdir, "N-gPAMeXlQk.mkv")
+        with open(path, "w") as fout:
+            fout.write("video")
+        self.index.add("N-gPAMeXlQk", path)
+        self.assertEquals(self.index.locate("N-gPAMeXlQk"), path)
+        self.assertEquals(self.index.total_bytes, 5)
+
+    def test_discard(self):
+        os.remove(P.join(self.tmpdir, "IU5NSSzYygk.mp4"))
+        self.index.discard("IU5NSSzYygk")
+        self.assertEquals(self.index.locate("IU5NSSzYygk"), None)
+
+    def test_rebuild(self):
+        open(P.join(self.tmpdir, "N-gPAMeXlQk.mp4"), "w").close()
+        self.index.rebuild()
+        self.assertEquals(len(self.index), 3)
+
+
+class TestShardedVideoIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        for f in ["IU5NSSzYygk.mp4", "co9IZOSssFw.webm", "notes.txt/"]:
+            if f.endswith("/"):
+                os.mkdir(P.join(self.tmpdir, f))
+            else:
+                open(P.join(self.tmpdir, f), "w").close()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_video_dir(self):
+        self.assertEquals(video_dir(self.tmpdir, "IU5NSSzYygk", True),
+                          P.join(self.tmpdir, "IU", "5N"))
+        self.assertEquals(video_dir(self.tmpdir, "IU5NSSzYygk", False),
+                          self.tmpdir)
+
+    def test_shard_directory(self):
+        self.assertEquals(shard_directory(self.tmpdir), 2)
+        self.assertTrue(P.isfile(P.join(self.tmpdir, "IU", "5N",
+                                        "IU5NSSzYygk.mp4")))
+        self.assertFalse(P.exists(P.join(self.tmpdir, "IU5NSSzYygk.mp4")))
+
+        index = VideoIndex(self.tmpdir, sharded=True)
+        self.assertEquals(len(index), 2)
+        self.assertEquals(index.locate("co9IZOSssFw"),
+                          P.join(self.tmpdir, "co", "9I", "co9IZOSssFw.webm"))
+
+        #
+        # Running it again shouldn't move anything.
+        #
+        self.assertEquals(shard_directory(self.tmpdir), 0)
+
+    def test_add(self):
+        index = VideoIndex(self.tmpdir, sharded=True)
+        self.assertEquals(len(index), 0)
+        subdir = index.video_dir("N-gPAMeXlQk")
+        ensure_dir(subdir)
+        ensure_dir(subdir)
+        path = P.join(subdir, "N-gPAMeXlQk.mp4")
+        open(path, "w").close()
+        index.add("N-gPAMeXlQk", path)
+        self.assertEquals(index.locate("N-gPAMeXlQk"), path)
+        self.assertEquals(VideoIndex(self.tmpdir, sharded=True)
+                          .locate("N-gPAMeXlQk"), path)
+
+
+class TestDiskBudget(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        for f, size in [("IU5NSSzYygk.mp4", 100), ("co9IZOSssFw.webm", 50)]:
+            with open(P.join(self.tmpdir, f), "wb") as fout:
+                fout.write("x" * size)
+        self.index = VideoIndex(self.tmpdir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_total_bytes(self):
+        self.assertEquals(self.index.total_bytes, 150)
+        path = P.join(self.tmpdir, "IU5NSSzYygk.mp4")
+        self.index.discard("IU5NSSzYygk")
+        self.assertEquals(self.index.total_bytes, 50)
+        self.index.add("IU5NSSzYygk", path)
+        self.assertEquals(self.index.total_bytes, 150)
+        #
+        # Adding a video that's already indexed doesn't count it twice.
+        #
+        self.index.add("IU5NSSzYygk", path)
+        self.assertEquals(self.index.total_bytes, 150)
+
+    def test_lazy(self):
+        with patch("rlb.storage.file_size") as mock_file_size:
+            mock_file_size.return_value = 10
+            index = VideoIndex(self.tmpdir)
+            index.discard("co9IZOSssFw")
+            self.assertEquals(mock_file_size.called, False)
+            self.assertEquals(index.total_bytes, 10)
+            self.assertEquals(mock_file_size.call_count, 1)
+
+    def test_max_bytes(self):
+        self.assertEquals(DiskBudget().excess(self.index), 0)
+        self.assertEquals(DiskBudget(max_bytes=200).excess(self.index), 0)
+        self.assertEquals(DiskBudget(max_bytes=120).excess(self.index), 30)
+
+    def test_min_free_percent(self):
+        self.assertEquals(
+            DiskBudget(min_free_percent=0.0001).excess(self.index), 0)
+        budget = DiskBudget(min_free_percent=100)
+        self.assertTrue(budget.excess(self.index) > 0)
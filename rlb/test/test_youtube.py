@@ -1,8 +1,13 @@
 import unittest
+import datetime
 import mock
+import os.path as P
+import shutil
+import tempfile
 
-import rlb.main
+import rlb.net
 import rlb.youtube as youtube
+from rlb.fakes import FakeYoutubeApi, FakeYoutubeDL
 
 
 class TestExtractYouTubeId(unittest.TestCase):
@@ -50,37 +55,242 @@ v=LEN5rn47gYQ"
 a=P3m5pZfhr5Y&u=%2Fwatch%3Fv%3DHnc-1rXLx_4%26feature%3Dshare"
         self.assertEquals(youtube.extract_id(url), "Hnc-1rXLx_4")
 
+    def test_attribution_lowercase(self):
+        url = "https://www.youtube.com/attribution_link?\
+a=P3m5pZfhr5Y&u=%2fwatch%3fv%3dHnc-1rXLx_4%26feature%3dshare"
+        self.assertEquals(youtube.extract_id(url), "Hnc-1rXLx_4")
+
+    def test_mobile(self):
+        url = "https://m.youtube.com/watch?v=IU5NSSzYygk"
+        self.assertEquals(youtube.extract_id(url), "IU5NSSzYygk")
+
+    def test_embed(self):
+        url = "https://www.youtube.com/embed/IU5NSSzYygk?autoplay=1"
+        self.assertEquals(youtube.extract_id(url), "IU5NSSzYygk")
+
+    def test_nocookie(self):
+        url = "https://www.youtube-nocookie.com/embed/IU5NSSzYygk"
+        self.assertEquals(youtube.extract_id(url), "IU5NSSzYygk")
+
+    def test_shorts(self):
+        url = "https://youtube.com/shorts/IU5NSSzYygk"
+        self.assertEquals(youtube.extract_id(url), "IU5NSSzYygk")
+
+    def test_v(self):
+        url = "http://www.youtube.com/v/IU5NSSzYygk?version=3"
+        self.assertEquals(youtube.extract_id(url), "IU5NSSzYygk")
+
+    def test_negative_channel(self):
+        url = "https://www.youtube.com/channel/UCupvZG-5ko_eiXAupbDfxWw"
+        self.assertEquals(youtube.extract_id(url), None)
+
+    def test_negative_too_long(self):
+        url = "https://www.youtube.com/watch?v=IU5NSSzYygkX"
+        self.assertEquals(youtube.extract_id(url), None)
+
+    def test_extract_ids(self):
+        urls = ["http://youtu.be/co9IZOSssFw",
+                "http://i.imgur.com/KJ0h3nZ.png",
+                "https://www.youtube.com/watch?v=IU5NSSzYygk"]
+        self.assertEquals(youtube.extract_ids(urls),
+                          ["co9IZOSssFw", None, "IU5NSSzYygk"])
+
+
+class TestCheckChunk(unittest.TestCase):
+
+    @mock.patch("requests.get")
+    def test_failure(self, mock_get):
+        mock_get.return_value = mock.Mock(status_code=403, text="quota")
+        self.assertRaises(youtube.YoutubeException, youtube.check_chunk,
+                          ["jNQXAC9IVRw"], "user_agent", "key")
+
+
+class TestRateLimiter(unittest.TestCase):
 
-class TestVideoExists(unittest.TestCase):
+    def test_rate(self):
+        now = [0.0]
+
+        def sleep(seconds):
+            now[0] += seconds
+        limiter = youtube.RateLimiter(4, clock=lambda: now[0], sleep=sleep)
+        for _ in range(9):
+            limiter.acquire()
+        self.assertAlmostEquals(now[0], 2.0)
+
+
+class TestAvailabilityChecker(unittest.TestCase):
 
     def setUp(self):
-        self.cfg = rlb.main.Config()
+        self.video_ids = ["video%06d" % i for i in range(230)]
+        self.alive = set(self.video_ids[::3])
+        self.api = FakeYoutubeApi(self.alive).start()
+        self.addCleanup(self.api.stop)
 
-    def test_positive(self):
-        video_id = "jNQXAC9IVRw"
-        self.assertTrue(youtube.video_exists(video_id, self.cfg.user_agent,
-                                             self.cfg.google_developer_key))
+    def checker(self, **kwargs):
+        return youtube.AvailabilityChecker(
+            "user_agent", "key", url=self.api.url, requests_per_second=1000,
+            backoff=0.01, **kwargs)
 
-    def test_negative(self):
-        video_id = "Y7UmFIpenjs"
-        self.assertFalse(youtube.video_exists(video_id, self.cfg.user_agent,
-                                              self.cfg.google_developer_key))
-
-
-#
-# http://www.toptal.com/python/an-introduction-to-mocking-in-python
-# http://alexmarandon.com/articles/python_mock_gotchas/
-#
-class TestDownload(unittest.TestCase):
-
-    @mock.patch("subprocess.Popen")
-    def test_success(self, mock_popen):
-        mock_popen.return_value.communicate.return_value = "stdin", "stdout"
-        mock_popen.return_value.returncode = 0
-        rlb.youtube.download(".", "dummy")
-
-    @mock.patch("subprocess.Popen")
-    def test_failure(self, mock_popen):
-        mock_popen.return_value.communicate.return_value = "stdin", "stdout"
-        mock_popen.return_value.returncode = 1
-        rlb.youtube.download(".", "dummy")
+    def test_check(self):
+        alive, unknown = self.checker().check(self.video_ids)
+        self.assertEquals(alive, self.alive)
+        self.assertEquals(unknown, set())
+        self.assertEquals(self.api.requests, 5)
+
+    def test_retry(self):
+        self.api.failures = 2
+        alive, unknown = self.checker().check(self.video_ids)
+        self.assertEquals(alive, self.alive)
+        self.assertEquals(unknown, set())
+        self.assertEquals(self.api.requests, 7)
+
+    def test_give_up(self):
+        self.api.failures = 1000
+        alive, unknown = self.checker(max_retries=1).check(self.video_ids)
+        self.assertEquals(alive, set())
+        self.assertEquals(unknown, set(self.video_ids))
+        self.assertEquals(self.api.requests, 10)
+
+    def test_session(self):
+        self.api.failures = 1000
+        checker = self.checker(max_retries=2, session=rlb.net.create_session(
+            "user_agent", max_retries=0, backoff_factor=0))
+        checker.limiter = mock.Mock(wraps=checker.limiter)
+        alive, unknown = checker.check(self.video_ids[:50])
+        self.assertEquals(unknown, set(self.video_ids[:50]))
+        #
+        # Each attempt is a single request, and goes through the limiter.
+        #
+        self.assertEquals(self.api.requests, 3)
+        self.assertEquals(checker.limiter.acquire.call_count, 3)
+
+    def test_empty(self):
+        self.assertEquals(self.checker().check([]), (set(), set()))
+        self.assertEquals(self.api.requests, 0)
+
+
+class TestDetails(unittest.TestCase):
+
+    def setUp(self):
+        self.api = FakeYoutubeApi(["alive"], channels={"alive": "UCabc"},
+                                  duration="PT1H2M3S").start()
+
+    def tearDown(self):
+        self.api.stop()
+
+    def test_details(self):
+        checker = youtube.AvailabilityChecker(
+            "user_agent", "key", requests_per_second=1000, url=self.api.url)
+        details, unknown = checker.details(["alive", "dead"])
+        self.assertEquals(details, {"alive": {
+            "channel_id": "UCabc",
+            "published": datetime.datetime(2014, 7, 16, 12, 0, 0),
+            "duration": 3723}})
+        self.assertEquals(unknown, set())
+        self.assertEquals(self.api.requests, 1)
+
+    def test_parse_duration(self):
+        self.assertEquals(youtube.parse_duration("PT45S"), 45)
+        self.assertEquals(youtube.parse_duration("P1DT1M"), 86460)
+        self.assertEquals(youtube.parse_duration("P0D"), 0)
+        self.assertEquals(youtube.parse_duration("PT"), None)
+        self.assertEquals(youtube.parse_duration(None), None)
+
+
+class TestFormatPolicy(unittest.TestCase):
+
+    def test_no_limits(self):
+        policy = youtube.FormatPolicy()
+        self.assertFalse(policy.limited)
+        self.assertEquals(policy.format_spec(), None)
+        self.assertEquals(policy.check({"duration": 86400}), None)
+
+    def test_container(self):
+        policy = youtube.FormatPolicy(container="mp4")
+        self.assertFalse(policy.limited)
+        self.assertEquals(policy.format_spec(), "best[ext=mp4]/best")
+
+    def test_format_spec(self):
+        policy = youtube.FormatPolicy(720, 1000, container="mp4")
+        self.assertEquals(
+            policy.format_spec(),
+            "best[ext=mp4][height<=?720][filesize<=?1000]/"
+            "best[height<=?720][filesize<=?1000]/worst")
+
+    def test_check(self):
+        policy = youtube.FormatPolicy(720, 1000, 600)
+        self.assertEquals(policy.check(
+            {"duration": 600, "height": 720, "filesize": 1000}), None)
+        self.assertEquals(policy.check({"duration": 601}),
+                          "duration 601s over 600s")
+        self.assertEquals(policy.check({"height": 1080}),
+                          "height 1080p over 720p")
+        self.assertEquals(policy.check({"filesize_approx": 2000}),
+                          "filesize 2000 over 1000 bytes")
+
+
+class TestDownloadEngine(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.created = []
+
+        def factory(params):
+            ydl = FakeYoutubeDL(params, size=10, unavailable=["gone"])
+            self.created.append(ydl)
+            return ydl
+        self.engine = youtube.DownloadEngine(factory=factory)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_success(self):
+        path = self.engine.download(self.tmpdir, "IU5NSSzYygk")
+        self.assertEquals(path, P.join(self.tmpdir, "IU5NSSzYygk.mp4"))
+        self.assertEquals(P.getsize(path), 10)
+
+    def test_failure(self):
+        self.assertEquals(self.engine.download(self.tmpdir, "gone"), None)
+        #
+        # The instance is still good for the next download.
+        #
+        self.assertNotEquals(self.engine.download(self.tmpdir, "dummy"), None)
+        self.assertEquals(len(self.created), 1)
+
+    def test_reuse(self):
+        for youtube_id in ["a", "b", "c"]:
+            self.engine.download(self.tmpdir, youtube_id)
+        self.assertEquals(len(self.created), 1)
+
+    def test_workers(self):
+        #
+        # Downloads that overlap get an instance each.
+        #
+        first = self.engine._borrow()
+        second = self.engine._borrow()
+        self.assertNotEquals(first, second)
+        self.engine._return(first)
+        self.engine._return(second)
+        self.assertEquals(len(self.created), 2)
+
+    def test_policy(self):
+        policy = youtube.FormatPolicy(max_height=1080, container="mp4")
+        path = self.engine.download(self.tmpdir, "IU5NSSzYygk", policy)
+        self.assertEquals(path, P.join(self.tmpdir, "IU5NSSzYygk.mp4"))
+        ydl = self.created[0]
+        self.assertEquals(ydl.params["format"], policy.format_spec())
+        #
+        # The download reuses what the probe found out.
+        #
+        self.assertEquals(ydl.extractions, 1)
+
+    def test_skipped(self):
+        policy = youtube.FormatPolicy(max_duration=30)
+        self.assertRaises(youtube.VideoSkipped, self.engine.download,
+                          self.tmpdir, "IU5NSSzYygk", policy)
+        self.assertFalse(P.exists(P.join(self.tmpdir, "IU5NSSzYygk.mp4")))
+
+    def test_progress(self):
+        ydl = self.engine._borrow()
+        self.assertEquals(ydl.hooks, [youtube.progress_hook])
+        self.assertEquals(ydl.params["logger"], youtube.YOUTUBE_DL_LOGGER)
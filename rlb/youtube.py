@@ -1,67 +1,434 @@
 import re
 import requests
+import datetime
+import functools
 import json
 import logging
 import os.path as P
-import subprocess as sub
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+import youtube_dl
+from youtube_dl.utils import DownloadError
+
+import metrics
+from net import RateLimiter
 
 logger = logging.getLogger(__name__)
 
+API_URL = "https://www.googleapis.com/youtube/v3/videos"
 
-def extract_id(url):
-    """Extract a YouTube ID from a URL."""
-    #
-    # YouTube attribution links.
-    # More info:
-    # http://techcrunch.com/2011/06/01/youtube-now-lets-you-license-videos-under-creative-commons-remixers-rejoice/
-    # Example:
-    # http://www.youtube.com/attribution_link?a=P3m5pZfhr5Y&u=%2Fwatch%3Fv%3DHnc-1rXLx_4%26feature%3Dshare
-    m = re.search("watch%3Fv%3D(?P<id>[a-zA-Z0-9-_]{11})", url)
-    if m:
-        return m.group("id")
+#
+# Ask the videos endpoint for only the metadata we use, to keep the
+# responses small.
+#
+DETAILS_FIELDS = ("items(id,snippet(channelId,publishedAt),"
+                  "contentDetails(duration))")
+
+#
+# An ISO 8601 duration, as the Data API gives it, e.g. PT1H2M3S.
+#
+DURATION = re.compile(
+    r"P(?:(\d+)D)?(?:T(?:(\d+)H)?(?:(\d+)M)?(?:(\d+)S)?)?$")
+
+#
+# Where youtube_dl saves a video, relative to the destination directory.
+#
+TEMPLATE = "%(id)s.%(ext)s"
+
+#
+# youtube_dl's own messages, including its debug output.
+#
+YOUTUBE_DL_LOGGER = logging.getLogger(__name__ + ".youtube_dl")
 
-    #
-    # Regular YouTube links.
-    #
-    m = re.search(r"youtu\.?be.*(v=|/)(?P<id>[a-zA-Z0-9-_]{11})", url)
+#
+# The maximum number of comma-separated IDs the videos endpoint accepts.
+#
+MAX_IDS_PER_REQUEST = 50
+
+#
+# Matches all the forms of YouTube links we know about in a single pass:
+#
+# http://youtu.be/co9IZOSssFw
+# https://www.youtube.com/watch?v=IU5NSSzYygk
+# https://m.youtube.com/watch?feature=player_embedded&amp;v=LEN5rn47gYQ
+# https://www.youtube.com/embed/IU5NSSzYygk (also /shorts/, /v/ and /live/)
+# http://www.youtube-nocookie.com/embed/IU5NSSzYygk
+#
+# and YouTube attribution links.  More info:
+# http://techcrunch.com/2011/06/01/youtube-now-lets-you-license-videos-under-creative-commons-remixers-rejoice/
+# Example:
+# http://www.youtube.com/attribution_link?a=P3m5pZfhr5Y&u=%2Fwatch%3Fv%3DHnc-1rXLx_4%26feature%3Dshare
+#
+YOUTUBE_URL = re.compile(r"""
+    (?:
+        youtu\.be/
+      | youtube(?:-nocookie)?\.com/
+        (?:
+            (?:embed|shorts|v|live)/
+          | [^#]*?[?&;]v=
+          | [^#]*?watch%3Fv%3D
+        )
+    )
+    (?P<id>[a-zA-Z0-9_-]{11})(?![a-zA-Z0-9_-])""", re.VERBOSE | re.IGNORECASE)
+
+
+def extract_id(url):
+    """Extract a YouTube ID from a URL.
+    Returns None if the URL doesn't link to a YouTube video."""
+    m = YOUTUBE_URL.search(url)
     if m:
         return m.group("id")
     return None
 
 
-def video_exists(youtube_id, user_agent, developer_key):
-    """Return True if the video is still accessible on YouTube."""
-    meth_name = "youtube_video_exists"
-    url = "https://www.googleapis.com/youtube/v3/videos"
+def extract_ids(urls):
+    """Extract the YouTube IDs from several URLs, e.g. all the submissions
+    in a listing.  Returns a list with an ID or None for each URL."""
+    search = YOUTUBE_URL.search
+    result = []
+    for url in urls:
+        m = search(url)
+        result.append(m.group("id") if m else None)
+    return result
+
+
+def chunk_ids(youtube_ids):
+    """Split the IDs into lists small enough for a single request."""
+    youtube_ids = list(youtube_ids)
+    return [youtube_ids[i:i + MAX_IDS_PER_REQUEST]
+            for i in range(0, len(youtube_ids), MAX_IDS_PER_REQUEST)]
+
+
+@metrics.timed("youtube.videos")
+def check_chunk(chunk, user_agent, developer_key, session=None, url=API_URL):
+    """Make a single request to find out which of the IDs are still
+    accessible.  Returns them as a set.
+    Raises YoutubeException if the request fails."""
+    meth_name = "check_chunk"
     headers = {"User-Agent": user_agent}
-    params = {"key": developer_key, "part": "id", "id": youtube_id}
-    r = requests.get(url, params=params, headers=headers)
-    logger.debug("%s: youtube_id: %s status_code: %d",
-                 meth_name, repr(youtube_id), r.status_code)
+    params = {"key": developer_key, "part": "id", "id": ",".join(chunk),
+              "maxResults": MAX_IDS_PER_REQUEST}
+    r = (session or requests).get(url, params=params, headers=headers)
+    logger.debug("%s: %d ids status_code: %d",
+                 meth_name, len(chunk), r.status_code)
     if r.status_code != 200:
         logger.error("%s: unexpected status_code: %d",
                      meth_name, r.status_code)
         logger.error("%s: GET response: %s", meth_name, repr(r.text))
         raise YoutubeException("bad HTTP response (%d)" % r.status_code)
     obj = json.loads(r.text)
-    return obj["pageInfo"]["totalResults"] > 0
+    return set(item["id"] for item in obj.get("items", []))
+
+
+@metrics.timed("youtube.details")
+def fetch_details(chunk, user_agent, developer_key, session=None,
+                  url=API_URL):
+    """Make a single request for the metadata of the videos.  Returns a
+    dictionary keyed by the IDs of the videos that are available.  Each
+    value is a dictionary with the channel_id, published (a UTC datetime)
+    and duration (in seconds) of the video, each None if unknown.
+    Raises YoutubeException if the request fails."""
+    meth_name = "fetch_details"
+    headers = {"User-Agent": user_agent}
+    params = {"key": developer_key, "part": "snippet,contentDetails",
+              "id": ",".join(chunk), "maxResults": MAX_IDS_PER_REQUEST,
+              "fields": DETAILS_FIELDS}
+    r = (session or requests).get(url, params=params, headers=headers)
+    logger.debug("%s: %d ids status_code: %d",
+                 meth_name, len(chunk), r.status_code)
+    if r.status_code != 200:
+        logger.error("%s: unexpected status_code: %d",
+                     meth_name, r.status_code)
+        raise YoutubeException("bad HTTP response (%d)" % r.status_code)
+    details = {}
+    for item in json.loads(r.text).get("items", []):
+        snippet = item.get("snippet", {})
+        content_details = item.get("contentDetails", {})
+        details[item["id"]] = {
+            "channel_id": snippet.get("channelId"),
+            "published": parse_timestamp(snippet.get("publishedAt")),
+            "duration": parse_duration(content_details.get("duration"))
+        }
+    return details
+
+
+def parse_timestamp(text):
+    """Parse a timestamp from the Data API, e.g. 2014-07-16T12:34:56.000Z.
+    Returns a UTC datetime, or None if there is no valid timestamp."""
+    try:
+        return datetime.datetime.strptime(
+            text.split(".")[0].rstrip("Z"), "%Y-%m-%dT%H:%M:%S")
+    except (AttributeError, ValueError):
+        return None
+
+
+def parse_duration(text):
+    """Parse an ISO 8601 duration from the Data API, e.g. PT1H2M3S.
+    Returns the number of seconds, or None if there is no valid
+    duration."""
+    match = DURATION.match(text or "")
+    if match is None or not any(match.groups()):
+        return None
+    days, hours, minutes, seconds = [int(g or 0) for g in match.groups()]
+    return ((days * 24 + hours) * 60 + minutes) * 60 + seconds
+
+
+class AvailabilityChecker(object):
+    """Checks which videos are still available on YouTube, and looks up
+    their metadata.
 
+    Keeps up to max_in_flight requests of MAX_IDS_PER_REQUEST IDs each
+    going at the same time, and sends at most requests_per_second of them.
+    A failed request is retried with exponential backoff by the thread that
+    sent it, so it doesn't hold up the others.  Give it a session that
+    doesn't retry on its own, e.g. net.create_session with max_retries=0:
+    every attempt then goes through the rate limiter."""
 
-def download(dest_dir, youtube_id):
-    meth_name = "download"
-    template = P.join(dest_dir, "%(id)s.%(ext)s")
-    args = ["youtube-dl", "--verbose", "--output", template, "--", youtube_id]
-    logger.debug("%s: %s", meth_name, " ".join(args))
-    process = sub.Popen(args, stdin=sub.PIPE, stdout=sub.PIPE,
-                        stderr=sub.STDOUT)
-    stdout, _ = process.communicate()
-    logger.debug("%s: return_code: %d", meth_name, process.returncode)
-    if process.returncode != 0:
-        logger.error("%s: youtube-dl stdout/stderr follows\n%s", meth_name,
-                     stdout)
-        logger.error("%s: youtube-dl exited with an error (%d)",
-                     meth_name, process.returncode)
+    def __init__(self, user_agent, developer_key, session=None,
+                 max_in_flight=4, requests_per_second=10, max_retries=3,
+                 backoff=1.0, url=API_URL):
+        self.user_agent = user_agent
+        self.developer_key = developer_key
+        self.session = session
+        self.max_in_flight = max_in_flight
+        self.limiter = RateLimiter(requests_per_second)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.url = url
+
+    def check(self, youtube_ids):
+        """Returns a pair of sets: the IDs of the videos that are still
+        available, and the IDs we couldn't check, even after retrying."""
+        meth_name = "check"
+        alive = set()
+        unknown = set()
+        for chunk, result in self._map(check_chunk, youtube_ids):
+            if result is None:
+                unknown.update(chunk)
+            else:
+                alive.update(result)
+        logger.info("%s: %d available, %d unknown", meth_name, len(alive),
+                    len(unknown))
+        return alive, unknown
+
+    def details(self, youtube_ids):
+        """Look up the metadata of the videos; see fetch_details.  Returns
+        a dictionary of the details of the videos that are available,
+        keyed by ID, and the set of IDs we couldn't look up."""
+        meth_name = "details"
+        details = {}
+        unknown = set()
+        for chunk, result in self._map(fetch_details, youtube_ids):
+            if result is None:
+                unknown.update(chunk)
+            else:
+                details.update(result)
+        logger.info("%s: %d available, %d unknown", meth_name, len(details),
+                    len(unknown))
+        return details, unknown
+
+    def _map(self, func, youtube_ids):
+        """Call func on each chunk of the IDs.  Returns a list of (chunk,
+        result) pairs, where the result is None if all attempts failed."""
+        chunks = chunk_ids(youtube_ids)
+        if not chunks:
+            return []
+        pool = ThreadPool(min(self.max_in_flight, len(chunks)))
+        try:
+            return pool.map(functools.partial(self._call, func), chunks)
+        finally:
+            pool.close()
+            pool.join()
+
+    def _call(self, func, chunk):
+        meth_name = "_call"
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                time.sleep(self.backoff * 2 ** (attempt - 1))
+            self.limiter.acquire()
+            try:
+                return chunk, func(chunk, self.user_agent,
+                                   self.developer_key, self.session,
+                                   self.url)
+            except (YoutubeException, requests.RequestException) as ex:
+                logger.error("%s: attempt %d: %s", meth_name, attempt + 1, ex)
+        return chunk, None
+
+
+class DownloadEngine(object):
+    """Downloads videos in-process through the youtube_dl API.
+
+    Setting up a YoutubeDL instance is expensive, so each one is kept and
+    reused: a download borrows an idle instance, or creates one if they're
+    all busy.  That makes one instance per download worker.  youtube_dl
+    reports to our logger and progress hooks instead of writing verbose
+    output for us to buffer.
+
+    rate_limit is the maximum download rate of each instance in bytes per
+    second.  factory creates the instances; tests and benchmarks can pass
+    a stand-in for youtube_dl.YoutubeDL."""
+
+    def __init__(self, rate_limit=None, factory=youtube_dl.YoutubeDL):
+        self.rate_limit = rate_limit
+        self.factory = factory
+        self.lock = threading.Lock()
+        self.idle = []
+        self.instances = 0
+
+    def _borrow(self):
+        with self.lock:
+            if self.idle:
+                return self.idle.pop()
+            self.instances += 1
+        params = {
+            "outtmpl": TEMPLATE,
+            "quiet": True,
+            "noprogress": True,
+            "logger": YOUTUBE_DL_LOGGER,
+            "ratelimit": self.rate_limit
+        }
+        ydl = self.factory(params)
+        ydl.add_progress_hook(progress_hook)
+        return ydl
+
+    def _return(self, ydl):
+        with self.lock:
+            self.idle.append(ydl)
+
+    def download(self, dest_dir, youtube_id, policy=None):
+        """Download a video into dest_dir.  Returns the path to the video
+        file, or None if the download failed.
+
+        The policy, a FormatPolicy, picks the format to download.  If it
+        has limits, the video is looked up first, and VideoSkipped is
+        raised if it's over them.  Looking it up doesn't cost an extra
+        request: the download reuses what it found."""
+        meth_name = "download"
+        ydl = self._borrow()
+        try:
+            ydl.params["outtmpl"] = P.join(dest_dir, TEMPLATE)
+            ydl.params["format"] = policy.format_spec() if policy else None
+            if policy is not None and policy.limited:
+                with metrics.timer("youtube.probe"):
+                    info = ydl.extract_info(youtube_id, download=False)
+                reason = policy.check(info)
+                if reason is not None:
+                    logger.info("%s: skipping %s: %s", meth_name, youtube_id,
+                                reason)
+                    metrics.count("youtube.download_skipped")
+                    raise VideoSkipped(reason)
+                with metrics.timer("youtube.download"):
+                    info = ydl.process_ie_result(info, download=True)
+            else:
+                with metrics.timer("youtube.download"):
+                    info = ydl.extract_info(youtube_id, download=True)
+            path = ydl.prepare_filename(info)
+        except DownloadError as ex:
+            logger.error("%s: %s: %s", meth_name, youtube_id, ex)
+            metrics.count("youtube.download_failures")
+            return None
+        finally:
+            self._return(ydl)
+        if not P.isfile(path):
+            logger.error("%s: %s: missing %s", meth_name, youtube_id, path)
+            metrics.count("youtube.download_failures")
+            return None
+        return path
+
+
+class FormatPolicy(object):
+    """Which format of a video to download, and which videos are too big
+    or too long to download at all.
+
+    max_height caps the resolution, max_filesize (in bytes) the size of
+    the file, and max_duration (in seconds) the length of the video.  Zero
+    disables a limit.  container is the file extension to prefer, e.g.
+    mp4, which LiveLeak plays without converting."""
+
+    def __init__(self, max_height=0, max_filesize=0, max_duration=0,
+                 container=None):
+        self.max_height = max_height
+        self.max_filesize = max_filesize
+        self.max_duration = max_duration
+        self.container = container
+
+    def __repr__(self):
+        return ("<FormatPolicy(max_height=%d, max_filesize=%d, "
+                "max_duration=%d, container=%s)>" % (
+                    self.max_height, self.max_filesize, self.max_duration,
+                    repr(self.container)))
+
+    @property
+    def limited(self):
+        return bool(self.max_height or self.max_filesize or self.max_duration)
+
+    def format_spec(self):
+        """Return the youtube_dl format selector, or None to leave the
+        choice to youtube_dl.
+
+        The best single-file format within the limits wins, in the
+        preferred container if there is one.  Formats of unknown size or
+        resolution are allowed through.  If no format is within the limits,
+        the smallest is selected, and check rejects it."""
+        filters = ""
+        if self.max_height:
+            filters += "[height<=?%d]" % self.max_height
+        if self.max_filesize:
+            filters += "[filesize<=?%d]" % self.max_filesize
+        alternatives = []
+        if self.container:
+            alternatives.append("best[ext=%s]%s" % (self.container, filters))
+        if filters:
+            alternatives += ["best" + filters, "worst"]
+        elif alternatives:
+            alternatives.append("best")
+        return "/".join(alternatives) or None
+
+    def check(self, info):
+        """Return the reason the video is over the limits, or None if it's
+        within them.  info is what youtube_dl found out about the video,
+        including the format it selected."""
+        duration = info.get("duration") or 0
+        if self.max_duration and duration > self.max_duration:
+            return "duration %ds over %ds" % (duration, self.max_duration)
+        height = info.get("height") or 0
+        if self.max_height and height > self.max_height:
+            return "height %dp over %dp" % (height, self.max_height)
+        filesize = info.get("filesize") or info.get("filesize_approx") or 0
+        if self.max_filesize and filesize > self.max_filesize:
+            return "filesize %d over %d bytes" % (filesize, self.max_filesize)
+        return None
+
+
+def progress_hook(status):
+    """Called by youtube_dl as a download goes along."""
+    meth_name = "progress_hook"
+    if status["status"] == "downloading":
+        logger.debug("%s: %s: %d bytes so far", meth_name,
+                     status["filename"], status.get("downloaded_bytes") or 0)
+    elif status["status"] == "finished":
+        logger.info("%s: %s: %d bytes", meth_name, status["filename"],
+                    status.get("total_bytes") or 0)
+        metrics.count("youtube.download_bytes",
+                      status.get("total_bytes") or 0)
+    elif status["status"] == "error":
+        logger.error("%s: %s: failed", meth_name, status.get("filename"))
+
+
+def download(dest_dir, youtube_id, rate_limit=None, policy=None):
+    """Download a single video into dest_dir.  Returns the path to the
+    video file, or None if the download failed.  To download several,
+    use a DownloadEngine."""
+    return DownloadEngine(rate_limit).download(dest_dir, youtube_id, policy)
 
 
 class YoutubeException(Exception):
     pass
+
+
+class VideoSkipped(YoutubeException):
+    """The video is over the limits of the format policy, so we didn't
+    download it.  The message says why."""
+    pass